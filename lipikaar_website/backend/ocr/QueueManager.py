@@ -2,6 +2,16 @@ import redis
 
 class QueueManager:
     redis_client = redis.Redis(host='localhost', port=6379, db=0)
+    registered_scripts = {} # script attribute name -> redis Script of redis_client
+
+    @classmethod
+    def get_registered_script(cls, script_name):
+        "The Lua script in the attribute script_name, sent with EVALSHA (and with EVAL only when Redis does not have it yet)."
+        registered_script = cls.registered_scripts.get(script_name)
+        if registered_script is None or registered_script.registered_client is not cls.redis_client:
+            registered_script = cls.redis_client.register_script(getattr(cls, script_name))
+            cls.registered_scripts[script_name] = registered_script
+        return registered_script
 
     # Upload cancelling
     @classmethod
@@ -46,3 +56,177 @@ class QueueManager:
     @classmethod
     def clear_upload_queue(cls):
         cls.redis_client.delete('upload_processing_statuses')
+        cls.redis_client.delete('upload_num_processed_pages')
+
+    # Upload page progress (pages of an upload may be processed in parallel)
+    @classmethod
+    def increment_num_processed_pages(cls, upload_id):
+        return cls.redis_client.hincrby('upload_num_processed_pages', upload_id, 1)
+
+    @classmethod
+    def clear_num_processed_pages(cls, upload_id):
+        cls.redis_client.hdel('upload_num_processed_pages', upload_id)
+
+    # Custom OCR tasks, polled by the user who submitted them
+    @classmethod
+    def add_custom_ocr_task(cls, task_id, user_id, ttl):
+        cls.redis_client.set(f"custom_ocr_tasks:{task_id}", user_id, ex=ttl)
+
+    @classmethod
+    def get_custom_ocr_task_user_id(cls, task_id):
+        value = cls.redis_client.get(f"custom_ocr_tasks:{task_id}")
+        return int(value) if value else None
+
+    # Service jobs: the job status and counters, the result of every finished page (as JSON), and the page indices in completion order
+    @classmethod
+    def create_service_job(cls, job_id, num_pages, callback_url, api_key_id, created_at, ttl):
+        pipeline = cls.redis_client.pipeline()
+        pipeline.hset(f"service_jobs:{job_id}", mapping={
+            'status': "processing",
+            'numPages': num_pages,
+            'numProcessedPages': 0,
+            'numFailedPages': 0,
+            'callbackUrl': callback_url or "",
+            'apiKeyId': api_key_id or "",
+            'createdAt': created_at,
+        })
+        pipeline.expire(f"service_jobs:{job_id}", ttl)
+        pipeline.execute()
+
+    @classmethod
+    def get_service_job(cls, job_id):
+        values = cls.redis_client.hgetall(f"service_jobs:{job_id}")
+        return {key.decode('utf-8'): value.decode('utf-8') for key, value in values.items()} if values else None
+
+    @classmethod
+    def save_service_job_page_result(cls, job_id, page_index, page_result_json, failed, ttl):
+        "Returns the number of processed pages of the job, this page included."
+        pipeline = cls.redis_client.pipeline()
+        pipeline.hset(f"service_job_pages:{job_id}", page_index, page_result_json)
+        pipeline.expire(f"service_job_pages:{job_id}", ttl)
+        pipeline.rpush(f"service_job_completed_pages:{job_id}", page_index)
+        pipeline.expire(f"service_job_completed_pages:{job_id}", ttl)
+        pipeline.hincrby(f"service_jobs:{job_id}", 'numFailedPages', 1 if failed else 0)
+        pipeline.hincrby(f"service_jobs:{job_id}", 'numProcessedPages', 1)
+        return pipeline.execute()[-1]
+
+    @classmethod
+    def get_service_job_page_results(cls, job_id):
+        values = cls.redis_client.hgetall(f"service_job_pages:{job_id}")
+        return {int(page_index): value.decode('utf-8') for page_index, value in values.items()}
+
+    @classmethod
+    def get_service_job_page_results_by_index(cls, job_id, page_indices):
+        values = cls.redis_client.hmget(f"service_job_pages:{job_id}", page_indices)
+        return [value.decode('utf-8') for value in values]
+
+    @classmethod
+    def get_service_job_completed_pages(cls, job_id, start):
+        "Indices of the pages finished after the first start ones, in completion order."
+        return [int(page_index) for page_index in cls.redis_client.lrange(f"service_job_completed_pages:{job_id}", start, -1)]
+
+    @classmethod
+    def update_service_job_status(cls, job_id, job_status):
+        cls.redis_client.hset(f"service_jobs:{job_id}", 'status', job_status)
+
+    # Service API keys: token bucket, in-flight jobs and usage counters of every key
+    acquire_service_api_key_script = """
+    local bucket_key, in_flight_key, usage_key = KEYS[1], KEYS[2], KEYS[3]
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local job_id, max_in_flight_jobs, job_expires_at = ARGV[4], tonumber(ARGV[5]), tonumber(ARGV[6])
+    local in_flight_retry_after = tonumber(ARGV[7])
+
+    redis.call('HINCRBY', usage_key, 'requests', 1)
+
+    if job_id ~= "" and max_in_flight_jobs > 0 then
+        redis.call('ZREMRANGEBYSCORE', in_flight_key, '-inf', now) -- jobs whose worker died
+        if redis.call('ZCARD', in_flight_key) >= max_in_flight_jobs then
+            redis.call('HINCRBY', usage_key, 'rejectedInFlight', 1)
+            return {0, tostring(in_flight_retry_after), 'inFlight'}
+        end
+    end
+
+    local bucket = redis.call('HMGET', bucket_key, 'tokens', 'updatedAt')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+    local bucket_ttl = math.ceil(burst / rate) + 60 -- a bucket left alone that long is full again
+
+    if tokens < 1 then
+        redis.call('HSET', bucket_key, 'tokens', tostring(tokens), 'updatedAt', tostring(now))
+        redis.call('EXPIRE', bucket_key, bucket_ttl)
+        redis.call('HINCRBY', usage_key, 'rejectedRateLimit', 1)
+        return {0, tostring((1 - tokens) / rate), 'rateLimit'}
+    end
+
+    redis.call('HSET', bucket_key, 'tokens', tostring(tokens - 1), 'updatedAt', tostring(now))
+    redis.call('EXPIRE', bucket_key, bucket_ttl)
+    if job_id ~= "" then
+        redis.call('ZADD', in_flight_key, job_expires_at, job_id)
+        redis.call('HINCRBY', usage_key, 'jobs', 1)
+    end
+    return {1, '0', ''}
+    """
+
+    @classmethod
+    def acquire_service_api_key(cls, key_id, requests_per_second, burst, now, job_id, max_in_flight_jobs, job_expires_at, in_flight_retry_after):
+        """
+        Takes a token from the bucket of the key and, with a job_id, a slot for the job, atomically.
+        Returns (allowed, retry_after seconds, rejection reason: "rateLimit" or "inFlight").
+        """
+        allowed, retry_after, reason = cls.get_registered_script('acquire_service_api_key_script')(
+            keys=[
+                f"service_api_key_buckets:{key_id}",
+                f"service_api_key_in_flight:{key_id}",
+                f"service_api_key_usage:{key_id}",
+            ],
+            args=[requests_per_second, burst, now, job_id or "", max_in_flight_jobs, job_expires_at, in_flight_retry_after],
+        )
+        return allowed == 1, float(retry_after), (reason.decode('utf-8') if isinstance(reason, bytes) else reason) or None
+
+    @classmethod
+    def release_service_api_key_job(cls, key_id, job_id):
+        cls.redis_client.zrem(f"service_api_key_in_flight:{key_id}", job_id)
+
+    @classmethod
+    def increment_service_api_key_usage(cls, key_id, counter, amount=1):
+        cls.redis_client.hincrby(f"service_api_key_usage:{key_id}", counter, amount)
+
+    @classmethod
+    def get_service_api_key_usage(cls, key_id, now):
+        pipeline = cls.redis_client.pipeline()
+        pipeline.hgetall(f"service_api_key_usage:{key_id}")
+        pipeline.zcount(f"service_api_key_in_flight:{key_id}", now, '+inf')
+        usage, num_in_flight_jobs = pipeline.execute()
+        return {key.decode('utf-8'): int(value) for key, value in usage.items()}, num_in_flight_jobs
+
+    # Page OCR cache bookkeeping (see ocr/page_ocr_cache.py)
+    @classmethod
+    def increment_page_ocr_cache_size(cls, size_change):
+        "Returns the new total size, or None when the total is not tracked yet."
+        pipeline = cls.redis_client.pipeline()
+        pipeline.exists('page_ocr_cache_size')
+        pipeline.incrby('page_ocr_cache_size', size_change)
+        is_tracked, total_size = pipeline.execute()
+        return total_size if is_tracked else None
+
+    @classmethod
+    def set_page_ocr_cache_size(cls, total_size):
+        cls.redis_client.set('page_ocr_cache_size', total_size)
+
+    @classmethod
+    def acquire_page_ocr_cache_eviction(cls, interval):
+        "True for at most one caller every interval seconds."
+        return bool(cls.redis_client.set('page_ocr_cache_eviction_lock', 1, nx=True, ex=max(1, int(interval))))
+
+    @classmethod
+    def increment_page_ocr_cache_hits(cls, entry_id):
+        cls.redis_client.hincrby('page_ocr_cache_hits', entry_id, 1)
+
+    @classmethod
+    def pop_page_ocr_cache_hits(cls, entry_id):
+        pipeline = cls.redis_client.pipeline()
+        pipeline.hget('page_ocr_cache_hits', entry_id)
+        pipeline.hdel('page_ocr_cache_hits', entry_id)
+        num_hits, _ = pipeline.execute()
+        return int(num_hits) if num_hits else 0
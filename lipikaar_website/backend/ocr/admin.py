@@ -13,9 +13,12 @@ from django.utils.html import format_html
 from django.utils.translation import gettext_lazy
 from django.contrib.admin import SimpleListFilter
 from django.http import HttpResponseRedirect
+from django_object_actions import DjangoObjectActions
 from rest_framework_simplejwt.token_blacklist.models import OutstandingToken, BlacklistedToken
 
-from ocr.models import CustomUser, Upload, Detection
+from redis import RedisError
+
+from ocr.models import CustomUser, Upload, Detection, PageOCRCacheEntry, ServiceAPIKey
 from ocr.cache import (
     create_folder_in_cache,
     download_from_cloud_storage_to_cache,
@@ -30,6 +33,9 @@ from ocr.utils import (
     normalize_detections_text,
 )
 from ocr.cloud_storage import (upload_to_cloud_storage_from_cache)
+from ocr.db_utils import get_upload_pages
+from ocr.page_ocr_cache import get_page_ocr_cache_size, purge_page_ocr_cache
+from ocr.service_api_keys import get_service_api_key_usage
 from ocr_app.settings import BACKEND_BASE_URL, DEBUG
 
 
@@ -267,15 +273,8 @@ class UploadAdmin(admin.ModelAdmin):
             with open(upload_cache_upload_details_json_file_path, "w+") as outfile:
                 outfile.write(upload_details_json)
 
-            detection_ids = try_parse_json_str(upload_object.detection_ids, "list") # Get all the detections for the upload
             all_detection_details = [] # To store all the detections for this upload
-            for i, detection_id in enumerate(detection_ids):
-                try:
-                    detection_object = Detection.objects.get(id=detection_id)
-                except Exception as e:
-                    print(e)
-                    continue                
-
+            for i, detection_object in enumerate(get_upload_pages(upload_object)): # Get all the detections for the upload
                 # copy the image into the images folder
                 download_from_cloud_storage_to_cache(
                     os.path.join("detection_images", detection_object.image_filename),
@@ -284,8 +283,8 @@ class UploadAdmin(admin.ModelAdmin):
 
                 # construct the detection details from the detection object and add them to the list
                 all_detection_details.append({
-                    'user': detection_object.user.id,
-                    'upload': detection_object.upload.id,
+                    'user': detection_object.user_id,
+                    'upload': detection_object.upload_id,
                     'image_filename': f"Page-{i+1}" + get_extension(detection_object.image_filename),
                     'document_parser': detection_object.document_parser,
                     'parsing_postprocessor': detection_object.parsing_postprocessor,
@@ -328,8 +327,66 @@ class DetectionAdmin(admin.ModelAdmin):
     list_display = ('user', 'upload','document_parser','parsing_postprocessor', 'text_recognizer')
 
 
+class PageOCRCacheEntryAdmin(DjangoObjectActions, admin.ModelAdmin):
+    model = PageOCRCacheEntry
+    readonly_fields = ('cache_key', 'page_hash', 'document_parser', 'text_recognizer', 'text_recognizer_version', 'size', 'num_hits', 'created_at', 'last_used_at')
+    exclude = ('detections',)
+    list_display = ('page_hash', 'document_parser', 'text_recognizer', 'text_recognizer_version', 'size', 'num_hits', 'last_used_at')
+    list_filter = ('document_parser', 'text_recognizer')
+    ordering = ('-last_used_at',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['title'] = f"Page OCR Cache ({get_page_ocr_cache_size() / (1024 * 1024):.1f} MB)"
+        return super().changelist_view(request, extra_context=extra_context)
+
+    def purge_cache(self, request, queryset):
+        num_deleted = purge_page_ocr_cache()
+
+        return self.message_user(
+            request,
+            ngettext(
+                f"%d cached page deleted.",
+                f"%d cached pages deleted.",
+                num_deleted,
+            )
+            % num_deleted,
+            messages.SUCCESS,
+        )
+    purge_cache.label = "Purge Cache"
+    purge_cache.short_description = "Delete every cached page"
+
+    changelist_actions = ('purge_cache',)
+
+
+class ServiceAPIKeyAdmin(admin.ModelAdmin):
+    model = ServiceAPIKey
+    readonly_fields = ('created_at', 'usage')
+    list_display = ('name', 'is_active', 'requests_per_minute', 'burst', 'max_in_flight_jobs', 'usage', 'created_at')
+    list_filter = ('is_active',)
+
+    def usage(self, obj):
+        try:
+            usage = get_service_api_key_usage(obj.id)
+        except RedisError:
+            return "Redis unavailable"
+        return (
+            f"{usage['requests']} requests, {usage['jobs']} jobs, {usage['pages']} pages, {usage['inFlightJobs']} in flight, "
+            f"{usage['rejectedRateLimit']} rate limited, {usage['rejectedInFlight']} over the in-flight quota"
+        )
+    usage.short_description = "Usage"
+
+
 admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(Upload, UploadAdmin)
+admin.site.register(PageOCRCacheEntry, PageOCRCacheEntryAdmin)
+admin.site.register(ServiceAPIKey, ServiceAPIKeyAdmin)
 
 # if DEBUG:
 #     admin.site.register(Detection, DetectionAdmin)
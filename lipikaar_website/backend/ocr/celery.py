@@ -1,5 +1,8 @@
 import os
 from celery import Celery
+from celery.concurrency import get_implementation
+from celery.signals import celeryd_after_setup
+from celery.worker.control import inspect_command
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ocr_app.settings')
 
@@ -14,16 +17,41 @@ app.conf.task_routes = {
         'routing_key': 're_run_ocr',
         'queue_arguments': {'x-priority': 10},
     },
+    'ocr.tasks.re_run_ocr_for_bboxes': {
+        'queue': 're_run_ocr',
+        'routing_key': 're_run_ocr',
+        'queue_arguments': {'x-priority': 10},
+    },
     'ocr.tasks.perform_ocr_for_service': {
         'queue': 'ocr_for_service',
         'routing_key': 'ocr_for_service',
         'queue_arguments': {'x-priority': 10},
     },
+    'ocr.tasks.perform_ocr_for_service_job_page': {
+        'queue': 'ocr_for_service',
+        'routing_key': 'ocr_for_service',
+        'queue_arguments': {'x-priority': 10},
+    },
+    'ocr.tasks.send_service_job_callback': {
+        'queue': 'ocr_for_service',
+        'routing_key': 'ocr_for_service',
+        'queue_arguments': {'x-priority': 10},
+    },
     'ocr.tasks.perform_ocr_for_new_upload': {
         'queue': 'new_uploads',
         'routing_key': 'new_uploads',
         'queue_arguments': {'x-priority': 5},
     },
+    'ocr.tasks.perform_ocr_for_upload_pages': {
+        'queue': 'new_uploads',
+        'routing_key': 'new_uploads',
+        'queue_arguments': {'x-priority': 5},
+    },
+    'ocr.tasks.finalize_ocr_for_new_upload': {
+        'queue': 'new_uploads',
+        'routing_key': 'new_uploads',
+        'queue_arguments': {'x-priority': 5},
+    },
 }
 app.conf.broker_transport_options = {
     'visibility_timeout': 1200,  # this doesn't affect priority, but it's part of redis config
@@ -33,3 +61,58 @@ app.conf.broker_transport_options = {
 app.config_from_object("django.conf:settings", namespace="CELERY")
 
 app.autodiscover_tasks()
+
+
+@celeryd_after_setup.connect
+def configure_page_image_cache(sender, instance, **kwargs):
+    """
+    PAGE_IMAGE_CACHE_MAX_SIZE_MB is the budget of the whole worker: it is split between the prefork processes
+    (set before they are forked), and workers not consuming re_run_ocr keep no pages at all.
+    """
+    from ocr.language_ocr_models.page_image_cache import page_image_cache
+    from ocr_app.settings import PAGE_IMAGE_CACHE_MAX_SIZE_MB
+
+    consumed_queues = instance.app.amqp.queues.consume_from # None when the worker consumes every queue
+    if consumed_queues is not None and 're_run_ocr' not in consumed_queues:
+        page_image_cache.set_max_size_mb(0)
+        return
+
+    num_processes = instance.concurrency if instance.pool_cls is get_implementation('prefork') else 1
+    page_image_cache.set_max_size_mb(PAGE_IMAGE_CACHE_MAX_SIZE_MB / max(1, num_processes))
+
+
+@inspect_command()
+def model_server_pool_stats(state):
+    "celery -A ocr.celery inspect model_server_pool_stats"
+    from ocr.language_ocr_models.model_server_session import model_server_session
+    return model_server_session.get_pool_stats()
+
+
+@inspect_command()
+def crop_text_cache_stats(state):
+    "celery -A ocr.celery inspect crop_text_cache_stats"
+    from ocr.language_ocr_models.crop_text_cache import crop_text_cache
+    return crop_text_cache.get_stats()
+
+
+@inspect_command()
+def text_recognizer_batching_stats(state):
+    "celery -A ocr.celery inspect text_recognizer_batching_stats"
+    from ocr.language_ocr_models.main import ocr_instance
+    micro_batcher = ocr_instance.text_recognizers_client.micro_batcher
+    return micro_batcher.get_stats() if micro_batcher is not None else {}
+
+
+@inspect_command()
+def text_recognizer_batch_sizes(state):
+    "celery -A ocr.celery inspect text_recognizer_batch_sizes"
+    from ocr.language_ocr_models.main import ocr_instance
+    batch_size_controller = ocr_instance.text_recognizers_client.batch_size_controller
+    return batch_size_controller.get_stats() if batch_size_controller is not None else {}
+
+
+@inspect_command()
+def page_image_cache_stats(state):
+    "celery -A ocr.celery inspect page_image_cache_stats"
+    from ocr.language_ocr_models.page_image_cache import page_image_cache
+    return page_image_cache.get_stats()
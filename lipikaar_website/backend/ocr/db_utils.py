@@ -36,6 +36,27 @@ from ocr_app.settings import (
     BACKEND_BASE_URL,
 )
 
+
+
+def get_upload_pages(upload_object, fields=None):
+    "The Detections of the pages of an upload in page order, in a single query. fields limits the loaded columns."
+    detections = Detection.objects.filter(upload=upload_object, page_index__isnull=False).order_by('page_index')
+    if fields is not None:
+        detections = detections.only(*fields)
+    return detections
+
+
+def set_upload_pages(upload_object, detection_ids):
+    "Make detection_ids, in this order, the pages of the upload. Saves the upload."
+    detections = list(Detection.objects.filter(id__in=detection_ids).only('id'))
+    page_indices = {detection_id: page_index for page_index, detection_id in enumerate(detection_ids)}
+    for detection in detections:
+        detection.page_index = page_indices[detection.id]
+    Detection.objects.bulk_update(detections, ['page_index'], batch_size=500)
+
+    upload_object.detection_ids = json.dumps([detection.id for detection in sorted(detections, key=lambda detection: detection.page_index)])
+    upload_object.save()
+
         
 def zip_uploads(upload_ids):
     uploads = Upload.objects.filter(id__in=upload_ids)
@@ -75,9 +96,7 @@ def zip_uploads(upload_ids):
             outfile.write(upload_details_json)
 
         # Get all the detections for the upload
-        detection_ids = try_parse_json_str(upload_object.detection_ids, "list")
-        detections = Detection.objects.filter(id__in=detection_ids)
-        detections = sorted(detections, key=lambda detection: detection_ids.index(detection.id))
+        detections = get_upload_pages(upload_object)
         
         all_detection_details = [] # To store all the detections for this upload
         for i, detection_object in enumerate(detections):
@@ -93,8 +112,8 @@ def zip_uploads(upload_ids):
 
             # construct the detection details from the detection object and add them to the list
             all_detection_details.append({
-                'user': detection_object.user.id,
-                'upload': detection_object.upload.id,
+                'user': detection_object.user_id,
+                'upload': detection_object.upload_id,
                 'image_filename': f"Page-{i+1}" + get_extension(detection_object.image_filename),
                 'document_parser': detection_object.document_parser,
                 'parsing_postprocessor': detection_object.parsing_postprocessor,
@@ -161,15 +180,8 @@ def zip_upload(upload_id, dest_folder_name):
     with open(upload_cache_upload_details_json_file_path, "w+") as outfile:
         outfile.write(upload_details_json)
 
-    detection_ids = try_parse_json_str(upload_object.detection_ids, "list") # Get all the detections for the upload
     all_detection_details = [] # To store all the detections for this upload
-    for i, detection_id in enumerate(detection_ids):
-        try:
-            detection_object = Detection.objects.get(id=detection_id)
-        except Exception as e:
-            print(e)
-            continue
-            
+    for i, detection_object in enumerate(get_upload_pages(upload_object)): # Get all the detections for the upload
         try:
             # copy the image into the images folder
             download_from_cloud_storage_to_cache(
@@ -182,8 +194,8 @@ def zip_upload(upload_id, dest_folder_name):
 
         # construct the detection details from the detection object and add them to the list
         all_detection_details.append({
-            'user': detection_object.user.id,
-            'upload': detection_object.upload.id,
+            'user': detection_object.user_id,
+            'upload': detection_object.upload_id,
             'image_filename': f"Page-{i+1}" + get_extension(detection_object.image_filename),
             'document_parser': detection_object.document_parser,
             'parsing_postprocessor': detection_object.parsing_postprocessor,
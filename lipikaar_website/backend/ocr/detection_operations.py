@@ -0,0 +1,63 @@
+"""
+Word-level edits of the detections of a page, sent by DetectionAPIView.patch instead of the whole page.
+Every operation names its word by text_id:
+- {op: "updateText", textId, text}
+- {op: "moveBbox", textId, bbox}: bbox holds the text_bbox keys to change (x_min, x_max, y_min, y_max, line_index, word_index);
+- {op: "insert", detection, afterTextId}: inserts the detection (with its own text_id) after the word afterTextId,
+  or at the end of the page without afterTextId;
+- {op: "delete", textId}
+"""
+
+
+DETECTION_OPERATIONS = ("updateText", "moveBbox", "insert", "delete")
+TEXT_BBOX_KEYS = ("x_min", "x_max", "y_min", "y_max", "line_index", "word_index")
+
+
+def get_text_id_indices(detections):
+    return {str(detection.get('text_id')): i for i, detection in enumerate(detections)}
+
+
+def apply_detection_operations(detections, operations):
+    """
+    Applies the operations, in order, to the detections list (in place).
+    Returns None, or the error message of the first operation that cannot be applied.
+    """
+    text_id_indices = get_text_id_indices(detections)
+
+    for operation_index, operation in enumerate(operations):
+        op = operation['op']
+
+        if op == "insert":
+            detection = operation['detection']
+            text_id = str(detection['text_id'])
+            if text_id in text_id_indices:
+                return f"Operation {operation_index}: text_id {text_id} already exists."
+
+            after_text_id = operation.get('afterTextId', None)
+            if after_text_id is None:
+                detections.append(detection)
+                text_id_indices[text_id] = len(detections) - 1
+                continue
+
+            if after_text_id not in text_id_indices:
+                return f"Operation {operation_index}: text_id {after_text_id} not found."
+            detections.insert(text_id_indices[after_text_id] + 1, detection)
+            text_id_indices = get_text_id_indices(detections)
+            continue
+
+        text_id = operation['textId']
+        if text_id not in text_id_indices:
+            return f"Operation {operation_index}: text_id {text_id} not found."
+        detection_index = text_id_indices[text_id]
+
+        if op == "updateText":
+            detections[detection_index]['text'] = operation['text']
+        elif op == "moveBbox":
+            text_bbox = detections[detection_index].setdefault('text_bbox', {})
+            for key, value in operation['bbox'].items():
+                text_bbox[key] = value
+        elif op == "delete":
+            detections.pop(detection_index)
+            text_id_indices = get_text_id_indices(detections)
+
+    return None
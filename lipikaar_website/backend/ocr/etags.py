@@ -0,0 +1,49 @@
+from hashlib import sha1
+
+from django.utils.http import parse_etags
+
+from ocr.db_utils import get_upload_pages
+from ocr_app.settings import BACKEND_VERSION
+
+
+"""
+ETags of the detections and uploads responses, computed from version numbers only, so that a request whose
+If-None-Match still matches is answered with a 304 before the JSON payloads are loaded or serialized:
+- the detections of an upload: the id and version of each of its pages (Detection.version);
+- the uploads of a user: CustomUser.uploads_version, incremented whenever one of the user's uploads is saved
+  or deleted (see ocr/signals.py).
+The tags also include BACKEND_VERSION and the query params, as both change the response.
+"""
+
+
+def generate_etag(*parts):
+    return '"' + sha1("|".join(str(part) for part in (BACKEND_VERSION, *parts)).encode("utf-8")).hexdigest() + '"'
+
+
+def generate_upload_detections_etag(upload_object, query_params):
+    page_versions = get_upload_pages(upload_object).values_list('id', 'version')
+    return generate_etag("detections", upload_object.id, sorted(query_params.items()), list(page_versions))
+
+
+def generate_uploads_etag(user, query_params):
+    "user has to be freshly loaded, e.g. request.user."
+    return generate_etag("uploads", user.id, user.uploads_version, sorted(query_params.items()))
+
+
+def check_if_etag_matches(request, etag):
+    "If-None-Match of the request lists etag (compared weakly) or is *."
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', "")
+    if if_none_match == "":
+        return False
+
+    request_etags = parse_etags(if_none_match)
+    if "*" in request_etags:
+        return True
+    return etag in [request_etag.removeprefix("W/") for request_etag in request_etags]
+
+
+def set_etag(response, etag):
+    "Lets the client cache the response but revalidate it every time."
+    response['ETag'] = etag
+    response['Cache-Control'] = "private, no-cache"
+    return response
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+from ocr_app.settings import SERVICE_INLINE_OCR_MAX_CONCURRENCY
+
+
+class InlineOCRExecutor:
+    """
+    Runs small service OCR requests in the web process, skipping the Celery broker and result backend.
+    At most max_concurrency requests run at once; when all the slots are busy try_submit returns None
+    and the request goes through Celery instead of queueing up in the web process.
+    """
+
+    def __init__(self, max_concurrency=SERVICE_INLINE_OCR_MAX_CONCURRENCY):
+        self.max_concurrency = max(1, max_concurrency)
+        self.slots = BoundedSemaphore(self.max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="inline-ocr")
+
+    def try_submit(self, fn, *args, **kwargs):
+        "Returns the Future of fn(*args, **kwargs), or None if no slot is free."
+        if not self.slots.acquire(blocking=False):
+            return None
+
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda _future: self.slots.release())
+        return future
+
+
+inline_ocr_executor = InlineOCRExecutor()
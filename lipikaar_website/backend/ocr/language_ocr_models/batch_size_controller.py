@@ -0,0 +1,111 @@
+from collections import deque
+from threading import Lock
+from time import time
+
+from ocr_app.settings import (
+    TEXT_RECOGNIZER_BATCH_SIZE,
+    TEXT_RECOGNIZER_MIN_BATCH_SIZE,
+    TEXT_RECOGNIZER_MAX_BATCH_SIZE,
+    TEXT_RECOGNIZER_TARGET_LATENCY,
+)
+
+
+LATENCY_SMOOTHING = 0.3 # weight of the newest request in the moving averages
+NUM_RECENT_MEASUREMENTS = 20
+
+
+class ModelBatchSize:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.average_latency = None # seconds per request
+        self.average_throughput = None # crops per second
+        self.num_requests = 0
+        self.num_failed_requests = 0
+        self.recent_measurements = deque(maxlen=NUM_RECENT_MEASUREMENTS)
+
+
+class AdaptiveBatchSizeController:
+    """
+    Batch size of the text recognizer requests, per modelId, kept so that one request takes about
+    target_latency seconds on the current server load:
+    - a full batch that was answered well within the target grows the batch size by min_batch_size;
+    - a request slower than the target shrinks it in proportion (assuming the latency grows with the
+      number of crops), and a failed request halves it.
+    """
+
+    def __init__(
+        self,
+        initial_batch_size=TEXT_RECOGNIZER_BATCH_SIZE,
+        min_batch_size=TEXT_RECOGNIZER_MIN_BATCH_SIZE,
+        max_batch_size=TEXT_RECOGNIZER_MAX_BATCH_SIZE,
+        target_latency=TEXT_RECOGNIZER_TARGET_LATENCY,
+    ):
+        self.min_batch_size = max(1, min_batch_size)
+        self.max_batch_size = max(self.min_batch_size, max_batch_size)
+        self.initial_batch_size = self.clip(initial_batch_size if initial_batch_size > 0 else self.max_batch_size)
+        self.target_latency = target_latency
+
+        self.lock = Lock()
+        self.model_batch_sizes = {}
+
+    def clip(self, batch_size):
+        return min(self.max_batch_size, max(self.min_batch_size, batch_size))
+
+    def get_batch_size(self, model_id):
+        with self.lock:
+            model_batch_size = self.model_batch_sizes.get(model_id)
+            return model_batch_size.batch_size if model_batch_size is not None else self.initial_batch_size
+
+    def record(self, model_id, num_images, latency, succeeded):
+        "Called after every recognizer request with its number of crops and duration in seconds."
+        with self.lock:
+            model_batch_size = self.model_batch_sizes.get(model_id)
+            if model_batch_size is None:
+                model_batch_size = self.model_batch_sizes[model_id] = ModelBatchSize(self.initial_batch_size)
+
+            batch_size = model_batch_size.batch_size
+            model_batch_size.num_requests += 1
+            model_batch_size.recent_measurements.append({
+                'time': time(),
+                'numImages': num_images,
+                'latency': round(latency, 4),
+                'succeeded': succeeded,
+                'batchSize': batch_size,
+            })
+
+            if not succeeded:
+                model_batch_size.num_failed_requests += 1
+                model_batch_size.batch_size = self.clip(batch_size // 2)
+                return
+
+            throughput = num_images / latency if latency > 0 else 0.0
+            if model_batch_size.average_latency is None:
+                model_batch_size.average_latency = latency
+                model_batch_size.average_throughput = throughput
+            else:
+                model_batch_size.average_latency += LATENCY_SMOOTHING * (latency - model_batch_size.average_latency)
+                model_batch_size.average_throughput += LATENCY_SMOOTHING * (throughput - model_batch_size.average_throughput)
+
+            if latency > self.target_latency:
+                model_batch_size.batch_size = self.clip(min(batch_size - 1, int(num_images * self.target_latency / latency)))
+            elif num_images >= batch_size and latency < 0.8 * self.target_latency:
+                model_batch_size.batch_size = self.clip(batch_size + self.min_batch_size)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'targetLatency': self.target_latency,
+                'minBatchSize': self.min_batch_size,
+                'maxBatchSize': self.max_batch_size,
+                'models': {
+                    model_id: {
+                        'batchSize': model_batch_size.batch_size,
+                        'averageLatency': model_batch_size.average_latency,
+                        'averageThroughput': model_batch_size.average_throughput,
+                        'numRequests': model_batch_size.num_requests,
+                        'numFailedRequests': model_batch_size.num_failed_requests,
+                        'recentMeasurements': list(model_batch_size.recent_measurements),
+                    }
+                    for model_id, model_batch_size in self.model_batch_sizes.items()
+                },
+            }
@@ -0,0 +1,130 @@
+from cv2 import transform
+from numpy import (
+    asarray,
+    dtype,
+    empty,
+    float32,
+    float64,
+    int16,
+    int32,
+    int64,
+    unique,
+)
+
+
+bbox_dtype = dtype([
+    # float64 holds the int and the float coordinates of the document parsers exactly
+    ('x_min', float64),
+    ('y_min', float64),
+    ('x_max', float64),
+    ('y_max', float64),
+    ('rotation', float64),
+    ('line_index', int32),
+    ('word_index', int32),
+    ('language_index', int16), # index into BBoxArray.text_languages
+])
+
+
+class BBoxArray:
+    """
+    The bboxes of a page as one structured NumPy array (bbox_dtype) instead of a list of dicts.
+    Filtering, offsets and rotation transforms work on all the bboxes at once. Indexing with an int,
+    slice, index array or boolean mask returns a BBoxArray sharing text_languages.
+    Convert to the detection dict format with to_dicts only when building the API response.
+    """
+
+    def __init__(self, data, text_languages=()):
+        self.data = data
+        self.text_languages = tuple(text_languages)
+
+    @classmethod
+    def from_dicts(cls, bboxes):
+        "bboxes as returned by the document parsers; rotation, line_index and word_index default to 0."
+        text_languages = {}
+        data = empty(len(bboxes), dtype=bbox_dtype)
+
+        for i, bbox in enumerate(bboxes):
+            text_language = bbox.get('text_language', "")
+            language_index = text_languages.setdefault(text_language, len(text_languages))
+            data[i] = (
+                bbox['x_min'],
+                bbox['y_min'],
+                bbox['x_max'],
+                bbox['y_max'],
+                bbox.get('rotation', 0),
+                bbox.get('line_index', 0),
+                bbox.get('word_index', 0),
+                language_index,
+            )
+
+        return cls(data, text_languages.keys())
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        data = self.data[index]
+        if data.ndim == 0:
+            data = data.reshape(1)
+        return BBoxArray(data, self.text_languages)
+
+    @property
+    def widths(self):
+        return self.data['x_max'] - self.data['x_min']
+
+    @property
+    def heights(self):
+        return self.data['y_max'] - self.data['y_min']
+
+    @property
+    def rotations(self):
+        return self.data['rotation']
+
+    def get_unique_rotations(self):
+        return unique(self.data['rotation']).tolist()
+
+    def filter_by_min_size(self, min_width, min_height):
+        return self[(self.widths >= min_width) & (self.heights >= min_height)]
+
+    def offset(self, x_offset, y_offset):
+        data = self.data.copy()
+        data['x_min'] += x_offset
+        data['x_max'] += x_offset
+        data['y_min'] += y_offset
+        data['y_max'] += y_offset
+        return BBoxArray(data, self.text_languages)
+
+    def get_windows_after_rotation_transform(self, rotation_matrix):
+        """
+        Batched get_bbox_after_rotation_transform: the top left corners are transformed by rotation_matrix and
+        the widths and heights are kept, with the same arithmetic (float32 corners, float64 sums) and truncation.
+        Returns an (n, 4) int64 array of x_min, y_min, x_max, y_max.
+        """
+        min_points = asarray([self.data['x_min'], self.data['y_min']], dtype=float32).T.reshape(-1, 1, 2)
+        transformed_min_points = transform(min_points, rotation_matrix).reshape(-1, 2)
+
+        windows = empty((len(self), 4), dtype=int64)
+        windows[:, 0] = transformed_min_points[:, 0].astype(int64)
+        windows[:, 1] = transformed_min_points[:, 1].astype(int64)
+        windows[:, 2] = (transformed_min_points[:, 0].astype(float64) + self.widths).astype(int64)
+        windows[:, 3] = (transformed_min_points[:, 1].astype(float64) + self.heights).astype(int64)
+        return windows
+
+    def to_dicts(self):
+        "Whole coordinates are given back as ints, like the document parsers send them."
+        columns = {name: self.data[name].tolist() for name in bbox_dtype.names}
+        for name in ('x_min', 'y_min', 'x_max', 'y_max'):
+            columns[name] = [int(value) if value.is_integer() else value for value in columns[name]]
+        return [
+            {
+                'x_min': columns['x_min'][i],
+                'y_min': columns['y_min'][i],
+                'x_max': columns['x_max'][i],
+                'y_max': columns['y_max'][i],
+                'rotation': columns['rotation'][i],
+                'line_index': columns['line_index'][i],
+                'word_index': columns['word_index'][i],
+                'text_language': self.text_languages[columns['language_index'][i]],
+            }
+            for i in range(len(self))
+        ]
@@ -0,0 +1,122 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+
+from redis import Redis, RedisError
+
+from ocr_app.settings import (
+    CROP_TEXT_CACHE_MAX_ENTRIES,
+    CROP_TEXT_CACHE_REDIS_URL,
+    CROP_TEXT_CACHE_REDIS_TTL,
+)
+
+
+def get_crop_hash(pil_image):
+    crop_hash = blake2b(digest_size=20)
+    crop_hash.update(f"{pil_image.mode}:{pil_image.width}x{pil_image.height}:".encode("utf-8"))
+    crop_hash.update(pil_image.tobytes())
+    return crop_hash.hexdigest()
+
+
+def get_crop_text_redis_key(model_id, model_version, crop_hash):
+    return f"crop_texts:{model_id}:{model_version}:{crop_hash}"
+
+
+class CropTextCache:
+    """
+    Recognized texts keyed by (text recognizer modelId and version, crop hash), in two levels:
+    - an in-process LRU of at most max_entries texts;
+    - the Redis at redis_url, shared by all the workers, with every text expiring after redis_ttl seconds
+      (no redis_url or a redis_ttl of 0 disables it). Its size is only bounded by its own maxmemory policy,
+      so it should not be the broker Redis.
+    Redis errors count as misses, the cache never fails a recognition.
+    """
+
+    def __init__(self, max_entries=CROP_TEXT_CACHE_MAX_ENTRIES, redis_url=CROP_TEXT_CACHE_REDIS_URL, redis_ttl=CROP_TEXT_CACHE_REDIS_TTL):
+        self.max_entries = max(0, max_entries)
+        self.redis_ttl = redis_ttl
+        self.redis_client = Redis.from_url(redis_url) if redis_url and redis_ttl > 0 else None
+
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.num_local_hits = 0
+        self.num_redis_hits = 0
+        self.num_misses = 0
+
+    def get_many(self, model_id, model_version, crop_hashes):
+        "Returns {crop_hash: text} for the crops found in the cache."
+        crop_texts = {}
+        with self.lock:
+            for crop_hash in crop_hashes:
+                key = (model_id, model_version, crop_hash)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    crop_texts[crop_hash] = self.entries[key]
+            self.num_local_hits += len(crop_texts)
+
+        missing_crop_hashes = [crop_hash for crop_hash in crop_hashes if crop_hash not in crop_texts]
+        redis_crop_texts = self.get_many_from_redis(model_id, model_version, missing_crop_hashes)
+        self.set_many_in_memory(model_id, model_version, redis_crop_texts)
+        crop_texts.update(redis_crop_texts)
+
+        with self.lock:
+            self.num_redis_hits += len(redis_crop_texts)
+            self.num_misses += len(missing_crop_hashes) - len(redis_crop_texts)
+
+        return crop_texts
+
+    def set_many(self, model_id, model_version, crop_texts):
+        self.set_many_in_memory(model_id, model_version, crop_texts)
+
+        if self.redis_client is not None and len(crop_texts) > 0:
+            try:
+                pipeline = self.redis_client.pipeline(transaction=False)
+                for crop_hash, text in crop_texts.items():
+                    pipeline.set(get_crop_text_redis_key(model_id, model_version, crop_hash), text, ex=self.redis_ttl)
+                pipeline.execute()
+            except RedisError as e:
+                print("Error at ocr.language_ocr_models.crop_text_cache.CropTextCache")
+                print(4 * " " + str(e))
+
+    def set_many_in_memory(self, model_id, model_version, crop_texts):
+        if self.max_entries == 0:
+            return
+
+        with self.lock:
+            for crop_hash, text in crop_texts.items():
+                self.entries[(model_id, model_version, crop_hash)] = text
+                self.entries.move_to_end((model_id, model_version, crop_hash))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_many_from_redis(self, model_id, model_version, crop_hashes):
+        if self.redis_client is None or len(crop_hashes) == 0:
+            return {}
+
+        try:
+            values = self.redis_client.mget([get_crop_text_redis_key(model_id, model_version, crop_hash) for crop_hash in crop_hashes])
+            return {crop_hash: value.decode('utf-8') for crop_hash, value in zip(crop_hashes, values) if value is not None}
+        except RedisError as e:
+            print("Error at ocr.language_ocr_models.crop_text_cache.CropTextCache")
+            print(4 * " " + str(e))
+            return {}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            num_lookups = self.num_local_hits + self.num_redis_hits + self.num_misses
+            return {
+                'entries': len(self.entries),
+                'maxEntries': self.max_entries,
+                'redisTTL': self.redis_ttl if self.redis_client is not None else 0,
+                'localHits': self.num_local_hits,
+                'redisHits': self.num_redis_hits,
+                'misses': self.num_misses,
+                'hitRate': ((self.num_local_hits + self.num_redis_hits) / num_lookups) if num_lookups > 0 else 0.0,
+            }
+
+
+crop_text_cache = CropTextCache()
@@ -1,7 +1,11 @@
 import requests
 
-from .utils import pil_image_to_base64_str, flatten_dict, log_FastAPI_response_error
-from ocr_app.settings import DOCUMENT_PARSERS_API_PROVIDER_URL
+from .model_config_registry import ModelConfigRegistry
+from .model_server_session import model_server_session
+from .page_image import PageImage
+from .transport import IMAGE_FORMATS, get_image_encoding, encode_image_to_base64_str, build_multipart_request
+from .utils import flatten_dict, log_FastAPI_response_error
+from ocr_app.settings import DOCUMENT_PARSERS_API_PROVIDER_URL, DOCUMENT_PARSER_SEND_ORIGINAL_IMAGE, MODEL_SERVER_CONNECT_TIMEOUT, MODEL_CONFIG_FETCH_TIMEOUT
 
 
 def get_document_parsers_config(api_provider_url): # TODO: fix this (and more importantly, standardize it)
@@ -9,9 +13,15 @@ def get_document_parsers_config(api_provider_url): # TODO: fix this (and more im
         return []
     
     get_text_recognizers_config_url = api_provider_url + "/config/"
-    response = requests.get(get_text_recognizers_config_url)
+    try:
+        response = model_server_session.get(get_text_recognizers_config_url, timeout=(MODEL_SERVER_CONNECT_TIMEOUT, MODEL_CONFIG_FETCH_TIMEOUT))
+    except requests.RequestException as e:
+        print("Error at ocr.language_ocr_models.document_parsers.get_document_parsers_config")
+        print(4 * " " + str(e))
+        return None
+
     if response.status_code != 200:
-        return []
+        return None
 
     response_data = response.json()
     dp_config = response_data['result']['documentParsersConfig']
@@ -24,27 +34,56 @@ def get_document_parsers_config(api_provider_url): # TODO: fix this (and more im
 class LipikarDocumentParserClient:
     def __init__(self):
         self.endpoint = DOCUMENT_PARSERS_API_PROVIDER_URL + "/get-bboxes-for-image/"
+        self.endpoints = { # one endpoint per image transport
+            'json': self.endpoint,
+            'multipart': DOCUMENT_PARSERS_API_PROVIDER_URL + "/get-bboxes-for-image/multipart/",
+            'packed': DOCUMENT_PARSERS_API_PROVIDER_URL + "/get-bboxes-for-image/packed/",
+        }
     
     def get_bboxes_for_image(self, image, model_id, language, allow_padding):
-        request_body = {
-            'imageContent': pil_image_to_base64_str(image),
+        "image is a PIL image or a PageImage."
+        image_encoding = get_image_encoding()
+        if DOCUMENT_PARSER_SEND_ORIGINAL_IMAGE and isinstance(image, PageImage) and image.encoded_image is not None and image_encoding['format'] != "RAW" and image.format in IMAGE_FORMATS:
+            # in its own format, the page is sent as the original file bytes without re-encoding
+            image_encoding['format'] = image.format
+
+        endpoint = self.endpoints[image_encoding['transport']]
+
+        request_config = {
             'parser': model_id,
             'language': language,
             'allowPadding': allow_padding,
         }
         
         # TODO: Add API Key in headers
-        response = requests.post(self.endpoint, json=request_body)
+        try:
+            if image_encoding['transport'] == "json":
+                request_body = {
+                    'imageContent': encode_image_to_base64_str(image, image_encoding['format'], image_encoding['quality']),
+                    **request_config,
+                }
+                response = model_server_session.post(endpoint, json=request_body)
+            else:
+                request_data, request_files = build_multipart_request(request_config, [image], image_encoding, "image")
+                response = model_server_session.post(endpoint, data=request_data, files=request_files)
+        except requests.RequestException as e:
+            print("Error at ocr.language_ocr_models.document_parsers.LipikarDocumentParserClient")
+            print(4 * " " + f"Request failed: {e}")
+            print(4 * " " + f"Endpoint: {endpoint}")
+            print(4 * " " + f"model_id: {model_id}")
+
+            return []
+
         if response.status_code != 200:
-            print("Error at ocr.language_ocr_models.text_recognizers.LipikarULCA_TextRecognizerClient")
+            print("Error at ocr.language_ocr_models.document_parsers.LipikarDocumentParserClient")
             print(4 * " " + f"Received status code {response.status_code} for ocr request")
-            print(4 * " " + f"Endpoint: {self.endpoint}")
+            print(4 * " " + f"Endpoint: {endpoint}")
             # print(4 * " " + f"Num images: {len(images)}")
             print(4 * " " + f"model_id: {model_id}")
 
             log_FastAPI_response_error(response)
 
-            return [""] * len(images)
+            return []
         
         response_data = response.json()
 
@@ -55,4 +94,4 @@ class LipikarDocumentParserClient:
         
         return bboxes
 
-document_parsers_config = get_document_parsers_config(DOCUMENT_PARSERS_API_PROVIDER_URL)
+document_parsers_config_registry = ModelConfigRegistry("document_parsers", lambda: get_document_parsers_config(DOCUMENT_PARSERS_API_PROVIDER_URL))
@@ -1,28 +1,48 @@
-from PIL import Image
-
-from .document_parsers import document_parsers_config, LipikarDocumentParserClient
-from .text_recognizers import text_recognizers_config, LipikarULCA_TextRecognizerClient
+from collections import namedtuple
+
+from .bboxes import BBoxArray
+from .page_image import PageImage
+from .page_image_cache import page_image_cache
+from .pipeline import PagePipeline
+from .document_parsers import document_parsers_config_registry, LipikarDocumentParserClient
+from .text_recognizers import text_recognizers_config_registry, LipikarULCA_TextRecognizerClient
 from .utils import (
     get_cropped_images_for_bboxes,
     get_detections_from_bboxes_and_recognized_texts,
     remove_bboxes_with_low_width_or_height,
-    save_pil_image,
 )
 from ocr.models import Upload
+from ocr.page_ocr_cache import (
+    get_page_hash,
+    get_page_ocr_cache_key,
+    get_cached_page_detections,
+    save_page_detections_to_cache,
+)
 from ocr.QueueManager import QueueManager
-from ocr.utils import upload_processing_status_generators, find_dict_in_list_by_key_and_value
+from ocr.utils import upload_processing_status_generators
+from ocr_app.settings import OCR_PIPELINE_MAX_PAGES_IN_FLIGHT, PAGE_OCR_CACHE_ENABLED
+
+
+# page_hash is None when the page OCR cache is disabled, cached_detections is None on a cache miss
+ParsedPage = namedtuple('ParsedPage', ['page_image', 'bboxes', 'page_hash', 'cached_detections'])
 
 
 class OCR:
     def __init__(self):
-        self.document_parsers_config = document_parsers_config
+        # the model configs are loaded on first use and refreshed in the background, see ModelConfigRegistry
+        self.document_parsers_config_registry = document_parsers_config_registry
         self.document_parsers_client = LipikarDocumentParserClient()
-        self.text_recognizers_config = text_recognizers_config
+        self.text_recognizers_config_registry = text_recognizers_config_registry
         self.text_recognizers_client = LipikarULCA_TextRecognizerClient()
 
-        self.available_document_parsers = [document_parser['modelId'] for document_parser in document_parsers_config]
-        self.available_text_recognizers = [text_recognizer['modelId'] for text_recognizer in text_recognizers_config]
-    
+    @property
+    def document_parsers_config(self):
+        return self.document_parsers_config_registry.get_all()
+
+    @property
+    def text_recognizers_config(self):
+        return self.text_recognizers_config_registry.get_all()
+
     def get_config(self):
         return {
             'document_parsers': self.document_parsers_config,
@@ -32,55 +52,106 @@ class OCR:
     def validate_config(self, ocr_config):
         invalid_keys = []
 
-        if not ocr_config.get('document_parser', "") in self.available_document_parsers:
+        if not ocr_config.get('document_parser', "") in self.document_parsers_config_registry:
             invalid_keys.append("document_parser")
         
-        if not ocr_config.get('text_recognizer', "") in self.available_text_recognizers:
+        if not ocr_config.get('text_recognizer', "") in self.text_recognizers_config_registry:
             invalid_keys.append("text_recognizer")
 
         return invalid_keys
 
     def get_full_ocr_config(self, document_parser_id, text_recognizer_id):
         return {
-            'document_parser': find_dict_in_list_by_key_and_value(self.document_parsers_config, 'modelId', document_parser_id),
-            'text_recognizer': find_dict_in_list_by_key_and_value(self.text_recognizers_config, 'modelId', text_recognizer_id),
+            'document_parser': self.document_parsers_config_registry.get(document_parser_id),
+            'text_recognizer': self.text_recognizers_config_registry.get(text_recognizer_id),
         }
 
-    def perform_ocr_on_full_image(
-        self,
-        upload_id,
-        image_path,
-        image_num,
-        num_total_images,
-        ocr_config
-    ):
-        if upload_id is not None and image_num is not None and num_total_images is not None:
-            updated_processing_status = upload_processing_status_generators['processing_page'](image_num, num_total_images)
-            QueueManager.update_upload_processing_status(upload_id, updated_processing_status)
+    def parse_page(self, image_path, ocr_config):
+        page_image = PageImage.open(image_path)
 
-        pil_image = Image.open(image_path)
+        page_hash = None
+        if PAGE_OCR_CACHE_ENABLED:
+            page_hash = get_page_hash(page_image)
+            cache_key = get_page_ocr_cache_key(page_hash, ocr_config)
+            if cache_key is None: # models without a version are not cached
+                page_hash = None
+            else:
+                cached_detections = get_cached_page_detections(cache_key)
+                if cached_detections is not None:
+                    return ParsedPage(page_image, None, page_hash, cached_detections)
 
         bboxes = self.document_parsers_client.get_bboxes_for_image(
-            pil_image,
+            page_image,
             ocr_config['document_parser']['modelId'],
             ocr_config['text_recognizer']['language'][0],
             True, #TODO: get allowPadding from the parser config
         )
-        for bbox in bboxes:
-            if not 'rotation' in bbox.keys():
-                bbox['rotation'] = 0
+        bboxes = BBoxArray.from_dicts(bboxes) # missing rotations default to 0
         bboxes = remove_bboxes_with_low_width_or_height(bboxes, 1, 1)
 
-        cropped_images = get_cropped_images_for_bboxes(pil_image, bboxes)
+        return ParsedPage(page_image, bboxes, page_hash, None)
 
-        recognized_texts = self.text_recognizers_client.get_texts_for_images(
+    def recognize_page(self, parsed_page, ocr_config):
+        "Returns (detections, is_cached)."
+        if parsed_page.cached_detections is not None:
+            return parsed_page.cached_detections, True
+
+        cropped_images = get_cropped_images_for_bboxes(parsed_page.page_image, parsed_page.bboxes)
+
+        recognized_texts, num_failed_batches = self.text_recognizers_client.recognize_images(
             cropped_images,
-            ocr_config['text_recognizer']['modelId']
+            ocr_config['text_recognizer']['modelId'],
+            ocr_config['text_recognizer'].get('version')
         )
 
-        detections = get_detections_from_bboxes_and_recognized_texts(bboxes, recognized_texts)
+        detections = get_detections_from_bboxes_and_recognized_texts(parsed_page.bboxes, recognized_texts)
 
-        return detections
+        # pages without bboxes are not cached, the document parser also returns no bboxes when it fails
+        if parsed_page.page_hash is not None and len(detections) > 0 and num_failed_batches == 0:
+            cache_key = get_page_ocr_cache_key(parsed_page.page_hash, ocr_config)
+            save_page_detections_to_cache(cache_key, parsed_page.page_hash, ocr_config, detections)
+
+        return detections, False
+
+    def perform_ocr_on_full_image(
+        self,
+        upload_id,
+        image_path,
+        image_num,
+        num_total_images,
+        ocr_config,
+        return_cache_status=False
+    ):
+        "Returns the detections, or (detections, is_cached) with return_cache_status."
+        if upload_id is not None and image_num is not None and num_total_images is not None:
+            updated_processing_status = upload_processing_status_generators['processing_page'](image_num, num_total_images)
+            QueueManager.update_upload_processing_status(upload_id, updated_processing_status)
+
+        parsed_page = self.parse_page(image_path, ocr_config)
+        detections, is_cached = self.recognize_page(parsed_page, ocr_config)
+
+        return (detections, is_cached) if return_cache_status else detections
+
+    def perform_ocr_on_multiple_images(self, image_paths, ocr_config, max_pages_in_flight=OCR_PIPELINE_MAX_PAGES_IN_FLIGHT, on_page_start=None):
+        """
+        Pipelined version of perform_ocr_on_full_image for multiple pages: the document parser works on
+        the next page while the current one is being cropped and recognized.
+        on_page_start(image_path) is called when a page is sent to the document parser.
+        Yields ((detections, is_cached), error) for every image path, in order.
+        """
+        def parse_page(image_path):
+            if on_page_start is not None:
+                on_page_start(image_path)
+            return self.parse_page(image_path, ocr_config)
+
+        pipeline = PagePipeline(
+            [
+                parse_page,
+                lambda parsed_page: self.recognize_page(parsed_page, ocr_config),
+            ],
+            max_pages_in_flight
+        )
+        return pipeline.run(image_paths)
 
     def perform_ocr_for_single_bbox(
         self,
@@ -89,12 +160,31 @@ class OCR:
         text_recognizer,
         copy_image = True
     ):
-        pil_image = Image.open(image_path)
-        print(bbox)
-        cropped_images = get_cropped_images_for_bboxes(pil_image, [bbox])
-        save_pil_image(cropped_images[0])
+        page_image = page_image_cache.open(image_path) # repeated edits on a page reuse its decoded pixels
+        cropped_images = get_cropped_images_for_bboxes(page_image, BBoxArray.from_dicts([bbox]))
         recognized_texts = self.text_recognizers_client.get_texts_for_images(
             cropped_images,
-            text_recognizer['modelId']
+            text_recognizer['modelId'],
+            text_recognizer.get('version')
         )
         return recognized_texts[0]
+
+    def perform_ocr_for_bboxes(self, image_path, bboxes, text_recognizer):
+        """
+        perform_ocr_for_single_bbox for many bboxes of one page: the page is decoded once and the crops are
+        recognized together. Returns the texts in the order of bboxes, "" for bboxes without any area.
+        """
+        page_image = page_image_cache.open(image_path)
+        bboxes = BBoxArray.from_dicts(bboxes)
+        bboxes_have_area = (bboxes.widths >= 1) & (bboxes.heights >= 1)
+
+        cropped_images = get_cropped_images_for_bboxes(page_image, bboxes[bboxes_have_area])
+        recognized_texts = iter(self.text_recognizers_client.get_texts_for_images(
+            cropped_images,
+            text_recognizer['modelId'],
+            text_recognizer.get('version')
+        ))
+        return [next(recognized_texts) if bbox_has_area else "" for bbox_has_area in bboxes_have_area]
+
+
+ocr_instance = OCR() # shared by the views and the tasks, creating it does not contact the model servers
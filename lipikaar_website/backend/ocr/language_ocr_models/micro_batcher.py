@@ -0,0 +1,142 @@
+import os
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+
+class PendingRecognition:
+    def __init__(self, images):
+        self.images = images
+        self.future = Future()
+        self.submitted_at = monotonic()
+
+
+class RecognizerMicroBatcher:
+    """
+    Gathers the crops that concurrent callers (pages of the OCR pipeline, tasks of a worker running with
+    --pool=threads) send to the same text recognizer modelId into larger batches.
+    A batch is sent once it has get_max_batch_size(model_id) crops, or once its oldest crop has waited max_wait seconds.
+    send_batch(images, model_id) -> (texts, succeeded) runs on executor, and every caller's future
+    resolves to (its own texts, succeeded).
+    """
+
+    def __init__(self, send_batch, executor, get_max_batch_size, max_wait):
+        self.send_batch = send_batch
+        self.executor = executor
+        self.get_max_batch_size = get_max_batch_size
+        self.max_wait = max(0.0, max_wait)
+
+        self.condition = Condition()
+        self.pending_recognitions = {} # modelId -> [PendingRecognition], oldest first
+        self.dispatcher_thread = None
+        self.dispatcher_pid = None
+
+        self.stats_lock = Lock()
+        self.num_recognitions = 0
+        self.num_batches = 0
+        self.num_images = 0
+
+    def submit(self, model_id, images):
+        "Returns a Future of (texts, succeeded) for images."
+        pending_recognition = PendingRecognition(images)
+
+        with self.condition:
+            self.start_dispatcher_thread()
+            self.pending_recognitions.setdefault(model_id, []).append(pending_recognition)
+            self.condition.notify()
+
+        return pending_recognition.future
+
+    def start_dispatcher_thread(self):
+        "Called with the condition held. Also restarts the thread in forked worker processes."
+        if self.dispatcher_thread is not None and self.dispatcher_pid == os.getpid() and self.dispatcher_thread.is_alive():
+            return
+
+        self.dispatcher_pid = os.getpid()
+        self.dispatcher_thread = Thread(target=self.dispatch_batches, name="text-recognizer-micro-batcher", daemon=True)
+        self.dispatcher_thread.start()
+
+    def dispatch_batches(self):
+        while True:
+            with self.condition:
+                ready_batches = self.take_ready_batches()
+                if len(ready_batches) == 0:
+                    self.condition.wait(self.get_time_until_next_deadline())
+                    continue
+
+            for model_id, batch_recognitions in ready_batches:
+                self.executor.submit(self.send_recognitions, model_id, batch_recognitions)
+
+    def take_ready_batches(self):
+        "Called with the condition held."
+        now = monotonic()
+        ready_batches = []
+
+        for model_id in list(self.pending_recognitions.keys()):
+            pending_recognitions = self.pending_recognitions[model_id]
+            max_batch_size = max(1, self.get_max_batch_size(model_id))
+
+            while len(pending_recognitions) > 0:
+                num_pending_images = sum(len(pending_recognition.images) for pending_recognition in pending_recognitions)
+                if num_pending_images < max_batch_size and now - pending_recognitions[0].submitted_at < self.max_wait:
+                    break
+
+                batch_recognitions = [pending_recognitions.pop(0)]
+                num_batch_images = len(batch_recognitions[0].images)
+                while len(pending_recognitions) > 0 and num_batch_images + len(pending_recognitions[0].images) <= max_batch_size:
+                    num_batch_images += len(pending_recognitions[0].images)
+                    batch_recognitions.append(pending_recognitions.pop(0))
+
+                ready_batches.append((model_id, batch_recognitions))
+
+            if len(pending_recognitions) == 0:
+                del self.pending_recognitions[model_id]
+
+        return ready_batches
+
+    def get_time_until_next_deadline(self):
+        "Called with the condition held. None waits until the next submit."
+        if len(self.pending_recognitions) == 0:
+            return None
+
+        oldest_submitted_at = min(pending_recognitions[0].submitted_at for pending_recognitions in self.pending_recognitions.values())
+        return max(0.0, oldest_submitted_at + self.max_wait - monotonic())
+
+    def send_recognitions(self, model_id, batch_recognitions):
+        images = []
+        for pending_recognition in batch_recognitions:
+            images += pending_recognition.images
+
+        with self.stats_lock:
+            self.num_recognitions += len(batch_recognitions)
+            self.num_batches += 1
+            self.num_images += len(images)
+
+        try:
+            texts, succeeded = self.send_batch(images, model_id)
+        except Exception as e:
+            for pending_recognition in batch_recognitions:
+                pending_recognition.future.set_exception(e)
+            return
+
+        if not succeeded and len(batch_recognitions) > 1: # resend each caller's crops alone, so one bad page does not fail the others
+            for pending_recognition in batch_recognitions:
+                self.send_recognitions(model_id, [pending_recognition])
+            return
+
+        start = 0
+        for pending_recognition in batch_recognitions:
+            end = start + len(pending_recognition.images)
+            pending_recognition.future.set_result((texts[start:end], succeeded))
+            start = end
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {
+                'maxWait': self.max_wait,
+                'numRecognitions': self.num_recognitions,
+                'numBatches': self.num_batches,
+                'numImages': self.num_images,
+                'averageBatchSize': (self.num_images / self.num_batches) if self.num_batches > 0 else 0.0,
+                'averageRecognitionsPerBatch': (self.num_recognitions / self.num_batches) if self.num_batches > 0 else 0.0,
+            }
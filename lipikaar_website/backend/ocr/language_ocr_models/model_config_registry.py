@@ -0,0 +1,121 @@
+import json
+import os
+from threading import Lock, Thread
+from time import monotonic
+
+from ocr_app.settings import MODEL_CONFIGS_ROOT, MODEL_CONFIG_REFRESH_INTERVAL
+
+
+FAILED_REFRESH_RETRY_INTERVAL = 30 # seconds, retry sooner than refresh_interval when the model server was down
+
+
+class ModelConfigRegistry:
+    """
+    Configs of the models served by one model server, by modelId.
+    - Nothing is fetched at import. The first use loads the on-disk snapshot if there is one (so startup
+      does not wait for, or depend on, the model server), otherwise fetches the configs.
+    - Every successful fetch replaces the snapshot.
+    - Once refresh_interval seconds have passed, the next use starts a refresh in a background thread
+      and keeps serving the current configs meanwhile.
+    fetch_configs returns the list of configs, or None if the model server could not be reached.
+    """
+
+    def __init__(self, name, fetch_configs, refresh_interval=MODEL_CONFIG_REFRESH_INTERVAL, snapshot_dir=MODEL_CONFIGS_ROOT):
+        self.name = name
+        self.fetch_configs = fetch_configs
+        self.refresh_interval = refresh_interval
+        self.snapshot_path = os.path.join(snapshot_dir, f"{name}.json")
+
+        self.lock = Lock()
+        self.is_loaded = False
+        self.is_refreshing = False
+        self.next_refresh_time = 0.0
+        self.configs = ([], {}) # (list of configs, configs by modelId), swapped as a whole on refresh
+
+    def get_all(self):
+        self.ensure_fresh()
+        return self.configs[0]
+
+    def get(self, model_id, default=None):
+        self.ensure_fresh()
+        return self.configs[1].get(model_id, default)
+
+    def __contains__(self, model_id):
+        self.ensure_fresh()
+        return model_id in self.configs[1]
+
+    def ensure_fresh(self):
+        if not self.is_loaded:
+            with self.lock:
+                if not self.is_loaded:
+                    self.load()
+            return
+
+        if monotonic() < self.next_refresh_time:
+            return
+
+        with self.lock:
+            if self.is_refreshing or monotonic() < self.next_refresh_time:
+                return
+            self.is_refreshing = True
+
+        Thread(target=self.refresh_in_background, name=f"{self.name}-config-refresh", daemon=True).start()
+
+    def load(self):
+        "First load, called with the lock held."
+        snapshot_configs = self.read_snapshot()
+        if snapshot_configs is not None:
+            self.set_configs(snapshot_configs)
+            self.next_refresh_time = 0.0 # refresh in the background on the next use
+        else:
+            self.refresh()
+
+        self.is_loaded = True
+
+    def refresh(self):
+        "Fetch the configs now. Returns False (and keeps the current configs) if the model server could not be reached."
+        try:
+            configs = self.fetch_configs()
+        except Exception as e: # e.g. an unexpected response
+            print("Error at ocr.language_ocr_models.model_config_registry.ModelConfigRegistry")
+            print(4 * " " + str(e))
+            configs = None
+
+        if configs is None:
+            self.next_refresh_time = monotonic() + min(self.refresh_interval, FAILED_REFRESH_RETRY_INTERVAL)
+            print("Error at ocr.language_ocr_models.model_config_registry.ModelConfigRegistry")
+            print(4 * " " + f"Failed to fetch the {self.name} config, keeping {len(self.configs[0])} known models")
+            return False
+
+        self.set_configs(configs)
+        self.write_snapshot(configs)
+        self.next_refresh_time = monotonic() + self.refresh_interval
+        return True
+
+    def refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self.lock:
+                self.is_refreshing = False
+
+    def set_configs(self, configs):
+        self.configs = (configs, {config['modelId']: config for config in configs})
+
+    def read_snapshot(self):
+        try:
+            with open(self.snapshot_path, "r") as snapshot_file:
+                return json.load(snapshot_file)
+        except (OSError, ValueError):
+            return None
+
+    def write_snapshot(self, configs):
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+            temp_snapshot_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+            with open(temp_snapshot_path, "w") as snapshot_file:
+                json.dump(configs, snapshot_file)
+            os.replace(temp_snapshot_path, self.snapshot_path) # other processes only ever read a complete snapshot
+        except OSError as e:
+            print("Error at ocr.language_ocr_models.model_config_registry.ModelConfigRegistry")
+            print(4 * " " + f"Failed to write the {self.name} config snapshot: {e}")
@@ -0,0 +1,114 @@
+from threading import Lock
+from time import perf_counter
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ocr_app.settings import (
+    MODEL_SERVER_POOL_CONNECTIONS,
+    MODEL_SERVER_POOL_MAXSIZE,
+    MODEL_SERVER_CONNECT_TIMEOUT,
+    MODEL_SERVER_READ_TIMEOUT,
+    MODEL_SERVER_MAX_RETRIES,
+    MODEL_SERVER_RETRY_BACKOFF_FACTOR,
+)
+
+
+class ModelServerSession:
+    """
+    Keep-alive HTTP session shared by the document parser and text recognizer clients.
+    Connections are pooled per model server host (pool_maxsize connections per host, for pool_connections hosts).
+    Every request gets (connect_timeout, read_timeout) unless the caller passes its own timeout.
+    Model server requests are pure inference, so POSTs are retried too when max_retries > 0.
+    """
+
+    def __init__(
+        self,
+        pool_connections=MODEL_SERVER_POOL_CONNECTIONS,
+        pool_maxsize=MODEL_SERVER_POOL_MAXSIZE,
+        connect_timeout=MODEL_SERVER_CONNECT_TIMEOUT,
+        read_timeout=MODEL_SERVER_READ_TIMEOUT,
+        max_retries=MODEL_SERVER_MAX_RETRIES,
+        retry_backoff_factor=MODEL_SERVER_RETRY_BACKOFF_FACTOR,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry,
+            pool_block=True, # wait for a free connection instead of opening (and then discarding) extra ones
+        )
+
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+        self.stats_lock = Lock()
+        self.num_requests = 0
+        self.num_failed_requests = 0
+        self.total_request_time = 0.0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        start_time = perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.record_request(perf_counter() - start_time, failed=True)
+            raise
+
+        self.record_request(perf_counter() - start_time, failed=response.status_code != 200)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def record_request(self, request_time, failed):
+        with self.stats_lock:
+            self.num_requests += 1
+            self.total_request_time += request_time
+            if failed:
+                self.num_failed_requests += 1
+
+    def get_pool_stats(self):
+        hosts = []
+        pools = self.adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+
+            hosts.append({
+                'host': f"{pool.scheme}://{pool.host}:{pool.port}",
+                'maxConnections': pool.pool.maxsize if pool.pool is not None else 0,
+                'idleConnections': len([conn for conn in list(pool.pool.queue) if conn is not None]) if pool.pool is not None else 0,
+                'connectionsOpened': pool.num_connections,
+                'requests': pool.num_requests,
+            })
+
+        with self.stats_lock:
+            return {
+                'poolConnections': self.adapter._pool_connections,
+                'poolMaxsize': self.adapter._pool_maxsize,
+                'timeout': list(self.timeout),
+                'numRequests': self.num_requests,
+                'numFailedRequests': self.num_failed_requests,
+                'averageRequestTime': (self.total_request_time / self.num_requests) if self.num_requests > 0 else 0.0,
+                'hosts': hosts,
+            }
+
+
+model_server_session = ModelServerSession()
@@ -0,0 +1,61 @@
+from io import BytesIO
+
+from numpy import asarray
+from PIL import Image, ImageOps
+
+from .transport import encode_pil_image
+
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+class PageImage:
+    """
+    A page image decoded once, shared by the document parser client and the cropper.
+    - pixels: read-only RGB NumPy array (height, width, 3). Crops of unrotated bboxes are views into it.
+    - encode: the original file bytes when the requested format is the file's own format (no re-encoding),
+      otherwise the pixels encoded in the requested format.
+    Pages with an EXIF orientation are rotated upright, and then have no original file bytes (encoded_image is None).
+    """
+
+    def __init__(self, encoded_image, image_format=None):
+        self.encoded_image = encoded_image
+
+        pil_image = Image.open(BytesIO(encoded_image))
+        self.format = image_format or pil_image.format
+        if pil_image.getexif().get(EXIF_ORIENTATION_TAG, 1) != 1:
+            # the original bytes would reach the document parser sideways
+            pil_image = ImageOps.exif_transpose(pil_image)
+            self.encoded_image = None
+        if pil_image.mode != "RGB":
+            pil_image = pil_image.convert("RGB")
+
+        # PIL exports the pixels through tobytes(), i.e. one copy, and the PIL image itself is released here
+        self.pixels = asarray(pil_image)
+        pil_image.close()
+
+    @classmethod
+    def open(cls, image_path):
+        with open(image_path, "rb") as image_file:
+            return cls(image_file.read())
+
+    @property
+    def width(self):
+        return self.pixels.shape[1]
+
+    @property
+    def height(self):
+        return self.pixels.shape[0]
+
+    @property
+    def num_channels(self):
+        return self.pixels.shape[2]
+
+    def encode(self, image_format="PNG", quality=90):
+        if image_format == self.format and self.encoded_image is not None:
+            return self.encoded_image
+
+        if image_format == "RAW":
+            return self.pixels.tobytes()
+
+        return encode_pil_image(Image.fromarray(self.pixels), image_format, quality)
@@ -0,0 +1,81 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from .page_image import PageImage
+from ocr_app.settings import PAGE_IMAGE_CACHE_MAX_SIZE_MB
+
+
+class PageImageCache:
+    """
+    Decoded pages kept in the worker, least recently used first out once their pixels and encoded bytes
+    take more than max_size_mb, so re-running OCR on boxes of the same page does not decode it again.
+    An entry is reused only while the file keeps its size and modification time.
+    """
+
+    def __init__(self, max_size_mb=PAGE_IMAGE_CACHE_MAX_SIZE_MB):
+        self.max_size = int(max_size_mb * 1024 * 1024)
+
+        self.lock = Lock()
+        self.entries = OrderedDict() # image path -> (file stat key, PageImage, size)
+        self.size = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def open(self, image_path):
+        "PageImage.open, served from the cache when possible."
+        file_stat = os.stat(image_path)
+        stat_key = (file_stat.st_size, file_stat.st_mtime_ns)
+
+        with self.lock:
+            entry = self.entries.get(image_path)
+            if entry is not None and entry[0] == stat_key:
+                self.entries.move_to_end(image_path)
+                self.num_hits += 1
+                return entry[1]
+            self.num_misses += 1
+
+        page_image = PageImage.open(image_path)
+        page_image_size = page_image.pixels.nbytes + len(page_image.encoded_image or b"")
+        if page_image_size > self.max_size:
+            return page_image
+
+        with self.lock:
+            old_entry = self.entries.pop(image_path, None)
+            if old_entry is not None:
+                self.size -= old_entry[2]
+
+            self.entries[image_path] = (stat_key, page_image, page_image_size)
+            self.size += page_image_size
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+        return page_image
+
+    def set_max_size_mb(self, max_size_mb):
+        with self.lock:
+            self.max_size = int(max_size_mb * 1024 * 1024)
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                'entries': len(self.entries),
+                'sizeMB': round(self.size / (1024 * 1024), 2),
+                'maxSizeMB': round(self.max_size / (1024 * 1024), 2),
+                'hits': self.num_hits,
+                'misses': self.num_misses,
+                'hitRate': (self.num_hits / num_lookups) if num_lookups > 0 else 0.0,
+            }
+
+
+page_image_cache = PageImageCache()
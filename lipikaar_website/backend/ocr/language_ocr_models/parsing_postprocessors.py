@@ -1,27 +1,164 @@
 def get_components(adj_list):
+    "Connected components, each in DFS preorder. Iterative, so long chains do not hit the recursion limit."
     visited = [False for i in range(0, len(adj_list))]
 
-    current_comp = []
-
-    def dfs(current_node):
-        if visited[current_node]:
-            return
-        
-        current_comp.append(current_node)
-        visited[current_node] = True
-        for an in adj_list[current_node]:
-            dfs(an)
-
     comps = []
 
     for i in range(0, len(adj_list)):
-        if not visited[i]:
-            current_comp = []
-            dfs(i)
-            comps.append(current_comp)
+        if visited[i]:
+            continue
+
+        current_comp = []
+        stack = [i]
+        while len(stack) > 0:
+            current_node = stack.pop()
+            if visited[current_node]:
+                continue
+
+            current_comp.append(current_node)
+            visited[current_node] = True
+            stack.extend(reversed(adj_list[current_node]))
+
+        comps.append(current_comp)
     
     return comps
 
+
+class DisjointSet:
+    "Union-find over 0..n-1, the root of a set is its smallest element."
+
+    def __init__(self, n):
+        self.parents = list(range(n))
+
+    def find(self, i):
+        root = i
+        while self.parents[root] != root:
+            root = self.parents[root]
+
+        while self.parents[i] != root: # path compression
+            self.parents[i], i = root, self.parents[i]
+
+        return root
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i < root_j:
+            self.parents[root_j] = root_i
+        elif root_j < root_i:
+            self.parents[root_i] = root_j
+
+    def get_components(self):
+        "Components ordered by their smallest element, like get_components."
+        components = {}
+        for i in range(len(self.parents)):
+            components.setdefault(self.find(i), []).append(i)
+        return list(components.values())
+
+
+def check_if_bboxes_are_on_same_line(bbox_1, bbox_2):
+    if bbox_1['y_min'] > bbox_2['y_max'] or bbox_2['y_min'] > bbox_1['y_max']:
+        # no common vertical location
+        return False
+
+    # Checking percentage overlap
+    bbox_1_height = bbox_1['y_max'] - bbox_1['y_min']
+    bbox_2_height = bbox_2['y_max'] - bbox_2['y_min']
+    threshold_overlap = 0.2 * ((bbox_1_height + bbox_2_height) / 2)
+    current_overlap = min(bbox_1['y_max'], bbox_2['y_max']) - max(bbox_1['y_min'], bbox_2['y_min'])
+
+    # Checking containment: not doing this for now
+
+    return current_overlap >= threshold_overlap
+
+
+def get_line_components_with_pairwise_checks(bboxes):
+    "Reference implementation of get_line_components, checks every pair of bboxes: O(n**2)."
+    adj_list = [[] for i in range(0, len(bboxes))]
+
+    # for every 2 bboxes, if they have a common point, connect them
+    for i in range(0, len(bboxes)):
+        for j in range(i + 1, len(bboxes)):
+            if check_if_bboxes_are_on_same_line(bboxes[i], bboxes[j]):
+                adj_list[i].append(j)
+
+    return get_components(adj_list)
+
+
+def get_line_components(bboxes):
+    """
+    The same lines as get_line_components_with_pairwise_checks, each with its bboxes in input order.
+    Its edges only go to later bboxes, so a bbox is in the line of the earliest bbox it can be reached from:
+    the earliest line among the earlier bboxes it is on the same line with, or a new line if there are none.
+    A bbox on the same line as two earlier lines does not merge them.
+    1) The bboxes are swept by y_min into groups connected in both directions (union-find): a bbox can only be
+       on the same line as the earlier bboxes that have not ended above it, and these are only checked if they
+       are not already in its group. Every line lies within one group.
+    2) The bboxes of each group are assigned to lines in input order, trying the lines from the earliest one
+       and their bboxes from the latest one (usually the previous word).
+    """
+    disjoint_set = DisjointSet(len(bboxes))
+    sorted_bbox_indices = sorted(range(len(bboxes)), key=lambda i: bboxes[i]['y_min'])
+
+    active_bbox_indices = []
+    for j in sorted_bbox_indices:
+        bbox = bboxes[j]
+
+        still_active_bbox_indices = []
+        for i in active_bbox_indices:
+            if bboxes[i]['y_max'] < bbox['y_min']: # ended above this bbox, and above all the following ones
+                continue
+            still_active_bbox_indices.append(i)
+
+            if disjoint_set.find(i) != disjoint_set.find(j) and check_if_bboxes_are_on_same_line(bboxes[i], bbox):
+                disjoint_set.union(i, j)
+
+        still_active_bbox_indices.append(j)
+        active_bbox_indices = still_active_bbox_indices
+
+    lines = {} # first bbox index of every line: its bbox indices
+    for group in disjoint_set.get_components():
+        group_first_bbox_indices = []
+        for j in group:
+            for first_bbox_index in group_first_bbox_indices:
+                line = lines[first_bbox_index]
+                if any(check_if_bboxes_are_on_same_line(bboxes[i], bboxes[j]) for i in reversed(line)):
+                    line.append(j)
+                    break
+            else:
+                group_first_bbox_indices.append(j)
+                lines[j] = [j]
+
+    return [lines[first_bbox_index] for first_bbox_index in sorted(lines)]
+
+
+def merge_components(bboxes, components):
+    new_bboxes = []
+    
+    for component in components:
+        merged_component_bbox = {
+            'x_min': 1000000,
+            'y_min': 1000000,
+            'x_max': 0,
+            'y_max': 0,
+        }
+
+        for bbox_index in component:
+            if bboxes[bbox_index]['x_min'] < merged_component_bbox['x_min']:
+                merged_component_bbox['x_min'] = bboxes[bbox_index]['x_min']
+            
+            if bboxes[bbox_index]['y_min'] < merged_component_bbox['y_min']:
+                merged_component_bbox['y_min'] = bboxes[bbox_index]['y_min']
+
+            if bboxes[bbox_index]['x_max'] > merged_component_bbox['x_max']:
+                merged_component_bbox['x_max'] = bboxes[bbox_index]['x_max']
+            
+            if bboxes[bbox_index]['y_max'] > merged_component_bbox['y_max']:
+                merged_component_bbox['y_max'] = bboxes[bbox_index]['y_max']
+
+        new_bboxes.append(merged_component_bbox)
+
+    return new_bboxes
+
 # def process_bboxes(bboxes):
     
 
@@ -36,60 +173,9 @@ class DefaultParsingPostprocessor:
         1) Merge overlapping bboxes
         2) Merge 2 bboxes that have a common y value
         """
+        components = get_line_components(bboxes)
 
-        # Merging is done in O(n**2), can be optimized later.
-
-        adj_list = [[] for i in range(0, len(bboxes))]
-
-        # for every 2 bboxes, if they have a common point, connect them
-        for i in range(0, len(bboxes)):
-            for j in range(i + 1, len(bboxes)):
-                # Checking common point
-                if bboxes[i]['y_min'] > bboxes[j]['y_max'] or bboxes[j]['y_min'] > bboxes[i]['y_max']:
-                    # no common vertical location
-                    continue
-
-                # Checking percentage overlap
-                bbox_1_height = bboxes[i]['y_max'] - bboxes[i]['y_min']
-                bbox_2_height = bboxes[j]['y_max'] - bboxes[j]['y_min']
-                threshold_overlap = 0.2 * ((bbox_1_height + bbox_2_height) / 2)
-                current_overlap = min(bboxes[i]['y_max'], bboxes[j]['y_max']) - max(bboxes[i]['y_min'], bboxes[j]['y_min'])
-
-                if current_overlap < threshold_overlap:
-                    continue
-                
-                # Checking containment: not doing this for now
-
-                adj_list[i].append(j)
-
-        components = get_components(adj_list)
-
-        new_bboxes = []
-        
-        for component in components:
-            merged_component_bbox = {
-                'x_min': 1000000,
-                'y_min': 1000000,
-                'x_max': 0,
-                'y_max': 0,
-            }
-
-            for bbox_index in component:
-                if bboxes[bbox_index]['x_min'] < merged_component_bbox['x_min']:
-                    merged_component_bbox['x_min'] = bboxes[bbox_index]['x_min']
-                
-                if bboxes[bbox_index]['y_min'] < merged_component_bbox['y_min']:
-                    merged_component_bbox['y_min'] = bboxes[bbox_index]['y_min']
-
-                if bboxes[bbox_index]['x_max'] > merged_component_bbox['x_max']:
-                    merged_component_bbox['x_max'] = bboxes[bbox_index]['x_max']
-                
-                if bboxes[bbox_index]['y_max'] > merged_component_bbox['y_max']:
-                    merged_component_bbox['y_max'] = bboxes[bbox_index]['y_max']
-
-            new_bboxes.append(merged_component_bbox)
-
-        return new_bboxes
+        return merge_components(bboxes, components)
 
 
 parsing_postprocessors = {
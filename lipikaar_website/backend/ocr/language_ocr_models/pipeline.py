@@ -0,0 +1,94 @@
+from queue import Queue, Empty, Full
+from threading import Event, Thread
+
+from django.db import connections
+
+
+_END_OF_PAGES = object()
+
+
+class PagePipeline:
+    """
+    Runs every page through a list of stages, each stage in its own thread, so that page N+1 can be in
+    an earlier stage while page N is in a later one.
+    At most max_pages_in_flight pages wait between two stages, which bounds the memory used by decoded pages.
+    run() yields (result, error) for every page, in input order. A page whose stage raises an exception
+    skips the remaining stages and is yielded with the exception as the error.
+    Stages (and pages) may use the ORM: every thread closes its own database connections when it ends.
+    """
+
+    def __init__(self, stages, max_pages_in_flight=2):
+        self.stages = stages
+        self.max_pages_in_flight = max(1, max_pages_in_flight)
+
+    def run(self, pages):
+        stop_event = Event()
+        queues = [Queue(maxsize=self.max_pages_in_flight) for _ in range(len(self.stages) + 1)]
+
+        def put(queue, item):
+            while not stop_event.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def get(queue):
+            while not stop_event.is_set():
+                try:
+                    return queue.get(timeout=0.1)
+                except Empty:
+                    continue
+            return _END_OF_PAGES
+
+        def feed_pages():
+            # pages may be a lazy iterable (e.g. one that stops when an upload is cancelled)
+            try:
+                for page in pages:
+                    if not put(queues[0], (page, None)):
+                        return
+            except Exception as e:
+                put(queues[0], (None, e))
+            put(queues[0], _END_OF_PAGES)
+
+        def run_stage(stage, input_queue, output_queue):
+            while True:
+                item = get(input_queue)
+                if item is _END_OF_PAGES:
+                    put(output_queue, _END_OF_PAGES)
+                    return
+
+                value, error = item
+                if error is None:
+                    try:
+                        value = stage(value)
+                    except Exception as e:
+                        value, error = None, e
+
+                if not put(output_queue, (value, error)):
+                    return
+
+        def run_in_thread(target, *args):
+            # Django opens one connection per thread and only closes the ones of request and task threads
+            try:
+                target(*args)
+            finally:
+                connections.close_all()
+
+        threads = [Thread(target=run_in_thread, args=(feed_pages,), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(Thread(target=run_in_thread, args=(run_stage, stage, queues[i], queues[i + 1]), daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = get(queues[-1])
+                if item is _END_OF_PAGES:
+                    return
+                yield item
+        finally:
+            # also reached when the consumer stops iterating early
+            stop_event.set()
@@ -2,9 +2,31 @@ import os
 import shutil
 import json
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
-from .utils import pil_image_to_base64_str, flatten_dict, log_FastAPI_response_error
-from ocr_app.settings import TEXT_RECOGNIZERS_API_PROVIDER_URL
+from .batch_size_controller import AdaptiveBatchSizeController
+from .crop_text_cache import crop_text_cache, get_crop_hash
+from .micro_batcher import RecognizerMicroBatcher
+from .model_config_registry import ModelConfigRegistry
+from .model_server_session import model_server_session
+from .transport import get_image_encoding, encode_pil_image_to_base64_str, build_multipart_request
+from .utils import flatten_dict, log_FastAPI_response_error
+from ocr_app.settings import (
+    TEXT_RECOGNIZERS_API_PROVIDER_URL,
+    TEXT_RECOGNIZER_BATCH_SIZE,
+    TEXT_RECOGNIZER_MAX_CONCURRENT_BATCHES,
+    TEXT_RECOGNIZER_ADAPTIVE_BATCH_SIZE,
+    TEXT_RECOGNIZER_MICRO_BATCHING,
+    TEXT_RECOGNIZER_MICRO_BATCH_MAX_SIZE,
+    TEXT_RECOGNIZER_MICRO_BATCH_MAX_WAIT_MS,
+    CROP_TEXT_CACHE_ENABLED,
+    MODEL_SERVER_CONNECT_TIMEOUT,
+    MODEL_CONFIG_FETCH_TIMEOUT,
+)
+
+
+MICRO_BATCH_PARTS = 4 # with micro batching, a page sends its crops in quarters of a merged request, so that pages fill each other's requests
 
 
 def get_text_recognizers_config(api_provider_url):
@@ -12,9 +34,15 @@ def get_text_recognizers_config(api_provider_url):
         return []
     
     get_text_recognizers_config_url = api_provider_url + "/config/"
-    response = requests.get(get_text_recognizers_config_url)
+    try:
+        response = model_server_session.get(get_text_recognizers_config_url, timeout=(MODEL_SERVER_CONNECT_TIMEOUT, MODEL_CONFIG_FETCH_TIMEOUT))
+    except requests.RequestException as e:
+        print("Error at ocr.language_ocr_models.text_recognizers.get_text_recognizers_config")
+        print(4 * " " + str(e))
+        return None
+
     if response.status_code != 200:
-        return []
+        return None
 
     response_data = response.json()
     tr_config = response_data['result']['processConfigs']
@@ -25,11 +53,158 @@ def get_text_recognizers_config(api_provider_url):
     return tr_list
 
 class LipikarULCA_TextRecognizerClient:
-    def __init__(self):
+    def __init__(
+        self,
+        batch_size=TEXT_RECOGNIZER_BATCH_SIZE,
+        max_concurrent_batches=TEXT_RECOGNIZER_MAX_CONCURRENT_BATCHES,
+        crop_text_cache=crop_text_cache if CROP_TEXT_CACHE_ENABLED else None,
+        micro_batching=TEXT_RECOGNIZER_MICRO_BATCHING,
+        adaptive_batch_size=TEXT_RECOGNIZER_ADAPTIVE_BATCH_SIZE,
+    ):
         self.endpoint = TEXT_RECOGNIZERS_API_PROVIDER_URL + "/get-texts-for-images/"
-    
-    def get_texts_for_images(self, images, model_id):
-        request_images = [{'imageContent': pil_image_to_base64_str(image),} for image in images]
+        self.endpoints = { # one endpoint per image transport
+            'json': self.endpoint,
+            'multipart': TEXT_RECOGNIZERS_API_PROVIDER_URL + "/get-texts-for-images/multipart/",
+            'packed': TEXT_RECOGNIZERS_API_PROVIDER_URL + "/get-texts-for-images/packed/",
+        }
+        self.batch_size = batch_size # 0 sends all the images in a single request, unless adaptive (see AdaptiveBatchSizeController)
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self.batch_executor = ThreadPoolExecutor(max_workers=self.max_concurrent_batches, thread_name_prefix="text-recognizer")
+        self.crop_text_cache = crop_text_cache # None disables the crop cache
+        self.batch_size_controller = AdaptiveBatchSizeController(initial_batch_size=batch_size) if adaptive_batch_size else None
+        self.micro_batcher = None
+        if micro_batching:
+            self.micro_batcher = RecognizerMicroBatcher(
+                self.get_texts_for_batch,
+                self.batch_executor,
+                get_max_batch_size=self.get_micro_batch_max_size,
+                max_wait=TEXT_RECOGNIZER_MICRO_BATCH_MAX_WAIT_MS / 1000,
+            )
+
+    def get_batch_size(self, model_id, num_images):
+        if self.batch_size_controller is not None:
+            return self.batch_size_controller.get_batch_size(model_id)
+        return self.batch_size if self.batch_size > 0 else num_images
+
+    def get_micro_batch_max_size(self, model_id):
+        if self.batch_size_controller is not None:
+            return self.batch_size_controller.get_batch_size(model_id)
+        return TEXT_RECOGNIZER_MICRO_BATCH_MAX_SIZE
+
+    def get_texts_for_images(self, images, model_id, model_version=None):
+        """
+        Split the images into batches (of batch_size, or the adaptive batch size of model_id), recognize up to max_concurrent_batches of them at once
+        and return the texts in the order of the images. A batch that fails gets empty strings for its images.
+        """
+        recognized_texts, _ = self.recognize_images(images, model_id, model_version)
+        return recognized_texts
+
+    def recognize_images(self, images, model_id, model_version=None):
+        """
+        get_texts_for_images, also returning the number of batches that failed.
+        Crops found in the crop text cache are not sent, identical crops are sent once, and only the
+        texts of successful batches are added to the cache. Models without a version are not cached.
+        """
+        if len(images) == 0:
+            return [], 0
+
+        if self.crop_text_cache is None or not model_version:
+            recognized_texts, _, num_failed_batches = self.recognize_images_in_batches(images, model_id)
+            return recognized_texts, num_failed_batches
+
+        crop_hashes = [get_crop_hash(image) for image in images]
+        crop_texts = self.crop_text_cache.get_many(model_id, model_version, list(dict.fromkeys(crop_hashes)))
+
+        uncached_images = {}
+        for crop_hash, image in zip(crop_hashes, images):
+            if crop_hash not in crop_texts and crop_hash not in uncached_images:
+                uncached_images[crop_hash] = image
+
+        num_failed_batches = 0
+        if len(uncached_images) > 0:
+            recognized_texts, texts_succeeded, num_failed_batches = self.recognize_images_in_batches(list(uncached_images.values()), model_id)
+
+            new_crop_texts = {}
+            for crop_hash, recognized_text, text_succeeded in zip(uncached_images.keys(), recognized_texts, texts_succeeded):
+                crop_texts[crop_hash] = recognized_text
+                if text_succeeded:
+                    new_crop_texts[crop_hash] = recognized_text
+            self.crop_text_cache.set_many(model_id, model_version, new_crop_texts)
+
+        return [crop_texts[crop_hash] for crop_hash in crop_hashes], num_failed_batches
+
+    def recognize_images_in_batches(self, images, model_id):
+        """
+        Returns the texts, whether each text was recognized successfully, and the number of failed batches.
+        With micro batching, the batches may be sent together with the crops of other pages and uploads.
+        """
+        if self.micro_batcher is not None:
+            batch_size = max(1, self.get_micro_batch_max_size(model_id) // MICRO_BATCH_PARTS)
+        else:
+            batch_size = self.get_batch_size(model_id, len(images))
+        batch_starts = range(0, len(images), batch_size)
+
+        if self.micro_batcher is not None:
+            batch_futures = [self.micro_batcher.submit(model_id, images[start : start + batch_size]) for start in batch_starts]
+            batches_results = [batch_future.result() for batch_future in batch_futures]
+        elif len(batch_starts) == 1 or self.max_concurrent_batches == 1:
+            batches_results = [self.get_texts_for_batch(images[start : start + batch_size], model_id) for start in batch_starts]
+        else:
+            batch_futures = [
+                self.batch_executor.submit(self.get_texts_for_batch, images[start : start + batch_size], model_id)
+                for start in batch_starts
+            ]
+            batches_results = [batch_future.result() for batch_future in batch_futures]
+
+        recognized_texts = []
+        texts_succeeded = []
+        num_failed_batches = 0
+        for batch_texts, batch_succeeded in batches_results:
+            recognized_texts += batch_texts
+            texts_succeeded += [batch_succeeded] * len(batch_texts)
+            if not batch_succeeded:
+                num_failed_batches += 1
+        return recognized_texts, texts_succeeded, num_failed_batches
+
+    def get_texts_for_batch(self, images, model_id):
+        "Returns (texts, succeeded), and reports the request latency to the batch size controller."
+        start_time = perf_counter()
+        recognized_texts = self.get_checked_texts_for_batch(images, model_id)
+        if self.batch_size_controller is not None:
+            self.batch_size_controller.record(model_id, len(images), perf_counter() - start_time, recognized_texts is not None)
+
+        if recognized_texts is None:
+            return [""] * len(images), False
+        return recognized_texts, True
+
+    def get_checked_texts_for_batch(self, images, model_id):
+        "Returns the texts, or None if the request failed or did not return one text per image."
+        try:
+            recognized_texts = self.request_texts_for_batch(images, model_id)
+        except Exception as e:
+            print("Error at ocr.language_ocr_models.text_recognizers.LipikarULCA_TextRecognizerClient")
+            print(4 * " " + f"Failed to recognize batch: {e}")
+            print(4 * " " + f"Num images: {len(images)}")
+            print(4 * " " + f"model_id: {model_id}")
+
+            return None
+
+        if recognized_texts is None: # the request failed, already logged
+            return None
+
+        if len(recognized_texts) != len(images): # keep the texts aligned with the bboxes of the other batches
+            print("Error at ocr.language_ocr_models.text_recognizers.LipikarULCA_TextRecognizerClient")
+            print(4 * " " + f"Received {len(recognized_texts)} texts for {len(images)} images")
+            print(4 * " " + f"model_id: {model_id}")
+
+            return None
+
+        return recognized_texts
+
+    def request_texts_for_batch(self, images, model_id):
+        image_encoding = get_image_encoding(model_id)
+        endpoint = self.endpoints[image_encoding['transport']]
+
         request_config = {
             'modelId': model_id,
             'detectionLevel': "string",
@@ -42,26 +217,43 @@ class LipikarULCA_TextRecognizerClient:
             }],
         }
 
-        request_body = {
-            'image': request_images,
-            'config': request_config,
-        }
-
         # TODO: Add API Key in headers
-        response = requests.post(self.endpoint, json=request_body)
+        try:
+            if image_encoding['transport'] == "json":
+                request_images = [
+                    {'imageContent': encode_pil_image_to_base64_str(image, image_encoding['format'], image_encoding['quality']),}
+                    for image in images
+                ]
+                request_body = {
+                    'image': request_images,
+                    'config': request_config,
+                }
+                response = model_server_session.post(endpoint, json=request_body)
+            else:
+                request_data, request_files = build_multipart_request(request_config, images, image_encoding)
+                response = model_server_session.post(endpoint, data=request_data, files=request_files)
+        except requests.RequestException as e:
+            print("Error at ocr.language_ocr_models.text_recognizers.LipikarULCA_TextRecognizerClient")
+            print(4 * " " + f"Request failed: {e}")
+            print(4 * " " + f"Endpoint: {endpoint}")
+            print(4 * " " + f"Num images: {len(images)}")
+            print(4 * " " + f"model_id: {model_id}")
+
+            return None
+
         if response.status_code != 200:
             print("Error at ocr.language_ocr_models.text_recognizers.LipikarULCA_TextRecognizerClient")
             print(4 * " " + f"Received status code {response.status_code} for ocr request")
-            print(4 * " " + f"Endpoint: {self.endpoint}")
+            print(4 * " " + f"Endpoint: {endpoint}")
             print(4 * " " + f"Num images: {len(images)}")
             print(4 * " " + f"model_id: {model_id}")
 
             log_FastAPI_response_error(response)
 
-            return [""] * len(images)
+            return None
 
         response_data = response.json()
         recognized_texts = [img_text['source'] for img_text in response_data['output']]
         return recognized_texts
 
-text_recognizers_config = get_text_recognizers_config(TEXT_RECOGNIZERS_API_PROVIDER_URL)
+text_recognizers_config_registry = ModelConfigRegistry("text_recognizers", lambda: get_text_recognizers_config(TEXT_RECOGNIZERS_API_PROVIDER_URL))
@@ -0,0 +1,164 @@
+import json
+import struct
+from base64 import b64encode
+from io import BytesIO
+
+from PIL import Image
+
+from ocr_app.settings import (
+    MODEL_SERVER_IMAGE_TRANSPORT,
+    MODEL_SERVER_IMAGE_FORMAT,
+    MODEL_SERVER_IMAGE_QUALITY,
+    TEXT_RECOGNIZER_IMAGE_ENCODINGS,
+)
+
+
+#region Image Encoding
+IMAGE_TRANSPORTS = ("json", "multipart", "packed")
+IMAGE_FORMATS = ("PNG", "JPEG", "WEBP", "RAW")
+
+image_format_content_types = {
+    'PNG': "image/png",
+    'JPEG': "image/jpeg",
+    'WEBP': "image/webp",
+    'RAW': "application/octet-stream",
+}
+
+
+def get_image_encoding(model_id=None):
+    """
+    Transport, format and quality used to send images to a model server.
+    TEXT_RECOGNIZER_IMAGE_ENCODINGS can override any of them per text recognizer modelId.
+    """
+    image_encoding = {
+        'transport': MODEL_SERVER_IMAGE_TRANSPORT,
+        'format': MODEL_SERVER_IMAGE_FORMAT,
+        'quality': MODEL_SERVER_IMAGE_QUALITY,
+    }
+    if model_id is not None:
+        image_encoding.update(TEXT_RECOGNIZER_IMAGE_ENCODINGS.get(model_id, {}))
+
+    image_encoding['format'] = image_encoding['format'].upper()
+    if image_encoding['transport'] not in IMAGE_TRANSPORTS:
+        raise ValueError(f"Unknown image transport: {image_encoding['transport']}")
+    if image_encoding['format'] not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {image_encoding['format']}")
+    if image_encoding['transport'] == "json" and image_encoding['format'] == "RAW":
+        raise ValueError("RAW images can only be sent with the multipart or packed transports.")
+
+    return image_encoding
+
+
+def encode_pil_image(pil_image, image_format="PNG", quality=90):
+    if image_format == "RAW": # uncompressed pixels, the size and number of channels are sent alongside
+        return pil_image.tobytes()
+
+    if image_format == "JPEG" and pil_image.mode not in ("RGB", "L"):
+        pil_image = pil_image.convert("RGB")
+
+    buffer = BytesIO()
+    if image_format == "PNG":
+        pil_image.save(buffer, format="PNG")
+    else:
+        pil_image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def encode_pil_image_to_base64_str(pil_image, image_format="PNG", quality=90):
+    return b64encode(encode_pil_image(pil_image, image_format, quality)).decode("utf-8")
+
+
+def encode_image(image, image_format="PNG", quality=90):
+    "image is a PIL image or a PageImage, which can skip re-encoding its original file."
+    if isinstance(image, Image.Image):
+        return encode_pil_image(image, image_format, quality)
+    return image.encode(image_format, quality)
+
+
+def encode_image_to_base64_str(image, image_format="PNG", quality=90):
+    return b64encode(encode_image(image, image_format, quality)).decode("utf-8")
+
+
+def get_image_size(image):
+    "(width, height, channels) of a PIL image or a PageImage."
+    if isinstance(image, Image.Image):
+        return image.width, image.height, len(image.getbands())
+    return image.width, image.height, image.num_channels
+#endregion
+
+
+#region Packed Images Container
+"""
+Many images in one binary body, all little-endian:
+    header: magic (4s) "LPKI", version (H), format (H, index into IMAGE_FORMATS), number of images (I)
+    offset table, one entry per image: offset (I), length (I), width (H), height (H), channels (B), 3 padding bytes
+    data: the encoded images one after the other, offsets are relative to the start of the data
+"""
+PACKED_IMAGES_MAGIC = b"LPKI"
+PACKED_IMAGES_VERSION = 1
+packed_images_header_struct = struct.Struct("<4sHHI")
+packed_images_table_entry_struct = struct.Struct("<IIHHB3x")
+
+
+def pack_pil_images(pil_images, image_format="PNG", quality=90):
+    table = bytearray()
+    data = BytesIO()
+
+    for pil_image in pil_images:
+        encoded_image = encode_image(pil_image, image_format, quality)
+        table += packed_images_table_entry_struct.pack(
+            data.tell(),
+            len(encoded_image),
+            *get_image_size(pil_image),
+        )
+        data.write(encoded_image)
+
+    header = packed_images_header_struct.pack(
+        PACKED_IMAGES_MAGIC,
+        PACKED_IMAGES_VERSION,
+        IMAGE_FORMATS.index(image_format),
+        len(pil_images),
+    )
+    return header + bytes(table) + data.getvalue()
+
+
+def unpack_images(packed_images):
+    "Inverse of pack_pil_images. Returns the image format and a list of (encoded_image, width, height, channels)."
+    magic, version, image_format_index, num_images = packed_images_header_struct.unpack_from(packed_images, 0)
+    if magic != PACKED_IMAGES_MAGIC or version != PACKED_IMAGES_VERSION:
+        raise ValueError("Not a packed images container.")
+
+    table_offset = packed_images_header_struct.size
+    data_offset = table_offset + num_images * packed_images_table_entry_struct.size
+    packed_images = memoryview(packed_images)
+
+    images = []
+    for i in range(num_images):
+        offset, length, width, height, channels = packed_images_table_entry_struct.unpack_from(
+            packed_images,
+            table_offset + i * packed_images_table_entry_struct.size
+        )
+        images.append((packed_images[data_offset + offset : data_offset + offset + length], width, height, channels))
+
+    return IMAGE_FORMATS[image_format_index], images
+#endregion
+
+
+def build_multipart_request(config, pil_images, image_encoding, images_field_name="images"):
+    "Returns the data and files kwargs for a multipart model server request."
+    image_format = image_encoding['format']
+    data = {'config': json.dumps(config)}
+
+    if image_encoding['transport'] == "packed":
+        files = [(images_field_name, ("images.lpki", pack_pil_images(pil_images, image_format, image_encoding['quality']), "application/octet-stream"))]
+        return data, files
+
+    files = []
+    for i, pil_image in enumerate(pil_images):
+        encoded_image = encode_image(pil_image, image_format, image_encoding['quality'])
+        files.append((images_field_name, (f"{i}.{image_format.lower()}", encoded_image, image_format_content_types[image_format])))
+
+    if image_format == "RAW":
+        data['imageSizes'] = json.dumps([list(get_image_size(pil_image)) for pil_image in pil_images])
+
+    return data, files
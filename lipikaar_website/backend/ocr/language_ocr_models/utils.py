@@ -6,20 +6,27 @@ from PIL import Image
 
 from cv2 import (
     copyMakeBorder,
-    cvtColor,
     getRotationMatrix2D,
     rectangle,
+    remap,
     transform,
     warpAffine,
     BORDER_CONSTANT,
-    COLOR_BGR2RGB,
-    COLOR_RGB2BGR,
+    INTER_LINEAR,
 )
 from numpy import (
+    arange,
     array,
     ceil,
+    float64,
+    int16,
+    int64,
+    rint,
     sqrt,
+    stack,
+    uint16,
     float32,
+    zeros,
 )
 
 
@@ -85,7 +92,8 @@ def get_bbox_after_rotation_transform(bbox, rotation_matrix, use_bbox_center_for
     }
 
 
-def crop_bboxes_from_image(image, bboxes):
+def crop_bboxes_from_image_with_full_page_warps(image, bboxes):
+    "Reference implementation of crop_bboxes_from_image, warps the whole padded page once per bbox."
     bboxes = deepcopy(bboxes)
     # imwrite(join(fp, "original-image.png"), image)
 
@@ -119,6 +127,127 @@ def crop_bboxes_from_image(image, bboxes):
         cropped_images.append(cropped_bbox_image)
     
     return cropped_images
+
+
+"""
+crop_bboxes_from_image gives the same crops as crop_bboxes_from_image_with_full_page_warps without warping the page:
+- The page is never padded; crop windows are computed in padded page coordinates and read from the original image,
+  with zeros wherever the window falls into the padding.
+- Unrotated bboxes are plain array slices.
+- Rotated bboxes only sample the pixels of their own crop window: the fixed-point source coordinates that
+  warpAffine would compute for those pixels are built here and passed to remap, which is what warpAffine does
+  internally, so the interpolated values are identical.
+- Bboxes with the same rotation share the rotation matrix and its per-row/per-column coordinate tables.
+"""
+WARP_AB_BITS = 10 # fixed-point constants used by cv2.warpAffine
+WARP_AB_SCALE = 1 << WARP_AB_BITS
+WARP_INTER_BITS = 5
+WARP_INTER_TAB_SIZE = 1 << WARP_INTER_BITS
+WARP_ROUND_DELTA = WARP_AB_SCALE // WARP_INTER_TAB_SIZE // 2
+
+
+def get_inverse_rotation_matrix(rotation_matrix):
+    "Inverts the affine matrix with the same floating point operations as cv2.warpAffine."
+    m = [float(value) for value in rotation_matrix.flatten()]
+
+    d = m[0] * m[4] - m[1] * m[3]
+    d = 1. / d if d != 0 else 0
+    a11, a22 = m[4] * d, m[0] * d
+    m[0] = a11
+    m[1] *= -d
+    m[3] *= -d
+    m[4] = a22
+    b1 = -m[0] * m[2] - m[1] * m[5]
+    b2 = -m[3] * m[2] - m[4] * m[5]
+    m[2] = b1
+    m[5] = b2
+
+    return m
+
+
+class RotatedPageSampler:
+    "Fixed-point source coordinate tables of one rotation of the padded page."
+
+    def __init__(self, rotation_matrix, padded_height, padded_width, paddings):
+        m = get_inverse_rotation_matrix(rotation_matrix)
+        xs = arange(padded_width, dtype=float64)
+        ys = arange(padded_height, dtype=float64)
+
+        # same split as warpAffine: a per-column term and a per-row term (which also carries the rounding delta)
+        self.x_column_deltas = rint(m[0] * xs * WARP_AB_SCALE).astype(int64)
+        self.y_column_deltas = rint(m[3] * xs * WARP_AB_SCALE).astype(int64)
+        self.x_row_offsets = rint((m[1] * ys + m[2]) * WARP_AB_SCALE).astype(int64) + WARP_ROUND_DELTA
+        self.y_row_offsets = rint((m[4] * ys + m[5]) * WARP_AB_SCALE).astype(int64) + WARP_ROUND_DELTA
+
+        # source coordinates are in padded page coordinates, the pixels are read from the unpadded image
+        self.x_padding = paddings[2] * WARP_INTER_TAB_SIZE
+        self.y_padding = paddings[0] * WARP_INTER_TAB_SIZE
+
+    def crop(self, image, y_start, y_stop, x_start, x_stop):
+        shift = WARP_AB_BITS - WARP_INTER_BITS
+        xs = (self.x_row_offsets[y_start:y_stop, None] + self.x_column_deltas[None, x_start:x_stop]) >> shift
+        ys = (self.y_row_offsets[y_start:y_stop, None] + self.y_column_deltas[None, x_start:x_stop]) >> shift
+        xs -= self.x_padding
+        ys -= self.y_padding
+
+        integer_coordinates = stack([xs >> WARP_INTER_BITS, ys >> WARP_INTER_BITS], axis=-1).astype(int16)
+        fractional_coordinates = ((ys & (WARP_INTER_TAB_SIZE - 1)) * WARP_INTER_TAB_SIZE + (xs & (WARP_INTER_TAB_SIZE - 1))).astype(uint16)
+
+        return remap(image, integer_coordinates, fractional_coordinates, INTER_LINEAR, borderMode=BORDER_CONSTANT)
+
+
+def slice_with_zero_padding(image, y_start, y_stop, x_start, x_stop, paddings):
+    "image padded by paddings, then sliced with [y_start:y_stop, x_start:x_stop], without padding the image."
+    height, width = image.shape[:2]
+    source_y_start, source_y_stop = y_start - paddings[0], y_stop - paddings[0]
+    source_x_start, source_x_stop = x_start - paddings[2], x_stop - paddings[2]
+
+    if source_y_start >= 0 and source_x_start >= 0 and source_y_stop <= height and source_x_stop <= width:
+        return image[source_y_start:source_y_stop, source_x_start:source_x_stop]
+
+    cropped_image = zeros((y_stop - y_start, x_stop - x_start) + image.shape[2:], dtype=image.dtype)
+    overlap_y_start, overlap_y_stop = max(source_y_start, 0), min(source_y_stop, height)
+    overlap_x_start, overlap_x_stop = max(source_x_start, 0), min(source_x_stop, width)
+    if overlap_y_start < overlap_y_stop and overlap_x_start < overlap_x_stop:
+        cropped_image[
+            overlap_y_start - source_y_start : overlap_y_stop - source_y_start,
+            overlap_x_start - source_x_start : overlap_x_stop - source_x_start
+        ] = image[overlap_y_start:overlap_y_stop, overlap_x_start:overlap_x_stop]
+
+    return cropped_image
+
+
+def crop_bboxes_from_image(image, bboxes):
+    "bboxes is a BBoxArray."
+    paddings = get_required_padding_for_image_rotation(image)
+    padded_height = image.shape[0] + paddings[0] + paddings[1]
+    padded_width = image.shape[1] + paddings[2] + paddings[3]
+    rotation_center = (padded_width // 2, padded_height // 2)
+    padded_bboxes = bboxes.offset(paddings[2], paddings[0])
+
+    cropped_images = [None] * len(bboxes)
+
+    for rotation in padded_bboxes.get_unique_rotations():
+        rotation_matrix = getRotationMatrix2D(rotation_center, rotation, 1.0)
+        sampler = None if rotation == 0 else RotatedPageSampler(rotation_matrix, padded_height, padded_width, paddings)
+
+        bbox_indices = (padded_bboxes.rotations == rotation).nonzero()[0]
+        windows = padded_bboxes[bbox_indices].get_windows_after_rotation_transform(rotation_matrix)
+
+        for i, (x_min, y_min, x_max, y_max) in zip(bbox_indices.tolist(), windows.tolist()):
+            # window of the (never created) rotated padded page, with the clipping rules of numpy slicing
+            y_start, y_stop, _ = slice(y_min, y_max).indices(padded_height)
+            x_start, x_stop, _ = slice(x_min, x_max).indices(padded_width)
+            y_stop, x_stop = max(y_start, y_stop), max(x_start, x_stop)
+
+            if y_start == y_stop or x_start == x_stop:
+                cropped_images[i] = zeros((y_stop - y_start, x_stop - x_start) + image.shape[2:], dtype=image.dtype)
+            elif sampler is None:
+                cropped_images[i] = slice_with_zero_padding(image, y_start, y_stop, x_start, x_stop, paddings)
+            else:
+                cropped_images[i] = sampler.crop(image, y_start, y_stop, x_start, x_stop)
+
+    return cropped_images
 #endregion
 
 
@@ -127,11 +256,7 @@ def clamp(value, lower_limit, upper_limit):
 
 
 def remove_bboxes_with_low_width_or_height(bboxes, min_width, min_height):
-    bboxes = [
-        bbox for bbox in bboxes 
-        if (bbox['x_max'] - bbox['x_min'] >= min_width) and (bbox['y_max'] - bbox['y_min'] >= min_height)
-    ]
-    return bboxes
+    return bboxes.filter_by_min_size(min_width, min_height)
 
 
 def pil_image_to_base64_str(pil_image):
@@ -148,12 +273,11 @@ def save_pil_image(pil_image, output_path=None):
     pil_image.save(output_path)
 
 
-def get_cropped_images_for_bboxes(pil_image, bboxes):
-    cv2_image = cvtColor(array(pil_image), COLOR_RGB2BGR)
-    
-    cropped_images = crop_bboxes_from_image(cv2_image, bboxes)
-    
-    cropped_images = [Image.fromarray(cvtColor(image, COLOR_BGR2RGB)) for image in cropped_images]
+def get_cropped_images_for_bboxes(page_image, bboxes):
+    # cropping works on any channel order, so the RGB pixels of the page are cropped directly
+    cropped_images = crop_bboxes_from_image(page_image.pixels, bboxes)
+
+    cropped_images = [Image.fromarray(image) for image in cropped_images]
     return cropped_images
 
 
@@ -167,7 +291,7 @@ def get_detections_from_bboxes_and_recognized_texts(bboxes, recognized_texts):
         return []
 
     detections = []
-    for i, bbox in enumerate(bboxes):
+    for i, bbox in enumerate(bboxes.to_dicts()):
         detections.append({
             'text_id': str(i),
             'text_bbox': {
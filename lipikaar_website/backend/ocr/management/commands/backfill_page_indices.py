@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from ocr.models import Upload
+from ocr.db_utils import set_upload_pages
+from ocr.utils import try_parse_json_str
+
+
+def backfill_page_indices():
+    """
+    Sets Detection.page_index from Upload.detection_ids for uploads saved before pages were ordered by it.
+    Returns the number of uploads updated.
+    """
+    num_uploads = 0
+    for upload_object in Upload.objects.filter(detection__page_index__isnull=True).distinct():
+        set_upload_pages(upload_object, try_parse_json_str(upload_object.detection_ids, "list"))
+        num_uploads += 1
+    return num_uploads
+
+
+class Command(BaseCommand):
+    help = 'Sets the page order of uploads created before Detection.page_index, from their detection_ids.'
+
+    def handle(self, *args, **kwargs):
+        num_uploads = backfill_page_indices()
+        print(f"Set the page order of {num_uploads} uploads.")
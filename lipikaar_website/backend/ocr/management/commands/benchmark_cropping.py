@@ -0,0 +1,81 @@
+from random import Random
+from time import perf_counter
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from ocr.language_ocr_models.bboxes import BBoxArray
+from ocr.language_ocr_models.utils import (
+    crop_bboxes_from_image,
+    crop_bboxes_from_image_with_full_page_warps,
+)
+
+
+def generate_page(height, width, seed):
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    return np.ascontiguousarray(noise.repeat(8, axis=0).repeat(8, axis=1)[:height, :width])
+
+
+def generate_bboxes(height, width, num_bboxes, rotated_fraction, seed):
+    random = Random(seed)
+    rotations = [random.uniform(-15, 15) for _ in range(4)] + [90.0, -90.0]
+
+    bboxes = []
+    for _ in range(num_bboxes):
+        bbox_width, bbox_height = random.randint(20, 300), random.randint(15, 60)
+        x_min, y_min = random.randint(0, width - bbox_width), random.randint(0, height - bbox_height)
+        bboxes.append({
+            'x_min': x_min,
+            'y_min': y_min,
+            'x_max': x_min + bbox_width,
+            'y_max': y_min + bbox_height,
+            'rotation': random.choice(rotations) if random.random() < rotated_fraction else 0,
+        })
+    return bboxes
+
+
+class Command(BaseCommand):
+    help = "Compares the crops/sec of crop_bboxes_from_image with the full page warp implementation on a synthetic page, and checks that the crops are identical."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--width", type=int, default=4000)
+        parser.add_argument("--height", type=int, default=3000)
+        parser.add_argument("--bboxes", type=int, default=1500)
+        parser.add_argument("--rotated-fraction", type=float, default=0.3)
+        parser.add_argument("--legacy-limit", type=int, default=50, help="Bboxes cropped with the (slow) full page warp implementation.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if not 0 <= options['rotated_fraction'] <= 1:
+            raise CommandError("--rotated-fraction must be between 0 and 1.")
+
+        image = generate_page(options['height'], options['width'], options['seed'])
+        bboxes = generate_bboxes(options['height'], options['width'], options['bboxes'], options['rotated_fraction'], options['seed'])
+        legacy_bboxes = bboxes[:options['legacy_limit']]
+
+        start_time = perf_counter()
+        cropped_images = crop_bboxes_from_image(image, BBoxArray.from_dicts(bboxes))
+        time_taken = perf_counter() - start_time
+
+        start_time = perf_counter()
+        legacy_cropped_images = crop_bboxes_from_image_with_full_page_warps(image, legacy_bboxes)
+        legacy_time_taken = perf_counter() - start_time
+
+        num_mismatches = 0
+        for cropped_image, legacy_cropped_image in zip(cropped_images, legacy_cropped_images):
+            if cropped_image.shape != legacy_cropped_image.shape or not np.array_equal(cropped_image, legacy_cropped_image):
+                num_mismatches += 1
+
+        crops_per_second = len(bboxes) / time_taken
+        legacy_crops_per_second = len(legacy_bboxes) / legacy_time_taken if legacy_bboxes else 0.0
+
+        print(f"Page: {options['width']}x{options['height']}, bboxes: {len(bboxes)}, rotated: {sum(1 for bbox in bboxes if bbox['rotation'] != 0)}")
+        print(f"Full page warps: {legacy_crops_per_second:.1f} crops/sec ({len(legacy_bboxes)} bboxes in {legacy_time_taken:.3f}s)")
+        print(f"Region crops:    {crops_per_second:.1f} crops/sec ({len(bboxes)} bboxes in {time_taken:.3f}s)")
+        if legacy_crops_per_second > 0:
+            print(f"Speedup: {crops_per_second / legacy_crops_per_second:.1f}x")
+        print(f"Identical crops: {len(legacy_bboxes) - num_mismatches}/{len(legacy_bboxes)}")
+
+        if num_mismatches > 0:
+            raise CommandError(f"{num_mismatches} crops differ from the full page warp implementation.")
@@ -0,0 +1,96 @@
+import json
+import os
+import sqlite3
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from ocr.models import Detection
+from ocr.detections_storage import encode_detections, decode_detections
+
+
+def generate_page_detections_json(random, num_words):
+    "Detections of a page as saved by the OCR pipeline, with random Devanagari words on lines of 10 words."
+    detections = []
+    for i in range(num_words):
+        line_index, word_index = divmod(i, 10)
+        x_min, y_min = 50 + word_index * 110 + int(random.integers(0, 10)), 50 + line_index * 45 + int(random.integers(0, 5))
+        detections.append({
+            'text_id': str(i),
+            'text_bbox': {
+                'x_min': x_min,
+                'x_max': x_min + int(random.integers(40, 100)),
+                'y_min': y_min,
+                'y_max': y_min + int(random.integers(25, 35)),
+                'line_index': line_index,
+                'word_index': word_index,
+            },
+            'text_language': "hindi",
+            'text': "".join(chr(int(code_point)) for code_point in random.integers(0x0905, 0x0939, int(random.integers(2, 8)))),
+        })
+    return json.dumps(detections)
+
+
+def run_storage_benchmark(pages_detections_json, encode, decode):
+    "Writes every page (twice, like original_detections and detections) to a new SQLite DB and reads it back."
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database_path = os.path.join(temp_dir, "benchmark.sqlite3")
+        database = sqlite3.connect(database_path)
+        database.execute("CREATE TABLE detection (id INTEGER PRIMARY KEY, original_detections BLOB, detections BLOB)")
+
+        start_time = perf_counter()
+        with database:
+            for detections_json in pages_detections_json:
+                stored_value = encode(detections_json)
+                database.execute("INSERT INTO detection (original_detections, detections) VALUES (?, ?)", (stored_value, stored_value))
+        write_time = perf_counter() - start_time
+
+        database.execute("VACUUM")
+        database_size = os.path.getsize(database_path)
+
+        start_time = perf_counter()
+        for original_detections, detections in database.execute("SELECT original_detections, detections FROM detection"):
+            json.loads(decode(original_detections))
+            json.loads(decode(detections))
+        read_time = perf_counter() - start_time
+
+        database.close()
+
+    return database_size, write_time, read_time
+
+
+class Command(BaseCommand):
+    help = "Compares the DB size and the read and write time of detections stored as plain JSON text and in the compact format."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pages", type=int, default=200)
+        parser.add_argument("--words", type=int, default=300, help="Words per generated page.")
+        parser.add_argument("--from-db", action="store_true", help="Use the detections of up to --pages pages from the DB instead of generated ones.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['from_db']:
+            pages_detections_json = list(Detection.objects.values_list('detections', flat=True)[:options['pages']])
+        else:
+            random = np.random.default_rng(options['seed'])
+            pages_detections_json = [generate_page_detections_json(random, options['words']) for _ in range(options['pages'])]
+
+        if len(pages_detections_json) == 0:
+            print("No pages to benchmark.")
+            return
+
+        for value in pages_detections_json:
+            if decode_detections(encode_detections(value)) != value:
+                print("Warning: a page did not decode to the same JSON.")
+                break
+
+        print(f"{len(pages_detections_json)} pages, stored twice each")
+        for storage_format, encode, decode in (
+            ("json", lambda detections_json: detections_json, lambda value: value),
+            ("compact", encode_detections, decode_detections),
+        ):
+            database_size, write_time, read_time = run_storage_benchmark(pages_detections_json, encode, decode)
+            print(f"{storage_format}:")
+            print(4 * " " + f"DB size {database_size / (1024 * 1024):.2f} MB, write {write_time * 1000:.1f} ms, read {read_time * 1000:.1f} ms")
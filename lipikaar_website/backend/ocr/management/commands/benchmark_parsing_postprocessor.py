@@ -0,0 +1,65 @@
+from random import Random
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from ocr.language_ocr_models.parsing_postprocessors import (
+    get_line_components,
+    get_line_components_with_pairwise_checks,
+    merge_components,
+)
+
+
+def generate_page_bboxes(num_bboxes, seed):
+    "Words on text lines, with jittered heights and baselines, some lines touching the next one, in random order."
+    random = Random(seed)
+    words_per_line = 40
+    line_height = 40
+
+    bboxes = []
+    for i in range(num_bboxes):
+        line_num, word_num = divmod(i, words_per_line)
+        x_min = 30 + word_num * 60 + random.randint(0, 10)
+        y_min = 30 + line_num * line_height + random.randint(-6, 6)
+        bboxes.append({
+            'x_min': x_min,
+            'y_min': y_min,
+            'x_max': x_min + random.randint(20, 55),
+            'y_max': y_min + random.randint(18, 36),
+        })
+
+    random.shuffle(bboxes)
+    return bboxes
+
+
+class Command(BaseCommand):
+    help = "Times the DefaultParsingPostprocessor line merging on synthetic pages, and compares it with the pairwise implementation."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bboxes", type=int, nargs="+", default=[5000, 20000])
+        parser.add_argument("--pairwise-limit", type=int, default=5000, help="Largest page also merged with the (O(n**2)) pairwise implementation.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        for num_bboxes in options['bboxes']:
+            bboxes = generate_page_bboxes(num_bboxes, options['seed'])
+
+            start_time = perf_counter()
+            components = get_line_components(bboxes)
+            merged_bboxes = merge_components(bboxes, components)
+            time_taken = perf_counter() - start_time
+
+            print(f"{num_bboxes} bboxes -> {len(merged_bboxes)} lines")
+            print(4 * " " + f"Sweep line: {time_taken:.3f}s")
+
+            if num_bboxes > options['pairwise_limit']:
+                continue
+
+            start_time = perf_counter()
+            pairwise_components = get_line_components_with_pairwise_checks(bboxes)
+            pairwise_merged_bboxes = merge_components(bboxes, pairwise_components)
+            pairwise_time_taken = perf_counter() - start_time
+
+            same_lines = [sorted(component) for component in components] == [sorted(component) for component in pairwise_components]
+            print(4 * " " + f"Pairwise: {pairwise_time_taken:.3f}s ({pairwise_time_taken / time_taken:.1f}x slower)")
+            print(4 * " " + f"Same lines: {same_lines and merged_bboxes == pairwise_merged_bboxes}")
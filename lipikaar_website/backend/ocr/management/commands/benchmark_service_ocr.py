@@ -0,0 +1,143 @@
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import mean
+from threading import Thread
+from time import perf_counter, sleep
+from uuid import uuid4
+
+import numpy as np
+from PIL import Image
+from django.core.management.base import BaseCommand
+
+from ocr.celery import app
+from ocr.inline_ocr import InlineOCRExecutor
+from ocr.language_ocr_models.main import ocr_instance
+from ocr.models import PageOCRCacheEntry
+from ocr.tasks import perform_ocr_for_service, run_ocr_for_service
+from ocr_app.settings import CACHE_ROOT
+
+
+def start_stand_in_model_server(port, num_bboxes, parser_delay, recognizer_delay):
+    "A document parser and text recognizer answering with a grid of bboxes and a fixed text after fixed delays."
+    bboxes = []
+    for i in range(num_bboxes):
+        line_num, word_num = divmod(i, 10)
+        bboxes.append({'x_min': 50 + word_num * 110, 'y_min': 50 + line_num * 45, 'x_max': 150 + word_num * 110, 'y_max': 85 + line_num * 45})
+
+    class StandInModelServerHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            request_body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if self.path.startswith("/get-bboxes-for-image/"):
+                sleep(parser_delay)
+                response_body = {'result': {'bboxes': bboxes}}
+            else:
+                sleep(recognizer_delay)
+                response_body = {'output': [{'source': "text"} for _ in request_body['image']]}
+
+            response_bytes = json.dumps(response_body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response_bytes)))
+            self.end_headers()
+            self.wfile.write(response_bytes)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInModelServerHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def save_page_image_to_cache(random, width, height):
+    "A white page with random dark words, different for every request so the page and crop caches never hit."
+    pixels = np.full((height, width, 3), 255, dtype=np.uint8)
+    for _ in range(200):
+        x, y = int(random.integers(0, width - 120)), int(random.integers(0, height - 40))
+        pixels[y : y + int(random.integers(10, 40)), x : x + int(random.integers(20, 120))] = int(random.integers(0, 100))
+
+    image_filename = f"benchmark_{uuid4()}.jpg"
+    Image.fromarray(pixels).save(os.path.join(CACHE_ROOT, image_filename), quality=90)
+    return image_filename
+
+
+def check_if_celery_worker_is_running():
+    try:
+        return len(app.control.ping(timeout=2.0)) > 0
+    except Exception: # the broker is down
+        return False
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the latency of single-image service OCR run inline in this process and through Celery, against local stand-in model servers. "
+        "The stand-ins only speak the json image transport (MODEL_SERVER_IMAGE_TRANSPORT=json)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=20)
+        parser.add_argument("--paths", nargs="+", choices=["inline", "celery"], default=["inline", "celery"])
+        parser.add_argument("--port", type=int, default=8799, help="Port of the stand-in model servers, the Celery worker has to be pointed at it.")
+        parser.add_argument("--bboxes", type=int, default=60)
+        parser.add_argument("--parser-delay-ms", type=float, default=40.0)
+        parser.add_argument("--recognizer-delay-ms", type=float, default=30.0)
+        parser.add_argument("--width", type=int, default=1240)
+        parser.add_argument("--height", type=int, default=1754)
+        parser.add_argument("--celery-timeout", type=float, default=60.0)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        server = start_stand_in_model_server(options['port'], options['bboxes'], options['parser_delay_ms'] / 1000, options['recognizer_delay_ms'] / 1000)
+        stand_in_url = f"http://127.0.0.1:{server.server_port}"
+        print(f"Stand-in model servers at {stand_in_url}")
+
+        # the inline path uses the clients of this process
+        ocr_instance.document_parsers_client.endpoint = stand_in_url + "/get-bboxes-for-image/"
+        ocr_instance.document_parsers_client.endpoints = {transport: ocr_instance.document_parsers_client.endpoint for transport in ("json", "multipart", "packed")}
+        ocr_instance.text_recognizers_client.endpoint = stand_in_url + "/get-texts-for-images/"
+        ocr_instance.text_recognizers_client.endpoints = {transport: ocr_instance.text_recognizers_client.endpoint for transport in ("json", "multipart", "packed")}
+
+        ocr_config = {
+            'document_parser': {'modelId': "stand-in"},
+            'text_recognizer': {'modelId': "stand-in", 'language': ["hindi"], 'version': "benchmark"},
+        }
+        random = np.random.default_rng(options['seed'])
+        inline_ocr_executor = InlineOCRExecutor(max_concurrency=1)
+
+        for path in options['paths']:
+            if path == "celery" and not check_if_celery_worker_is_running():
+                print("celery: skipped, no worker answered. Start one with")
+                print(4 * " " + f"DOCUMENT_PARSERS_API_PROVIDER_URL={stand_in_url} TEXT_RECOGNIZERS_API_PROVIDER_URL={stand_in_url} MODEL_SERVER_IMAGE_TRANSPORT=json \\")
+                print(4 * " " + "celery -A ocr.celery worker -Q ocr_for_service --pool=solo -l WARNING")
+                continue
+
+            latencies = []
+            for _ in range(options['requests']):
+                image_filenames = [save_page_image_to_cache(random, options['width'], options['height'])]
+
+                start_time = perf_counter()
+                if path == "inline":
+                    detections = inline_ocr_executor.try_submit(run_ocr_for_service, image_filenames, ocr_config).result()
+                else:
+                    detections = perform_ocr_for_service.apply_async(
+                        kwargs={'image_filenames': image_filenames, 'ocr_config': ocr_config}
+                    ).get(timeout=options['celery_timeout'])
+                latencies.append(perf_counter() - start_time)
+
+                if len(detections) == 0:
+                    print(f"{path}: got no detections, is the worker pointed at {stand_in_url}?")
+                    break
+
+            print(f"{path}: {len(latencies)} requests")
+            print(4 * " " + f"mean {mean(latencies) * 1000:.1f} ms, p50 {get_percentile(latencies, 50) * 1000:.1f} ms, p95 {get_percentile(latencies, 95) * 1000:.1f} ms")
+
+        PageOCRCacheEntry.objects.filter(document_parser="stand-in").delete()
+        server.shutdown()
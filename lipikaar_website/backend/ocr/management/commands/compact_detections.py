@@ -0,0 +1,75 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ocr.models import Detection
+from ocr.detections_storage import check_if_detections_are_compact, decode_detections
+
+
+def get_database_file_size():
+    "Bytes of the SQLite DB file, None for other databases."
+    if connection.vendor != "sqlite":
+        return None
+    return os.path.getsize(connection.settings_dict['NAME'])
+
+
+def compact_detections(batch_size):
+    """
+    Re-saves the detections of every Detection still stored as plain JSON text (or in the older columnar format) in the compact format, batch_size rows
+    per transaction. Returns (number of rows checked, number of rows converted).
+    """
+    select_query = "SELECT {id}, {original_detections}, {detections} FROM {table} WHERE {id} > %s ORDER BY {id} LIMIT %s".format(
+        id=connection.ops.quote_name('id'),
+        original_detections=connection.ops.quote_name('original_detections'),
+        detections=connection.ops.quote_name('detections'),
+        table=connection.ops.quote_name(Detection._meta.db_table),
+    )
+
+    num_rows = 0
+    num_converted_rows = 0
+    last_id = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(select_query, [last_id, batch_size])
+            rows = cursor.fetchall()
+        if len(rows) == 0:
+            break
+
+        num_rows += len(rows)
+        last_id = rows[-1][0]
+
+        detection_objects = [
+            Detection(id=detection_id, original_detections=decode_detections(original_detections), detections=decode_detections(detections))
+            for detection_id, original_detections, detections in rows
+            if not (check_if_detections_are_compact(original_detections) and check_if_detections_are_compact(detections))
+        ]
+        if len(detection_objects) > 0:
+            with transaction.atomic():
+                Detection.objects.bulk_update(detection_objects, ['original_detections', 'detections'])
+            num_converted_rows += len(detection_objects)
+
+        print(f"Checked {num_rows} detections, converted {num_converted_rows}.")
+
+    return num_rows, num_converted_rows
+
+
+class Command(BaseCommand):
+    help = 'Converts detections stored as plain JSON text or in the older columnar format to the compact format (see ocr/detections_storage.py), in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--vacuum", action="store_true", help="Run VACUUM afterwards so the SQLite DB file shrinks.")
+
+    def handle(self, *args, **options):
+        database_file_size = get_database_file_size()
+
+        num_rows, num_converted_rows = compact_detections(max(1, options['batch_size']))
+        print(f"Converted {num_converted_rows} of {num_rows} detections.")
+
+        if options['vacuum'] and connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+
+        if database_file_size is not None:
+            print(f"DB file: {database_file_size / (1024 * 1024):.1f} MB before, {get_database_file_size() / (1024 * 1024):.1f} MB after.")
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ocr.models import MIN_SERVICE_API_KEY_REQUESTS_PER_MINUTE, ServiceAPIKey
+from ocr_app.settings import SERVICE_API_KEY
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates a Service API Key, or updates the limits of an existing one with the same key. "
+        "Without --key, uses SERVICE_API_KEY if it is set, otherwise a random key."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--name", required=True)
+        parser.add_argument("--key", default=SERVICE_API_KEY)
+        parser.add_argument("--requests-per-minute", type=float, default=60.0)
+        parser.add_argument("--burst", type=int, default=10)
+        parser.add_argument("--max-in-flight-jobs", type=int, default=4, help="0 for no limit.")
+
+    def handle(self, *args, **options):
+        if options['requests_per_minute'] < MIN_SERVICE_API_KEY_REQUESTS_PER_MINUTE or options['burst'] < 1 or options['max_in_flight_jobs'] < 0:
+            raise CommandError(
+                f"--requests-per-minute must be at least {MIN_SERVICE_API_KEY_REQUESTS_PER_MINUTE}, --burst at least 1 "
+                "and --max-in-flight-jobs must not be negative."
+            )
+
+        limits = {
+            'name': options['name'],
+            'is_active': True,
+            'requests_per_minute': options['requests_per_minute'],
+            'burst': options['burst'],
+            'max_in_flight_jobs': options['max_in_flight_jobs'],
+        }
+
+        if options['key']:
+            service_api_key, created = ServiceAPIKey.objects.update_or_create(key=options['key'], defaults=limits)
+        else:
+            service_api_key, created = ServiceAPIKey.objects.create(**limits), True
+
+        print(f"{'Created' if created else 'Updated'} Service API Key \"{service_api_key.name}\":")
+        print(4 * " " + service_api_key.key)
@@ -1,13 +1,25 @@
 import json
 from django.core.management.base import BaseCommand, CommandError
 
-from ocr.models import Upload, Detection
+from ocr.models import Upload, Detection, ServiceAPIKey
 from ocr.utils import generate_processing_status_string
 from ocr.cache import clear_cache
 from ocr.cloud_storage import delete_unreferenced_files_from_cloud_storage
 from ocr.utils import try_parse_json_str
 from ocr.redis import redis_set_methods
 from ocr.QueueManager import QueueManager
+from ocr.management.commands.backfill_page_indices import backfill_page_indices
+from ocr.language_ocr_models.main import ocr_instance
+from ocr_app.settings import SERVICE_API_KEY
+
+
+def create_default_service_api_key(key):
+    "Creates a Service API Key with the default limits from key, only if key is set and there is no Service API Key yet."
+    if not key or ServiceAPIKey.objects.exists():
+        return False
+
+    ServiceAPIKey.objects.create(name="default", key=key)
+    return True
 
 
 def startup_code():
@@ -15,6 +27,9 @@ def startup_code():
         Executed only once when the server starts. Does the following:
         1) Clean the cache.
         2) Marked all previous uploads whose processingStatus is not 5 or 6 as status 6.
+        3) Set the page order of uploads created before Detection.page_index.
+        4) Fetch the model configs, so that the server and the workers start from a fresh snapshot.
+        5) Create a Service API Key from SERVICE_API_KEY if there is none, so that services keep their access.
         """
         print("Deleting cancelled_queued_uploads set from Redis... ")
         QueueManager.clear_cancelled_uploads()
@@ -40,9 +55,24 @@ def startup_code():
         print(f"Found {unprocessed_upload_count} such uploads... ", end="")
         print("Done.")
 
+        print("Setting the page order of older uploads... ", end="")
+        num_backfilled_uploads = backfill_page_indices()
+        print(f"Found {num_backfilled_uploads} such uploads... ", end="")
+        print("Done.")
+
+        print("Fetching the model configs... ", end="")
+        for config_registry in [ocr_instance.document_parsers_config_registry, ocr_instance.text_recognizers_config_registry]:
+            config_registry.refresh()
+        print("Done.")
+
+        print("Creating the Service API Key of SERVICE_API_KEY... ", end="")
+        if create_default_service_api_key(SERVICE_API_KEY):
+            print("Done.")
+        else:
+            print("Skipped, SERVICE_API_KEY is not set or Service API Keys exist.")
+
         print("Removing media files not referenced in the db... ", end="")
-        all_detections = Detection.objects.all()
-        all_referenced_filenames = [detection_object.image_filename for detection_object in all_detections]
+        all_referenced_filenames = list(Detection.objects.values_list('image_filename', flat=True)) # without decoding the detections
         delete_unreferenced_files_from_cloud_storage("detection_images", all_referenced_filenames)
         print("Done.")
 
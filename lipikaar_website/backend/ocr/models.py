@@ -1,6 +1,10 @@
+from secrets import token_urlsafe
+
 from django.contrib.auth.models import AbstractUser
+from django.core.validators import MinValueValidator
 from django.db import models
 
+from ocr.detections_storage import CompactDetectionsField
 from ocr_app import settings
 
 
@@ -13,6 +17,7 @@ class CustomUser(AbstractUser):
     organization = models.CharField(max_length=255)
     credits = models.FloatField(default=0.0, blank=False)
     credits_refresh_policy = models.TextField(default="None", blank=False)
+    uploads_version = models.PositiveIntegerField(default=0) # incremented on every change to the user's uploads, see ocr/etags.py
 
     class Meta:
         verbose_name = 'User'
@@ -39,6 +44,55 @@ class Detection(models.Model):
     document_parser = models.CharField(max_length=255)
     parsing_postprocessor = models.CharField(max_length=255)
     text_recognizer = models.CharField(max_length=255)
-    original_detections = models.TextField()
+    original_detections = CompactDetectionsField() # JSON strings, stored compressed (see ocr/detections_storage.py)
+    detections = CompactDetectionsField()
+    page_index = models.IntegerField(null=True, blank=True, default=None) # position of the page in its upload, None until the page is added to it
+    version = models.PositiveIntegerField(default=0) # incremented on every edit of detections
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['upload', 'page_index']),
+        ]
+
+
+class PageOCRCacheEntry(models.Model):
+    "Detections of a page, keyed by the page pixels and the models that produced them. See ocr/page_ocr_cache.py."
+    cache_key = models.CharField(max_length=64, unique=True)
+    page_hash = models.CharField(max_length=64)
+    document_parser = models.CharField(max_length=255)
+    text_recognizer = models.CharField(max_length=255)
+    text_recognizer_version = models.CharField(max_length=255, blank=True)
     detections = models.TextField()
-  
\ No newline at end of file
+    size = models.PositiveIntegerField(default=0) # bytes of detections
+    num_hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = 'Page OCR Cache Entry'
+        verbose_name_plural = 'Page OCR Cache'
+
+
+def generate_service_api_key():
+    return token_urlsafe(32)
+
+
+MIN_SERVICE_API_KEY_REQUESTS_PER_MINUTE = 0.01 # the bucket of a key with no refill would never expire
+
+
+class ServiceAPIKey(models.Model):
+    "A key of the service API, with its own rate limit and in-flight quota. See ocr/service_api_keys.py."
+    name = models.CharField(max_length=255)
+    key = models.CharField(max_length=64, unique=True, default=generate_service_api_key)
+    is_active = models.BooleanField(default=True)
+    requests_per_minute = models.FloatField(default=60.0, validators=[MinValueValidator(MIN_SERVICE_API_KEY_REQUESTS_PER_MINUTE)]) # token bucket refill rate
+    burst = models.PositiveIntegerField(default=10, validators=[MinValueValidator(1)]) # token bucket size
+    max_in_flight_jobs = models.PositiveIntegerField(default=4) # OCR requests and jobs running at once, 0 for no limit
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Service API Key'
+        verbose_name_plural = 'Service API Keys'
+
+    def __str__(self):
+        return self.name
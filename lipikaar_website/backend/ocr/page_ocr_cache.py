@@ -0,0 +1,135 @@
+import json
+from datetime import timedelta
+from hashlib import blake2b, sha256
+
+from django.db import IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+from redis.exceptions import RedisError
+
+from ocr.models import PageOCRCacheEntry
+from ocr.QueueManager import QueueManager
+from ocr_app.settings import PAGE_OCR_CACHE_EVICTION_INTERVAL, PAGE_OCR_CACHE_MAX_SIZE_MB, PAGE_OCR_CACHE_TOUCH_INTERVAL
+
+
+"""
+Whole-page OCR results, keyed by the decoded page pixels and the document parser and text recognizer
+configs that produced them, so that re-uploaded pages skip the model servers. Pages are only cached
+when both configs have a version, a model can otherwise change without its results being invalidated.
+The total size is tracked in Redis, and once it goes over PAGE_OCR_CACHE_MAX_SIZE_MB the least recently
+used entries are evicted, at most every PAGE_OCR_CACHE_EVICTION_INTERVAL seconds.
+"""
+
+
+def get_page_hash(page_image):
+    "Hash of the decoded pixels, so the same page inside different files (or re-encoded) still matches."
+    page_hash = blake2b(digest_size=32)
+    page_hash.update(str(page_image.pixels.shape).encode("utf-8"))
+    page_hash.update(page_image.pixels)
+    return page_hash.hexdigest()
+
+
+def get_page_ocr_cache_key(page_hash, ocr_config):
+    "None when the document parser or the text recognizer config has no version, such pages are not cached."
+    if not ocr_config['document_parser'].get('version') or not ocr_config['text_recognizer'].get('version'):
+        return None
+
+    key_parts = [
+        page_hash,
+        ocr_config['document_parser'],
+        ocr_config['text_recognizer'],
+    ]
+    return sha256(json.dumps(key_parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_cached_page_detections(cache_key):
+    "Returns the cached detections, or None on a miss."
+    cache_entry = PageOCRCacheEntry.objects.filter(cache_key=cache_key).only('id', 'detections', 'last_used_at').first()
+    if cache_entry is None:
+        return None
+
+    try:
+        # hits are counted in Redis, and only written to the entry with its last use once in a while
+        now = timezone.now()
+        if cache_entry.last_used_at < now - timedelta(seconds=PAGE_OCR_CACHE_TOUCH_INTERVAL):
+            num_hits = QueueManager.pop_page_ocr_cache_hits(cache_entry.id) + 1
+            PageOCRCacheEntry.objects.filter(id=cache_entry.id).update(last_used_at=now, num_hits=F('num_hits') + num_hits)
+        else:
+            QueueManager.increment_page_ocr_cache_hits(cache_entry.id)
+    except RedisError as e:
+        print("Error at page_ocr_cache.get_cached_page_detections")
+        print(4 * " " + str(e))
+
+    return json.loads(cache_entry.detections)
+
+
+def save_page_detections_to_cache(cache_key, page_hash, ocr_config, detections):
+    detections_json = json.dumps(detections)
+    size = len(detections_json.encode("utf-8"))
+    previous_size = PageOCRCacheEntry.objects.filter(cache_key=cache_key).values_list('size', flat=True).first() or 0
+
+    try:
+        PageOCRCacheEntry.objects.update_or_create(
+            cache_key=cache_key,
+            defaults={
+                'page_hash': page_hash,
+                'document_parser': ocr_config['document_parser']['modelId'],
+                'text_recognizer': ocr_config['text_recognizer']['modelId'],
+                'text_recognizer_version': str(ocr_config['text_recognizer'].get('version', "")),
+                'detections': detections_json,
+                'size': size,
+                'last_used_at': timezone.now(),
+            }
+        )
+    except IntegrityError: # the same page was saved by another worker in the meantime
+        return
+
+    try:
+        total_size = QueueManager.increment_page_ocr_cache_size(size - previous_size)
+        if total_size is not None and total_size <= get_page_ocr_cache_max_size():
+            return
+        if QueueManager.acquire_page_ocr_cache_eviction(PAGE_OCR_CACHE_EVICTION_INTERVAL):
+            evict_page_ocr_cache_entries()
+    except RedisError as e:
+        print("Error at page_ocr_cache.save_page_detections_to_cache")
+        print(4 * " " + str(e))
+
+
+def get_page_ocr_cache_max_size():
+    return int(PAGE_OCR_CACHE_MAX_SIZE_MB * 1024 * 1024)
+
+
+def get_page_ocr_cache_size():
+    return PageOCRCacheEntry.objects.aggregate(total_size=Sum('size'))['total_size'] or 0
+
+
+def evict_page_ocr_cache_entries(max_size=None):
+    """
+    Delete the least recently used entries until the cache fits in max_size bytes, and reset the size tracked
+    in Redis to the remaining one. Returns the number of deleted entries.
+    """
+    if max_size is None:
+        max_size = get_page_ocr_cache_max_size()
+
+    total_size = get_page_ocr_cache_size()
+    excess_size = total_size - max_size
+    if excess_size <= 0:
+        QueueManager.set_page_ocr_cache_size(total_size)
+        return 0
+
+    evicted_entry_ids = []
+    for entry_id, entry_size in PageOCRCacheEntry.objects.order_by('last_used_at').values_list('id', 'size').iterator():
+        if excess_size <= 0:
+            break
+        evicted_entry_ids.append(entry_id)
+        excess_size -= entry_size
+
+    num_deleted, _ = PageOCRCacheEntry.objects.filter(id__in=evicted_entry_ids).delete()
+    QueueManager.set_page_ocr_cache_size(get_page_ocr_cache_size())
+    return num_deleted
+
+
+def purge_page_ocr_cache():
+    num_deleted, _ = PageOCRCacheEntry.objects.all().delete()
+    QueueManager.set_page_ocr_cache_size(0)
+    return num_deleted
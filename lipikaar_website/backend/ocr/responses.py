@@ -64,6 +64,39 @@ queue_full_response = Response({
     }
 }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
+def generate_custom_ocr_timeout_response(task_id):
+    return Response({
+        'success': False,
+        'error': {
+            'errorCode': 0,
+            'message': "The text recognizer did not answer in time. Poll the task for its result.",
+            'taskId': task_id,
+        },
+    }, status=status.HTTP_504_GATEWAY_TIMEOUT)
+
+def generate_custom_ocr_failed_response(task_id):
+    return Response({
+        'success': False,
+        'error': {
+            'errorCode': 0,
+            'message': "Custom OCR failed.",
+            'taskId': task_id,
+        },
+    }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def generate_detection_version_conflict_response(current_version):
+    return Response({
+        'success': False,
+        'error': {
+            'errorCode': 0,
+            'message': "The detections were changed since this version. Get them again and resend the changes.",
+            'version': current_version,
+        },
+    }, status=status.HTTP_409_CONFLICT)
+
+def generate_not_modified_response():
+    return Response(status=status.HTTP_304_NOT_MODIFIED)
+
 def generate_invalid_id_response(table_name):
     return Response({
         'success': False,
@@ -124,6 +157,28 @@ def generate_unauthorized_service_request_response():
         },
     }, status=status.HTTP_401_UNAUTHORIZED)
 
+def generate_service_rate_limited_response(reason, retry_after):
+    response = Response({
+        'success': False,
+        'error': {
+            'message': "Too many requests in flight for this Service API Key." if reason == "inFlight" else "Rate limit of this Service API Key exceeded.",
+            'reason': reason,
+            'retryAfter': retry_after,
+        },
+    }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+def generate_service_ocr_timeout_response():
+    return Response({
+        'success': False,
+        'error': {
+            'message': "OCR did not finish in time. Use services/jobs/ to OCR the file in the background.",
+        },
+    }, status=status.HTTP_504_GATEWAY_TIMEOUT)
+
 service_responses = {
     'unauthorized': generate_unauthorized_service_request_response,
+    'rateLimited': generate_service_rate_limited_response,
+    'ocrTimeout': generate_service_ocr_timeout_response,
 }
@@ -10,6 +10,8 @@ from ocr.models import (
     Upload,
     Detection,
 )
+from ocr_app.settings import CUSTOM_OCR_BATCH_MAX_BBOXES, DETECTION_PATCH_MAX_OPERATIONS
+from ocr.detection_operations import DETECTION_OPERATIONS, TEXT_BBOX_KEYS
 
 
 class RegisterUserSerializer(serializers.ModelSerializer):
@@ -157,7 +159,7 @@ class UploadSerializer(serializers.ModelSerializer):
 class DetectionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Detection
-        fields = ('id', 'image_filename', 'original_detections', 'detections', 'document_parser', 'parsing_postprocessor', 'text_recognizer')
+        fields = ('id', 'image_filename', 'original_detections', 'detections', 'document_parser', 'parsing_postprocessor', 'text_recognizer', 'version')
 
 
 class DetectionFilenameOnlySerializer(serializers.ModelSerializer):
@@ -199,6 +201,70 @@ class CustomOCRSerializer(serializers.Serializer):
         return data
 
 
+class CustomOCRBBoxSerializer(serializers.Serializer):
+    xMin = serializers.FloatField()
+    yMin = serializers.FloatField()
+    xMax = serializers.FloatField()
+    yMax = serializers.FloatField()
+    rotation = serializers.FloatField(default=0.0)
+
+
+class CustomOCRBatchSerializer(serializers.Serializer):
+    detectionId = serializers.IntegerField()
+    bboxes = CustomOCRBBoxSerializer(many=True, allow_empty=False)
+
+    def validate_bboxes(self, bboxes):
+        if len(bboxes) > CUSTOM_OCR_BATCH_MAX_BBOXES:
+            raise serializers.ValidationError(f'At most {CUSTOM_OCR_BATCH_MAX_BBOXES} bboxes can be re-run at once.')
+
+        return bboxes
+
+
+class DetectionOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=DETECTION_OPERATIONS)
+    textId = serializers.CharField(required=False)
+    text = serializers.CharField(required=False, allow_blank=True, trim_whitespace=False)
+    bbox = serializers.DictField(child=serializers.IntegerField(), required=False)
+    detection = serializers.DictField(required=False)
+    afterTextId = serializers.CharField(required=False, allow_null=True)
+
+    def validate(self, data):
+        op = data['op']
+
+        if op == "insert":
+            if 'detection' not in data or 'text_id' not in data['detection']:
+                raise serializers.ValidationError('insert needs a detection with a text_id.')
+            return data
+
+        if 'textId' not in data:
+            raise serializers.ValidationError(f'{op} needs a textId.')
+        if op == "updateText" and 'text' not in data:
+            raise serializers.ValidationError('updateText needs a text.')
+        if op == "moveBbox":
+            if len(data.get('bbox', {})) == 0:
+                raise serializers.ValidationError('moveBbox needs a bbox.')
+            if any(key not in TEXT_BBOX_KEYS for key in data['bbox']):
+                raise serializers.ValidationError(f'bbox keys can only be {", ".join(TEXT_BBOX_KEYS)}.')
+
+        return data
+
+
+class DetectionReplaceSerializer(serializers.Serializer):
+    detections = serializers.JSONField()
+    version = serializers.IntegerField(min_value=0, required=False) # replace only while the detections are at this version
+
+
+class DetectionOperationsSerializer(serializers.Serializer):
+    version = serializers.IntegerField(min_value=0)
+    operations = DetectionOperationSerializer(many=True, allow_empty=False)
+
+    def validate_operations(self, operations):
+        if len(operations) > DETECTION_PATCH_MAX_OPERATIONS:
+            raise serializers.ValidationError(f'At most {DETECTION_PATCH_MAX_OPERATIONS} operations can be sent at once.')
+
+        return operations
+
+
 class MergeUploadsSerializer(serializers.Serializer):
     filename = serializers.CharField()
     uploadIds = serializers.ListField(
@@ -240,6 +306,10 @@ class UploadChangeFilenameSerializer(serializers.Serializer):
         return data
 
 
+class TaskIdSerializer(serializers.Serializer):
+    taskId = serializers.CharField(required=True)
+
+
 class IdSerializer(serializers.Serializer):
     id = serializers.IntegerField(required=True)
 
@@ -0,0 +1,83 @@
+from math import ceil
+from time import time
+from uuid import uuid4
+
+from redis import RedisError
+
+from ocr.models import MIN_SERVICE_API_KEY_REQUESTS_PER_MINUTE, ServiceAPIKey
+from ocr.QueueManager import QueueManager
+from ocr.responses import service_responses
+from ocr_app.settings import SERVICE_JOB_MAX_DURATION, SERVICE_IN_FLIGHT_RETRY_AFTER
+
+
+"""
+Service API keys (X-Lipikar-Service-API-Key header), each with a token bucket of burst requests refilled at
+requests_per_minute, and at most max_in_flight_jobs OCR requests and jobs running at once.
+Both are checked and taken in one Redis script, so concurrent web workers cannot overshoot them.
+"""
+
+
+def new_service_job_id():
+    return uuid4().hex
+
+
+def authenticate_service_request(request, job_id=None):
+    """
+    Returns (service_api_key, None), or (None, error response) for unknown keys and rejected requests.
+    With a job_id the request also takes an in-flight slot of the key, freed by release_service_job.
+    """
+    key = request.META.get('HTTP_X_LIPIKAR_SERVICE_API_KEY', "")
+    service_api_key = ServiceAPIKey.objects.filter(key=key, is_active=True).first() if key else None
+    if service_api_key is None:
+        return None, service_responses['unauthorized']()
+
+    now = time()
+    try:
+        allowed, retry_after, reason = QueueManager.acquire_service_api_key(
+            service_api_key.id,
+            max(MIN_SERVICE_API_KEY_REQUESTS_PER_MINUTE, service_api_key.requests_per_minute) / 60, # keys saved without the validators
+            max(1, service_api_key.burst),
+            now,
+            job_id,
+            service_api_key.max_in_flight_jobs,
+            now + SERVICE_JOB_MAX_DURATION,
+            SERVICE_IN_FLIGHT_RETRY_AFTER,
+        )
+    except RedisError as e: # the limits are not enforced while Redis is down
+        print("Error at ocr.service_api_keys.authenticate_service_request")
+        print(4 * " " + str(e))
+        return service_api_key, None
+
+    if not allowed:
+        return None, service_responses['rateLimited'](reason, ceil(retry_after))
+
+    return service_api_key, None
+
+
+def release_service_job(service_api_key_id, job_id):
+    try:
+        QueueManager.release_service_api_key_job(service_api_key_id, job_id)
+    except RedisError as e: # the slot expires after SERVICE_JOB_MAX_DURATION
+        print("Error at ocr.service_api_keys.release_service_job")
+        print(4 * " " + str(e))
+
+
+def add_service_api_key_usage(service_api_key_id, counter, amount=1):
+    try:
+        QueueManager.increment_service_api_key_usage(service_api_key_id, counter, amount)
+    except RedisError as e:
+        print("Error at ocr.service_api_keys.add_service_api_key_usage")
+        print(4 * " " + str(e))
+
+
+def get_service_api_key_usage(service_api_key_id):
+    "Counters of the key: requests, jobs, pages, rejectedRateLimit, rejectedInFlight and inFlightJobs."
+    usage, num_in_flight_jobs = QueueManager.get_service_api_key_usage(service_api_key_id, time())
+    return {
+        'requests': usage.get('requests', 0),
+        'jobs': usage.get('jobs', 0),
+        'pages': usage.get('pages', 0),
+        'rejectedRateLimit': usage.get('rejectedRateLimit', 0),
+        'rejectedInFlight': usage.get('rejectedInFlight', 0),
+        'inFlightJobs': num_in_flight_jobs,
+    }
@@ -0,0 +1,204 @@
+import ipaddress
+import json
+import socket
+from time import monotonic, sleep, time
+from urllib.parse import urlsplit, urlunsplit
+from uuid import uuid4
+
+import requests
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from requests.adapters import HTTPAdapter
+from requests.utils import get_auth_from_url
+
+from ocr.QueueManager import QueueManager
+from ocr_app.settings import (
+    SERVICE_JOB_CALLBACK_ALLOWED_HOSTS,
+    SERVICE_JOB_TTL,
+    SERVICE_STREAM_POLL_INTERVAL,
+    SERVICE_STREAM_TIMEOUT,
+)
+
+
+"""
+Multi-page OCR jobs of the service API, kept in Redis for SERVICE_JOB_TTL seconds.
+Every page is OCRed by its own task and its result is saved as soon as it finishes, so a job can be
+polled while its other pages are still being processed.
+"""
+
+
+def check_if_address_is_public(address):
+    address = ipaddress.ip_address(address.split("%")[0]) # without the IPv6 scope
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+def resolve_callback_url(callback_url):
+    """
+    The address to connect to for an http(s) callback URL whose host only resolves to public addresses, so
+    that callbacks cannot reach the loopback, private, link-local or reserved networks of the servers.
+    None if the URL is not allowed, and the hostname itself for hosts in SERVICE_JOB_CALLBACK_ALLOWED_HOSTS.
+    """
+    try:
+        URLValidator(schemes=["http", "https"])(callback_url)
+        split_url = urlsplit(callback_url)
+        port = split_url.port or (443 if split_url.scheme == "https" else 80)
+    except (ValidationError, ValueError):
+        return None
+
+    if split_url.hostname in SERVICE_JOB_CALLBACK_ALLOWED_HOSTS:
+        return split_url.hostname
+
+    try:
+        addresses = [address_info[4][0] for address_info in socket.getaddrinfo(split_url.hostname, port, proto=socket.IPPROTO_TCP)]
+    except (OSError, UnicodeError):
+        return None
+
+    if len(addresses) == 0 or not all(check_if_address_is_public(address) for address in addresses):
+        return None
+    return addresses[0]
+
+
+def check_if_callback_url_is_allowed(callback_url):
+    "Checked when the job is created, and post_to_callback_url checks the URL again before every callback."
+    return resolve_callback_url(callback_url) is not None
+
+
+class PinnedHostnameAdapter(HTTPAdapter):
+    "Keeps the TLS server name (SNI) and the certificate check on hostname for requests sent to one of its addresses."
+
+    def __init__(self, hostname, **kwargs):
+        self.hostname = hostname
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self.hostname
+        kwargs['assert_hostname'] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+def post_to_callback_url(callback_url, payload, timeout):
+    """
+    POST payload as JSON to callback_url, connected to the address its host was checked to resolve to, with the
+    original Host header, so that the host cannot resolve to another (private) address between the check and
+    the request. Redirects are not followed, they could point to a host that was never checked.
+    Returns None if the URL is not allowed, otherwise the response, raises requests.RequestException.
+    """
+    address = resolve_callback_url(callback_url)
+    if address is None:
+        return None
+
+    split_url = urlsplit(callback_url)
+    port = split_url.port or (443 if split_url.scheme == "https" else 80)
+    netloc = f"[{address}]:{port}" if ":" in address else f"{address}:{port}"
+
+    with requests.Session() as session:
+        session.mount(f"{split_url.scheme}://", PinnedHostnameAdapter(split_url.hostname))
+        return session.post(
+            urlunsplit((split_url.scheme, netloc, split_url.path, split_url.query, "")),
+            json=payload,
+            headers={'Host': split_url.netloc.rpartition("@")[2]}, # host[:port] as written in the URL
+            auth=get_auth_from_url(callback_url) if split_url.username else None,
+            timeout=timeout,
+            allow_redirects=False
+        )
+
+
+def create_service_job(num_pages, callback_url=None, api_key_id=None, job_id=None):
+    "api_key_id is the Service API Key the job counts against, its in-flight slot is freed once the last page is saved."
+    job_id = job_id or uuid4().hex
+    QueueManager.create_service_job(job_id, num_pages, callback_url, api_key_id, round(time()), SERVICE_JOB_TTL)
+    return job_id
+
+
+def save_service_job_page_result(job_id, page_index, detections=None, error=None):
+    """
+    Save the result of one page. Returns (page_result, job_finished), job_finished is True only for the
+    call that saved the last page of the job.
+    """
+    page_result = {
+        'pageIndex': page_index,
+        'status': "failed" if error is not None else "completed",
+    }
+    if error is not None:
+        page_result['error'] = error
+    else:
+        page_result['detections'] = detections
+
+    num_processed_pages = QueueManager.save_service_job_page_result(job_id, page_index, json.dumps(page_result), error is not None, SERVICE_JOB_TTL)
+
+    job = QueueManager.get_service_job(job_id)
+    job_finished = job is not None and num_processed_pages == int(job['numPages'])
+    if job_finished:
+        QueueManager.update_service_job_status(job_id, "completed")
+        if job['apiKeyId']:
+            QueueManager.release_service_api_key_job(int(job['apiKeyId']), job_id)
+
+    return page_result, job_finished
+
+
+def get_service_job_result(job_id, include_pages=True):
+    "The job status and counters, with the results of the finished pages in page order. None for unknown (or expired) jobs."
+    job = QueueManager.get_service_job(job_id)
+    if job is None:
+        return None
+
+    job_result = {
+        'jobId': job_id,
+        'status': job['status'],
+        'numPages': int(job['numPages']),
+        'numProcessedPages': int(job['numProcessedPages']),
+        'numFailedPages': int(job['numFailedPages']),
+        'createdAt': int(job['createdAt']),
+    }
+
+    if include_pages:
+        page_results = QueueManager.get_service_job_page_results(job_id)
+        job_result['pages'] = [json.loads(page_results[page_index]) for page_index in sorted(page_results.keys())]
+
+    return job_result
+
+
+def check_if_service_job_belongs_to_api_key(job_id, api_key_id):
+    job = QueueManager.get_service_job(job_id)
+    return job is not None and job['apiKeyId'] == str(api_key_id)
+
+
+def get_service_job_callback_url(job_id):
+    job = QueueManager.get_service_job(job_id)
+    return (job['callbackUrl'] or None) if job is not None else None
+
+
+def iter_service_job_page_results(job_id, num_pages, order="page", poll_interval=SERVICE_STREAM_POLL_INTERVAL, timeout=SERVICE_STREAM_TIMEOUT):
+    """
+    Yields the page results of a job as the pages finish, in page order ("page") or in the order the pages
+    finished ("completion"). Once timeout seconds have passed, yields the pages finished so far and stops.
+    """
+    deadline = monotonic() + timeout
+    num_completed_pages = 0
+    buffered_page_results = {} # pages finished before an earlier page, in page order
+    next_page_index = 0
+
+    while num_completed_pages < num_pages:
+        completed_page_indices = QueueManager.get_service_job_completed_pages(job_id, num_completed_pages)
+        if len(completed_page_indices) == 0:
+            if monotonic() >= deadline:
+                for page_index in sorted(buffered_page_results.keys()):
+                    yield json.loads(buffered_page_results[page_index])
+                return
+            sleep(poll_interval)
+            continue
+
+        num_completed_pages += len(completed_page_indices)
+        page_results_json = QueueManager.get_service_job_page_results_by_index(job_id, completed_page_indices)
+
+        for page_index, page_result_json in zip(completed_page_indices, page_results_json):
+            if order == "completion":
+                yield json.loads(page_result_json)
+                continue
+
+            buffered_page_results[page_index] = page_result_json
+            while next_page_index in buffered_page_results:
+                yield json.loads(buffered_page_results.pop(next_page_index))
+                next_page_index += 1
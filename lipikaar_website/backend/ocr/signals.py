@@ -0,0 +1,12 @@
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from ocr.models import CustomUser, Upload
+
+
+@receiver(post_save, sender=Upload)
+@receiver(post_delete, sender=Upload)
+def increment_uploads_version(sender, instance, **kwargs):
+    "Invalidates the ETags of the uploads listings of the user, see ocr/etags.py."
+    CustomUser.objects.filter(id=instance.user_id).update(uploads_version=F('uploads_version') + 1)
@@ -1,20 +1,37 @@
-from celery import shared_task
+from celery import shared_task, chord
 from time import sleep
 import os
 import json
+import requests
 
-from ocr_app.settings import CACHE_ROOT, MEDIA_ROOT
+from django.db.models import F
+
+from ocr_app.settings import (
+    CACHE_ROOT,
+    MEDIA_ROOT,
+    NEW_UPLOAD_PROCESSING_MODE,
+    NEW_UPLOAD_PAGES_PER_TASK,
+    PAGE_OCR_CACHE_HIT_CREDITS,
+    SERVICE_JOB_CALLBACK_TIMEOUT,
+    SERVICE_JOB_CALLBACK_MAX_RETRIES,
+)
 from .models import Upload, Detection, CustomUser
-from ocr.language_ocr_models.main import OCR
-ocr_instance = OCR()
+from ocr.language_ocr_models.main import ocr_instance
 from ocr.cloud_storage import upload_to_cloud_storage_from_cache
 from ocr.utils import generate_processing_status_string, upload_processing_status_generators
 from ocr.cache import delete_multiple_files_from_cache
+from ocr.db_utils import set_upload_pages
 # from ocr.redis import (
 #     redis_set_methods,
 #     redis_map_methods,
 # )
 from ocr.QueueManager import QueueManager
+from ocr.service_jobs import (
+    post_to_callback_url,
+    save_service_job_page_result,
+    get_service_job_result,
+    get_service_job_callback_url,
+)
 
 
 @shared_task(bind=True)
@@ -56,12 +73,13 @@ def perform_ocr_for_new_upload(
         image_filename = image_filenames[0]
         image_path = os.path.join(CACHE_ROOT, image_filename)
 
-        detections = ocr_instance.perform_ocr_on_full_image(
+        detections, is_cached = ocr_instance.perform_ocr_on_full_image(
             upload_object.id,
             image_path,
             current_image_num,
             num_total_images,
-            ocr_config
+            ocr_config,
+            return_cache_status=True
         )
         new_detection = Detection.objects.create(
             user=user,
@@ -71,7 +89,8 @@ def perform_ocr_for_new_upload(
             parsing_postprocessor="no_postprocessor",
             text_recognizer=json.dumps(ocr_config['text_recognizer']),
             original_detections=json.dumps(detections),
-            detections=json.dumps(detections)
+            detections=json.dumps(detections),
+            page_index=len(detection_ids)
         )
         detection_ids.append(new_detection.id)
 
@@ -89,8 +108,10 @@ def perform_ocr_for_new_upload(
             return f"Failed to upload image: {image_filename} from Cache to Cloud Storage. Upload id: {upload_id}"
 
         image_filenames.pop(0)
-        user.credits = user.credits - 1.0
-        user.save()
+        page_credits = get_page_credits(is_cached)
+        if page_credits != 0:
+            # update only the credits column, a full save would write back the stale uploads_version
+            CustomUser.objects.filter(id=user.id).update(credits=F('credits') - page_credits)
 
         if len(image_filenames) == 0:
             upload_object.processing_status = upload_processing_status_generators['completed']()
@@ -128,6 +149,224 @@ def perform_ocr_for_new_upload(
         print(e)
         return False
 
+def queue_ocr_for_new_upload(upload_id, user_id, image_filenames, ocr_config):
+    """
+    Queue OCR for all the pages of a new upload.
+    fan_out: every chunk of NEW_UPLOAD_PAGES_PER_TASK pages becomes its own task, and
+    finalize_ocr_for_new_upload collects the detections in page order once all of them finish.
+    serial: perform_ocr_for_new_upload processes one page and re-queues itself for the rest.
+    """
+    num_total_images = len(image_filenames)
+
+    if NEW_UPLOAD_PROCESSING_MODE == "serial":
+        return perform_ocr_for_new_upload.delay(
+            upload_id,
+            user_id,
+            1,
+            num_total_images,
+            image_filenames,
+            ocr_config
+        )
+
+    pages_per_task = max(1, NEW_UPLOAD_PAGES_PER_TASK)
+    page_tasks = []
+    for start in range(0, num_total_images, pages_per_task):
+        chunk_image_filenames = image_filenames[start : start + pages_per_task]
+        page_tasks.append(perform_ocr_for_upload_pages.s(
+            upload_id,
+            user_id,
+            list(range(start + 1, start + len(chunk_image_filenames) + 1)),
+            num_total_images,
+            chunk_image_filenames,
+            ocr_config
+        ))
+
+    finalize_task = finalize_ocr_for_new_upload.s(upload_id, num_total_images).on_error(mark_new_upload_as_errored.s(upload_id))
+    return chord(page_tasks)(finalize_task)
+
+
+def get_page_credits(is_cached):
+    "Credits charged for one page, pages served from the page OCR cache are charged PAGE_OCR_CACHE_HIT_CREDITS."
+    return PAGE_OCR_CACHE_HIT_CREDITS if is_cached else 1.0
+
+
+def save_ocr_for_upload_page(user, upload_object, image_filename, detections, ocr_config, is_cached=False):
+    """
+    Save the detections of one page of an upload and charge the user for it.
+    Returns the id of the new Detection, or None if the page image could not be moved to cloud storage.
+    """
+    new_detection = Detection.objects.create(
+        user=user,
+        upload=upload_object,
+        image_filename=os.path.basename(image_filename),
+        document_parser=json.dumps(ocr_config['document_parser']),
+        parsing_postprocessor="no_postprocessor",
+        text_recognizer=json.dumps(ocr_config['text_recognizer']),
+        original_detections=json.dumps(detections),
+        detections=json.dumps(detections)
+    )
+
+    if not upload_to_cloud_storage_from_cache(os.path.basename(image_filename), "detection_images"):
+        new_detection.delete()
+        print(f"Failed to upload image: {image_filename} from Cache to Cloud Storage. Upload id: {upload_object.id}")
+        return None
+
+    # pages of the same upload run concurrently, so the credit update has to be atomic
+    page_credits = get_page_credits(is_cached)
+    if page_credits != 0:
+        CustomUser.objects.filter(id=user.id).update(credits=F('credits') - page_credits)
+
+    return new_detection.id
+
+
+@shared_task(bind=True)
+def perform_ocr_for_upload_pages(
+        self,
+        upload_id,
+        user_id,
+        page_nums,
+        num_total_images,
+        image_filenames,
+        ocr_config
+    ):
+    """
+    Fan-out part of queue_ocr_for_new_upload. The pages of the chunk go through the OCR page pipeline,
+    so the next page is parsed while the current one is being recognized.
+    Returns one entry per page: the new Detection id, or None if the page was skipped or failed.
+    Never raises, so that finalize_ocr_for_new_upload always runs: a failure marks the remaining pages as failed.
+    """
+    page_detection_ids = []
+    try:
+        ocr_upload_pages(upload_id, user_id, page_nums, num_total_images, image_filenames, ocr_config, page_detection_ids)
+    except Exception as e:
+        print(f"Exception in running OCR for pages {page_nums} of Upload id: {upload_id}")
+        print(e)
+        delete_multiple_files_from_cache(image_filenames[len(page_detection_ids):])
+        page_detection_ids += [None] * (len(image_filenames) - len(page_detection_ids))
+
+    return page_detection_ids
+
+
+def ocr_upload_pages(upload_id, user_id, page_nums, num_total_images, image_filenames, ocr_config, page_detection_ids):
+    "Body of perform_ocr_for_upload_pages, appends the result of every page to page_detection_ids as soon as it is saved."
+    try:
+        user = CustomUser.objects.get(id=user_id)
+        upload_object = Upload.objects.get(id=upload_id)
+    except (CustomUser.DoesNotExist, Upload.DoesNotExist):
+        delete_multiple_files_from_cache(image_filenames)
+        page_detection_ids += [None] * len(image_filenames)
+        return
+
+    def get_image_paths_until_cancelled():
+        for image_filename in image_filenames:
+            if QueueManager.check_if_upload_is_cancelled(upload_id): # the upload was cancelled, skip the remaining pages
+                return
+            yield os.path.join(CACHE_ROOT, image_filename)
+
+    image_path_page_nums = {os.path.join(CACHE_ROOT, image_filename): page_num for page_num, image_filename in zip(page_nums, image_filenames)}
+
+    def update_processing_page_status(image_path):
+        if not QueueManager.check_if_upload_is_cancelled(upload_id):
+            processing_page_status = upload_processing_status_generators['processing_page'](image_path_page_nums[image_path], num_total_images)
+            QueueManager.update_upload_processing_status(upload_id, processing_page_status)
+
+    page_results = ocr_instance.perform_ocr_on_multiple_images(
+        get_image_paths_until_cancelled(),
+        ocr_config,
+        on_page_start=update_processing_page_status
+    )
+
+    try:
+        for page_num, image_filename in zip(page_nums, image_filenames):
+            page_result = next(page_results, None)
+            if page_result is None: # the upload was cancelled before this page was parsed
+                delete_multiple_files_from_cache([image_filename])
+                page_detection_ids.append(None)
+                continue
+
+            ocr_result, error = page_result
+            try:
+                if error is not None:
+                    raise error
+                detections, is_cached = ocr_result
+                detection_id = save_ocr_for_upload_page(user, upload_object, image_filename, detections, ocr_config, is_cached)
+            except Exception as e:
+                print(f"Exception in running OCR for page {page_num} of Upload id: {upload_id}")
+                print(e)
+                delete_multiple_files_from_cache([image_filename])
+                detection_id = None
+
+            page_detection_ids.append(detection_id)
+
+            num_processed_pages = QueueManager.increment_num_processed_pages(upload_id)
+            if num_processed_pages < num_total_images and not QueueManager.check_if_upload_is_cancelled(upload_id):
+                progress_processing_status = upload_processing_status_generators['processed_page'](num_processed_pages, num_total_images)
+                QueueManager.update_upload_processing_status(upload_id, progress_processing_status)
+    finally:
+        page_results.close()
+
+
+@shared_task
+def mark_new_upload_as_errored(request, exc, traceback, upload_id):
+    """
+    Error callback of finalize_ocr_for_new_upload, for when the chord failed anyway (e.g. a page task was lost).
+    The saved pages are kept in the order they were created.
+    """
+    print(f"Exception in running OCR for new upload. Upload id: {upload_id}")
+    print(exc)
+
+    try:
+        upload_object = Upload.objects.get(id=upload_id)
+        set_upload_pages(upload_object, list(Detection.objects.filter(upload=upload_object).order_by('id').values_list('id', flat=True)))
+        upload_object.processing_status = upload_processing_status_generators['errored']()
+        upload_object.is_cancelled = False
+        upload_object.save()
+    except Upload.DoesNotExist:
+        pass
+    finally:
+        QueueManager.clear_num_processed_pages(upload_id)
+        QueueManager.remove_cancelled_upload(upload_id)
+        QueueManager.mark_upload_as_processed(upload_id)
+
+
+@shared_task(bind=True)
+def finalize_ocr_for_new_upload(
+        self,
+        chunks_detection_ids,
+        upload_id,
+        num_total_images
+    ):
+    "Fan-in part of queue_ocr_for_new_upload, called with the results of all perform_ocr_for_upload_pages tasks."
+    page_detection_ids = [detection_id for chunk_detection_ids in chunks_detection_ids for detection_id in chunk_detection_ids]
+
+    QueueManager.clear_num_processed_pages(upload_id)
+
+    try:
+        upload_object = Upload.objects.get(id=upload_id)
+    except:
+        QueueManager.mark_upload_as_processed(upload_id)
+        return False
+
+    set_upload_pages(upload_object, [detection_id for detection_id in page_detection_ids if detection_id is not None])
+
+    if QueueManager.check_if_upload_is_cancelled(upload_id):
+        upload_object.processing_status = upload_processing_status_generators['cancelled']()
+        upload_object.is_cancelled = True
+        QueueManager.remove_cancelled_upload(upload_id)
+        result_message = f"Upload cancelled, not processing further pages. Upload id: {upload_id}"
+    elif None in page_detection_ids:
+        upload_object.processing_status = upload_processing_status_generators['errored']()
+        result_message = f"Failed to process {page_detection_ids.count(None)} of {num_total_images} pages. Upload id: {upload_id}"
+    else:
+        upload_object.processing_status = upload_processing_status_generators['completed']()
+        result_message = f"Finished processing from Upload id: {upload_id}. Processed {num_total_images} images."
+
+    upload_object.save()
+    QueueManager.mark_upload_as_processed(upload_id)
+
+    print(result_message)
+    return result_message
+
 @shared_task(bind=True)
 def re_run_ocr_for_bbox(
         self,
@@ -152,16 +391,76 @@ def re_run_ocr_for_bbox(
         print(e)
         return "" # return empty string
 
+@shared_task(bind=True)
+def re_run_ocr_for_bboxes(
+        self,
+        image_filename,
+        bboxes,
+        text_recognizer
+    ):
+    try:
+        image_path = os.path.join(MEDIA_ROOT, "detection_images", image_filename)
+
+        recognized_texts = ocr_instance.perform_ocr_for_bboxes(
+            image_path,
+            bboxes,
+            text_recognizer
+        )
+        return recognized_texts
+    except Exception as e:
+        print("Exception in rerunning OCR")
+        print(e)
+        return [""] * len(bboxes) # return empty strings
+
+def run_ocr_for_service(image_filenames, ocr_config):
+    """
+    OCR the single image of a service request and delete every image of the request from the cache, even if
+    OCR fails. Runs in perform_ocr_for_service, or inline in the web process.
+    """
+    image_path = os.path.join(CACHE_ROOT, image_filenames[0])
+
+    try:
+        return ocr_instance.perform_ocr_on_full_image(
+            None,
+            image_path,
+            None,
+            None,
+            ocr_config
+        )
+    finally:
+        delete_multiple_files_from_cache([os.path.basename(image_filename) for image_filename in image_filenames])
+
 @shared_task(bind=True)
 def perform_ocr_for_service(
         self,
         image_filenames,
         ocr_config
     ):
-    # try:
-        image_filename = image_filenames[0]
-        image_path = os.path.join(CACHE_ROOT, image_filename)
+    return run_ocr_for_service(image_filenames, ocr_config)
 
+
+def queue_ocr_for_service_job(job_id, image_filenames, ocr_config):
+    "Queue one perform_ocr_for_service_job_page task per page, so the pages of a job are processed in parallel."
+    for page_index, image_filename in enumerate(image_filenames):
+        perform_ocr_for_service_job_page.delay(job_id, page_index, image_filename, ocr_config)
+
+
+@shared_task(bind=True)
+def perform_ocr_for_service_job_page(
+        self,
+        job_id,
+        page_index,
+        image_filename,
+        ocr_config
+    ):
+    """
+    OCR one page of a service job and save its result right away.
+    With a callback URL, the page result is posted to it, and so is the whole job once its last page is saved.
+    """
+    image_path = os.path.join(CACHE_ROOT, image_filename)
+
+    detections = None
+    try:
         detections = ocr_instance.perform_ocr_on_full_image(
             None,
             image_path,
@@ -169,11 +468,41 @@ def perform_ocr_for_service(
             None,
             ocr_config
         )
-
+    except Exception as e:
+        print(f"Exception in performing OCR for page {page_index} of service job {job_id}")
+        print(e)
+    finally:
         delete_multiple_files_from_cache([os.path.basename(image_filename)])
 
-        return detections
-    # except Exception as e:
-    #     print("Exception in performing OCR for service.")
-    #     print(e)
-    #     return False
+    # saved once, outside the try, so a Redis error while saving is not retried as a failed page
+    if detections is not None:
+        page_result, job_finished = save_service_job_page_result(job_id, page_index, detections=detections)
+    else:
+        page_result, job_finished = save_service_job_page_result(job_id, page_index, error="Failed to perform OCR on page.")
+
+    callback_url = get_service_job_callback_url(job_id)
+    if callback_url is not None:
+        send_service_job_callback.delay(callback_url, {'jobId': job_id, 'event': "page", 'page': page_result})
+        if job_finished:
+            send_service_job_callback.delay(callback_url, {'jobId': job_id, 'event': "completed", 'job': get_service_job_result(job_id)})
+
+    return page_result['status']
+
+
+@shared_task(bind=True, max_retries=SERVICE_JOB_CALLBACK_MAX_RETRIES)
+def send_service_job_callback(self, callback_url, payload):
+    try:
+        response = post_to_callback_url(callback_url, payload, SERVICE_JOB_CALLBACK_TIMEOUT)
+        if response is None:
+            print("Error at ocr.tasks.send_service_job_callback")
+            print(4 * " " + f"Not posting {payload['event']} of service job {payload['jobId']}, {callback_url} does not resolve to a public host")
+            return False
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print("Error at ocr.tasks.send_service_job_callback")
+        print(4 * " " + f"Failed to post {payload['event']} of service job {payload['jobId']} to {callback_url}: {e}")
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=2 ** self.request.retries * 5)
+        return False
+
+    return True
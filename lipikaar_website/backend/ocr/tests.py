@@ -1,3 +1,703 @@
-from django.test import TestCase
+import json
+import os
+import socket
+import threading
+import zlib
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from random import Random
+from tempfile import TemporaryDirectory
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
+import numpy
+from PIL import Image
+from rest_framework.test import APIClient
+
+from ocr.detections_storage import (
+    COLUMNS_FORMAT,
+    COMPACT_DETECTIONS_MAGIC,
+    check_if_detections_are_compact,
+    decode_detections,
+    encode_detections,
+)
+from ocr import tasks
+from ocr.detection_operations import apply_detection_operations
+from ocr.celery import app as celery_app
+from ocr.etags import generate_uploads_etag
+from ocr.inline_ocr import InlineOCRExecutor
+from ocr.language_ocr_models.batch_size_controller import AdaptiveBatchSizeController
+from ocr.language_ocr_models.bboxes import BBoxArray
+from ocr.language_ocr_models.crop_text_cache import CropTextCache
+from ocr.language_ocr_models.main import ocr_instance
+from ocr.language_ocr_models.parsing_postprocessors import (
+    get_line_components,
+    get_line_components_with_pairwise_checks,
+    parsing_postprocessors,
+)
+from ocr.language_ocr_models.text_recognizers import LipikarULCA_TextRecognizerClient
+from ocr.language_ocr_models.utils import crop_bboxes_from_image, crop_bboxes_from_image_with_full_page_warps
+from ocr.management.commands.startup import create_default_service_api_key
+from ocr.models import CustomUser, Detection, PageOCRCacheEntry, ServiceAPIKey, Upload
+from ocr.page_ocr_cache import get_page_ocr_cache_key, save_page_detections_to_cache
+from ocr.QueueManager import QueueManager
+from ocr.service_api_keys import authenticate_service_request, release_service_job
+from ocr.service_jobs import (
+    check_if_service_job_belongs_to_api_key,
+    create_service_job,
+    iter_service_job_page_results,
+    post_to_callback_url,
+    save_service_job_page_result,
+)
+from ocr.views.services import generate_service_ocr_ndjson
+
+try:
+    import fakeredis
+    import lupa # runs the Lua scripts of fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def generate_crops(num_crops):
+    return [Image.new("RGB", (8, 4), (crop_num, 0, 0)) for crop_num in range(num_crops)]
+
+
+class CropTextCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.crop_text_cache = CropTextCache(max_entries=100, redis_url="")
+        self.client = LipikarULCA_TextRecognizerClient(
+            crop_text_cache=self.crop_text_cache,
+            micro_batching=False,
+            adaptive_batch_size=False,
+        )
+        self.sent_images = []
+
+    def recognize_images_in_batches(self, images, model_id, failed=False):
+        self.sent_images.append(images)
+        texts = ["" if failed else f"text-{image.getpixel((0, 0))[0]}" for image in images]
+        return texts, [not failed] * len(images), int(failed)
+
+    def recognize(self, images, model_version="1", failed=False):
+        with mock.patch.object(
+            self.client,
+            'recognize_images_in_batches',
+            side_effect=lambda images, model_id: self.recognize_images_in_batches(images, model_id, failed),
+        ):
+            return self.client.recognize_images(images, "recognizer", model_version)
+
+    def test_miss_then_hit(self):
+        crops = generate_crops(3)
+        self.assertEqual(self.recognize(crops), (["text-0", "text-1", "text-2"], 0))
+        self.assertEqual(self.recognize(crops), (["text-0", "text-1", "text-2"], 0))
+
+        self.assertEqual(len(self.sent_images), 1)
+        stats = self.crop_text_cache.get_stats()
+        self.assertEqual((stats['localHits'], stats['misses']), (3, 3))
+
+    def test_identical_crops_are_sent_once(self):
+        crops = generate_crops(2)
+        self.assertEqual(self.recognize(crops + crops)[0], ["text-0", "text-1", "text-0", "text-1"])
+        self.assertEqual(len(self.sent_images[0]), 2)
+
+    def test_failed_batch_is_not_cached(self):
+        crops = generate_crops(2)
+        self.assertEqual(self.recognize(crops, failed=True), (["", ""], 1))
+        self.assertEqual(self.recognize(crops), (["text-0", "text-1"], 0))
+        self.assertEqual(len(self.sent_images), 2)
+
+    def test_new_model_version_misses(self):
+        crops = generate_crops(2)
+        self.recognize(crops, model_version="1")
+        self.recognize(crops, model_version="2")
+        self.assertEqual(len(self.sent_images), 2)
+
+    def test_model_without_version_is_not_cached(self):
+        crops = generate_crops(2)
+        self.recognize(crops, model_version=None)
+        self.recognize(crops, model_version=None)
+        self.assertEqual(len(self.sent_images), 2)
+        self.assertEqual(self.crop_text_cache.get_stats()['entries'], 0)
+
+    @skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_redis_level_is_shared_and_versioned(self):
+        redis_client = fakeredis.FakeRedis()
+        worker_caches = [CropTextCache(max_entries=100, redis_url="") for _ in range(2)]
+        for worker_cache in worker_caches:
+            worker_cache.redis_client = redis_client
+
+        worker_caches[0].set_many("recognizer", "1", {"hash": "text"})
+        self.assertEqual(worker_caches[1].get_many("recognizer", "1", ["hash"]), {"hash": "text"})
+        self.assertEqual(worker_caches[1].get_many("recognizer", "2", ["hash"]), {})
+        self.assertEqual(worker_caches[1].get_stats()['redisHits'], 1)
+        self.assertIsNotNone(redis_client.ttl("crop_texts:recognizer:1:hash"))
+
+    def test_redis_level_is_off_without_url(self):
+        self.assertIsNone(CropTextCache(redis_url="").redis_client)
+
+
+class AdaptiveBatchSizeControllerTests(SimpleTestCase):
+    def setUp(self):
+        self.controller = AdaptiveBatchSizeController(initial_batch_size=32, min_batch_size=8, max_batch_size=64, target_latency=2.0)
+
+    def test_fast_full_batches_grow(self):
+        self.controller.record("model", 32, 1.0, True)
+        self.assertEqual(self.controller.get_batch_size("model"), 40)
+
+        self.controller.record("model", 10, 0.1, True) # not full, says nothing about larger batches
+        self.assertEqual(self.controller.get_batch_size("model"), 40)
+
+        for _ in range(5):
+            self.controller.record("model", 64, 0.5, True)
+        self.assertEqual(self.controller.get_batch_size("model"), 64) # up to max_batch_size
+        self.assertEqual(self.controller.get_batch_size("other model"), 32)
+
+    def test_slow_and_failed_batches_shrink(self):
+        self.controller.record("model", 32, 4.0, True)
+        self.assertEqual(self.controller.get_batch_size("model"), 16) # in proportion to the latency
+
+        self.controller.record("model", 16, 2.1, True)
+        self.assertEqual(self.controller.get_batch_size("model"), 15) # by at least one
+
+        self.controller.record("model", 15, 0.5, False)
+        self.assertEqual(self.controller.get_batch_size("model"), 8) # halved, down to min_batch_size
+
+        self.controller.record("model", 8, 0.5, False)
+        self.assertEqual(self.controller.get_batch_size("model"), 8)
+        self.assertEqual(self.controller.get_stats()['models']['model']['numFailedRequests'], 2)
+
+    def test_batch_size_0(self):
+        self.assertEqual(AdaptiveBatchSizeController(initial_batch_size=0, max_batch_size=64).get_batch_size("model"), 64)
+
+        client = LipikarULCA_TextRecognizerClient(batch_size=0, crop_text_cache=None, micro_batching=False, adaptive_batch_size=False)
+        self.addCleanup(client.batch_executor.shutdown)
+        with mock.patch.object(client, 'get_checked_texts_for_batch', side_effect=lambda images, model_id: ["text"] * len(images)) as get_checked_texts_for_batch:
+            self.assertEqual(client.get_texts_for_images(generate_crops(300), "model"), ["text"] * 300)
+        self.assertEqual(get_checked_texts_for_batch.call_count, 1) # the whole page in one request
+
+
+class BBoxArrayTests(SimpleTestCase):
+    bboxes = [
+        {'x_min': 10, 'y_min': 12, 'x_max': 60, 'y_max': 30, 'rotation': 0.0, 'line_index': 0, 'word_index': 0, 'text_language': "hindi"},
+        {'x_min': 60.75, 'y_min': 143.5, 'x_max': 64.25, 'y_max': 150.125, 'rotation': -12.0, 'line_index': 0, 'word_index': 1, 'text_language': "hindi"},
+        {'x_min': 100, 'y_min': 50.5, 'x_max': 170, 'y_max': 80, 'rotation': 7.5, 'line_index': 1, 'word_index': 0, 'text_language': "english"},
+    ]
+
+    def test_round_trip(self):
+        bboxes = BBoxArray.from_dicts(self.bboxes).to_dicts()
+        self.assertEqual(bboxes, self.bboxes)
+        self.assertEqual([type(bbox['x_min']) for bbox in bboxes], [int, float, int]) # coordinates are not truncated
+
+    def test_crops_match_the_full_page_warps(self):
+        image = numpy.random.default_rng(0).integers(0, 255, (300, 200, 3), dtype=numpy.uint8)
+        cropped_images = crop_bboxes_from_image(image, BBoxArray.from_dicts(self.bboxes))
+        reference_cropped_images = crop_bboxes_from_image_with_full_page_warps(image, self.bboxes)
+        for cropped_image, reference_cropped_image in zip(cropped_images, reference_cropped_images):
+            numpy.testing.assert_array_equal(cropped_image, reference_cropped_image)
+
+
+class ParsingPostprocessorTests(SimpleTestCase):
+    bboxes = [
+        {'x_min': 0, 'y_min': 0, 'x_max': 40, 'y_max': 20},
+        {'x_min': 50, 'y_min': 30, 'x_max': 90, 'y_max': 50},
+        {'x_min': 100, 'y_min': 10, 'x_max': 140, 'y_max': 40}, # on the same line as 0 and 1, only joins the line of 0
+        {'x_min': 150, 'y_min': 2, 'x_max': 190, 'y_max': 22},
+        {'x_min': 0, 'y_min': 100, 'x_max': 30, 'y_max': 101}, # inside 5, but overlaps it by less than 20% of their heights
+        {'x_min': 40, 'y_min': 90, 'x_max': 80, 'y_max': 130},
+        {'x_min': 90, 'y_min': 95, 'x_max': 130, 'y_max': 120},
+        {'x_min': 60, 'y_min': 35, 'x_max': 70, 'y_max': 48}, # on the same line as 1, joins the line of 0 through 2
+    ]
+    lines = [[0, 2, 3, 7], [1], [4], [5, 6]]
+
+    def test_line_components(self):
+        self.assertEqual(get_line_components_with_pairwise_checks(self.bboxes), self.lines)
+        self.assertEqual(get_line_components(self.bboxes), self.lines)
+        self.assertEqual(parsing_postprocessors['default'].process_bboxes(None, self.bboxes), [
+            {'x_min': 0, 'y_min': 0, 'x_max': 190, 'y_max': 48},
+            {'x_min': 50, 'y_min': 30, 'x_max': 90, 'y_max': 50},
+            {'x_min': 0, 'y_min': 100, 'x_max': 30, 'y_max': 101},
+            {'x_min': 40, 'y_min': 90, 'x_max': 130, 'y_max': 130},
+        ])
+
+    def test_line_components_match_the_pairwise_checks(self):
+        random = Random(0)
+        for _ in range(200):
+            bboxes = []
+            for _ in range(random.randint(0, 30)):
+                x_min, y_min = random.randint(0, 200), random.randint(0, 100)
+                bboxes.append({'x_min': x_min, 'y_min': y_min, 'x_max': x_min + random.randint(1, 40), 'y_max': y_min + random.randint(1, 30)})
+
+            pairwise_lines = [sorted(line) for line in get_line_components_with_pairwise_checks(bboxes)]
+            self.assertEqual(get_line_components(bboxes), pairwise_lines)
+
+
+class InlineOCRExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = InlineOCRExecutor(max_concurrency=2)
+        self.addCleanup(self.executor.executor.shutdown)
+
+    def test_try_submit_returns_none_when_saturated(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        busy_futures = [self.executor.try_submit(release.wait, 5) for _ in range(2)]
+        self.assertNotIn(None, busy_futures)
+        self.assertIsNone(self.executor.try_submit(lambda: "inline"))
+
+        release.set()
+        for future in busy_futures:
+            future.result(timeout=5)
+
+        future = self.executor.try_submit(lambda: "inline")
+        self.assertIsNotNone(future)
+        self.assertEqual(future.result(timeout=5), "inline")
+
+    def test_failed_call_releases_its_slot(self):
+        def fail():
+            raise ValueError("Failed to perform OCR.")
+
+        for _ in range(3):
+            future = self.executor.try_submit(fail)
+            self.assertIsNotNone(future)
+            with self.assertRaises(ValueError):
+                future.result(timeout=5)
+
+
+@skipIf(fakeredis is None, "fakeredis (with lupa) is not installed")
+class ServiceAPIKeyTests(TestCase):
+    def setUp(self):
+        redis_client_patcher = mock.patch.object(QueueManager, 'redis_client', fakeredis.FakeRedis())
+        redis_client_patcher.start()
+        self.addCleanup(redis_client_patcher.stop)
+
+        self.now = 1000.0
+        time_patcher = mock.patch('ocr.service_api_keys.time', side_effect=lambda: self.now)
+        time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+
+        self.service_api_key = ServiceAPIKey.objects.create(name="test", requests_per_minute=60.0, burst=2, max_in_flight_jobs=1)
+
+    def authenticate(self, job_id=None):
+        request = RequestFactory().post("/", HTTP_X_LIPIKAR_SERVICE_API_KEY=self.service_api_key.key)
+        return authenticate_service_request(request, job_id)
+
+    def test_token_bucket(self):
+        self.assertIsNone(self.authenticate()[1])
+        self.assertIsNone(self.authenticate()[1])
+
+        _, error_response = self.authenticate()
+        self.assertEqual(error_response.status_code, 429)
+        self.assertEqual(error_response['Retry-After'], "1")
+
+        self.now += 1 # one token refilled
+        self.assertIsNone(self.authenticate()[1])
+
+        acquire_script = QueueManager.registered_scripts['acquire_service_api_key_script']
+        self.assertEqual(QueueManager.redis_client.script_exists(acquire_script.sha), [True])
+
+    def test_rejected_bucket_expires(self):
+        bucket_key = f"service_api_key_buckets:{self.service_api_key.id}"
+        for _ in range(3):
+            self.authenticate()
+        QueueManager.redis_client.persist(bucket_key)
+
+        self.assertEqual(self.authenticate()[1].status_code, 429)
+        self.assertEqual(QueueManager.redis_client.ttl(bucket_key), 62) # ceil(burst / rate) + 60
+
+    def test_default_key_is_created_once(self):
+        ServiceAPIKey.objects.all().delete()
+        self.assertFalse(create_default_service_api_key(""))
+        self.assertTrue(create_default_service_api_key("shared-key"))
+        self.assertFalse(create_default_service_api_key("other-key"))
+        self.assertEqual(list(ServiceAPIKey.objects.values_list('name', 'key')), [("default", "shared-key")])
+
+    def test_in_flight_slot_is_released(self):
+        self.assertIsNone(self.authenticate("job-1")[1])
+        self.assertEqual(self.authenticate("job-2")[1].status_code, 429)
+
+        self.now += 1
+        release_service_job(self.service_api_key.id, "job-1")
+        self.assertIsNone(self.authenticate("job-2")[1])
+
+    def test_unknown_key(self):
+        request = RequestFactory().post("/", HTTP_X_LIPIKAR_SERVICE_API_KEY="unknown")
+        self.assertEqual(authenticate_service_request(request)[1].status_code, 401)
+
+    def test_job_belongs_to_its_key(self):
+        job_id = create_service_job(1, api_key_id=self.service_api_key.id)
+        self.assertTrue(check_if_service_job_belongs_to_api_key(job_id, self.service_api_key.id))
+        self.assertFalse(check_if_service_job_belongs_to_api_key(job_id, self.service_api_key.id + 1))
+        self.assertFalse(check_if_service_job_belongs_to_api_key("unknown", self.service_api_key.id))
+
+    def test_key_saved_without_refill(self):
+        ServiceAPIKey.objects.filter(id=self.service_api_key.id).update(requests_per_minute=0.0)
+        self.assertIsNone(self.authenticate()[1])
+
+    def test_limits_are_validated(self):
+        for limits in [{'requests_per_minute': 0.0}, {'burst': 0}]:
+            service_api_key = ServiceAPIKey(name="invalid", **limits)
+            with self.assertRaises(ValidationError):
+                service_api_key.full_clean()
+
+
+class CallbackRecorder(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.requests.append((self.headers['Host'], json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+        self.send_response(200)
+        self.send_header('Content-Length', "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ServiceJobCallbackTests(SimpleTestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), CallbackRecorder)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_callback_connects_to_the_checked_address(self):
+        getaddrinfo = socket.getaddrinfo
+        resolved_hosts = []
+
+        def rebinding_getaddrinfo(host, *args, **kwargs):
+            # the callback host resolves once, any later lookup would have given a private address
+            if host == "callback.example":
+                resolved_hosts.append(host)
+                return getaddrinfo("127.0.0.1" if len(resolved_hosts) == 1 else "10.0.0.1", *args, **kwargs)
+            return getaddrinfo(host, *args, **kwargs)
+
+        callback_url = f"http://callback.example:{self.server.server_port}/jobs?id=1"
+        with mock.patch('socket.getaddrinfo', side_effect=rebinding_getaddrinfo), \
+                mock.patch('ocr.service_jobs.check_if_address_is_public', side_effect=lambda address: address != "10.0.0.1"):
+            response = post_to_callback_url(callback_url, {'jobId': "1"}, 5)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(resolved_hosts, ["callback.example"])
+        self.assertEqual(self.server.requests, [(f"callback.example:{self.server.server_port}", {'jobId': "1"})])
+
+    def test_private_callback_is_not_posted(self):
+        self.assertIsNone(post_to_callback_url(f"http://127.0.0.1:{self.server.server_port}/", {'jobId': "1"}, 5))
+        self.assertEqual(self.server.requests, [])
+
+
+@skipIf(fakeredis is None, "fakeredis (with lupa) is not installed")
+class ServiceOCRStreamTests(SimpleTestCase):
+    def setUp(self):
+        redis_client_patcher = mock.patch.object(QueueManager, 'redis_client', fakeredis.FakeRedis())
+        redis_client_patcher.start()
+        self.addCleanup(redis_client_patcher.stop)
+
+        iter_page_results_patcher = mock.patch(
+            'ocr.views.services.iter_service_job_page_results',
+            side_effect=lambda job_id, num_pages, order: iter_service_job_page_results(job_id, num_pages, order, poll_interval=0, timeout=0)
+        )
+        iter_page_results_patcher.start()
+        self.addCleanup(iter_page_results_patcher.stop)
+
+        self.job_id = create_service_job(3)
+
+    def stream(self, order):
+        lines = [json.loads(line) for line in generate_service_ocr_ndjson(self.job_id, 3, order)]
+        return [line['pageIndex'] for line in lines[:-1]], lines[-1]
+
+    def test_page_and_completion_order(self):
+        for page_index in [2, 0, 1]:
+            save_service_job_page_result(self.job_id, page_index, detections=[{'text': str(page_index)}])
+
+        page_indices, job_line = self.stream("page")
+        self.assertEqual(page_indices, [0, 1, 2])
+        self.assertEqual((job_line['status'], job_line['numStreamedPages']), ("completed", 3))
+        self.assertEqual(self.stream("completion")[0], [2, 0, 1])
+
+    def test_timeout_line(self):
+        save_service_job_page_result(self.job_id, 1, error="Failed to perform OCR on page.")
+
+        page_indices, job_line = self.stream("page")
+        self.assertEqual(page_indices, [1]) # pages finished after an unfinished one are still sent
+        self.assertEqual((job_line['jobId'], job_line['status'], job_line['numStreamedPages'], job_line['numFailedPages']), (self.job_id, "timeout", 1, 1))
+
+
+@skipIf(fakeredis is None, "fakeredis (with lupa) is not installed")
+class PageOCRCacheTests(TestCase):
+    ocr_config = {
+        'document_parser': {'modelId': "parser", 'version': "1"},
+        'text_recognizer': {'modelId': "recognizer", 'version': "1", 'language': ["hindi"]},
+    }
+
+    def setUp(self):
+        redis_client_patcher = mock.patch.object(QueueManager, 'redis_client', fakeredis.FakeRedis())
+        redis_client_patcher.start()
+        self.addCleanup(redis_client_patcher.stop)
+
+    def get_ocr_config(self, text_recognizer_version):
+        return {**self.ocr_config, 'text_recognizer': {**self.ocr_config['text_recognizer'], 'version': text_recognizer_version}}
+
+    def test_cache_key_depends_on_the_configs(self):
+        cache_key = get_page_ocr_cache_key("page", self.ocr_config)
+        self.assertEqual(get_page_ocr_cache_key("page", json.loads(json.dumps(self.ocr_config))), cache_key)
+        self.assertNotEqual(get_page_ocr_cache_key("other page", self.ocr_config), cache_key)
+        self.assertNotEqual(get_page_ocr_cache_key("page", self.get_ocr_config("2")), cache_key)
+        self.assertIsNone(get_page_ocr_cache_key("page", self.get_ocr_config(None))) # models without a version are not cached
+
+    def test_miss_then_hit(self):
+        temporary_directory = TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        image_path = os.path.join(temporary_directory.name, "page.png")
+        Image.new("RGB", (40, 20), (255, 255, 255)).save(image_path)
+        bboxes = [{'x_min': 2, 'y_min': 2, 'x_max': 30, 'y_max': 15, 'text_language': "hindi"}]
+
+        with mock.patch('ocr.language_ocr_models.main.PAGE_OCR_CACHE_ENABLED', True), \
+                mock.patch.object(ocr_instance.document_parsers_client, 'get_bboxes_for_image', return_value=bboxes) as get_bboxes_for_image, \
+                mock.patch.object(ocr_instance.text_recognizers_client, 'recognize_images', return_value=(["नमस्ते"], 0)):
+            detections, is_cached = ocr_instance.perform_ocr_on_full_image(None, image_path, None, None, self.ocr_config, return_cache_status=True)
+            self.assertFalse(is_cached)
+            self.assertEqual(ocr_instance.perform_ocr_on_full_image(None, image_path, None, None, self.ocr_config, return_cache_status=True), (detections, True))
+            self.assertEqual(get_bboxes_for_image.call_count, 1)
+
+            # a new recognizer version misses
+            self.assertFalse(ocr_instance.perform_ocr_on_full_image(None, image_path, None, None, self.get_ocr_config("2"), return_cache_status=True)[1])
+            self.assertEqual(get_bboxes_for_image.call_count, 2)
+
+        self.assertEqual(detections[0]['text'], "नमस्ते")
+        self.assertEqual(PageOCRCacheEntry.objects.count(), 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for page_num in range(3):
+            save_page_detections_to_cache(f"key-{page_num}", f"page-{page_num}", self.ocr_config, [{'text': "x" * 100}])
+        PageOCRCacheEntry.objects.filter(cache_key="key-0").update(last_used_at=timezone.now() + timedelta(seconds=1)) # used last
+
+        entry_size = PageOCRCacheEntry.objects.values_list('size', flat=True).first()
+        with mock.patch('ocr.page_ocr_cache.get_page_ocr_cache_max_size', return_value=3 * entry_size - 1):
+            save_page_detections_to_cache("key-3", "page-3", self.ocr_config, [{'text': "x" * 100}])
+            self.assertEqual(PageOCRCacheEntry.objects.count(), 4) # evicted at most once every PAGE_OCR_CACHE_EVICTION_INTERVAL
+
+            QueueManager.redis_client.delete('page_ocr_cache_eviction_lock')
+            save_page_detections_to_cache("key-3", "page-3", self.ocr_config, [{'text': "x" * 100}])
+
+        self.assertEqual(sorted(PageOCRCacheEntry.objects.values_list('cache_key', flat=True)), ["key-0", "key-3"])
+        self.assertEqual(int(QueueManager.redis_client.get('page_ocr_cache_size')), 2 * entry_size)
+
+
+class DetectionsStorageTests(TestCase):
+    detections_jsons = [
+        json.dumps([{'text_id': "0", 'text_bbox': {'x_min': 1, 'x_max': 9}, 'text': "नमस्ते"}]),
+        json.dumps([{'text': "नमस्ते"}], ensure_ascii=False),
+        json.dumps([{'text': "a", 'confidence': 0.1 + 0.2}, {'text': "b", 'confidence': 1e-12}]),
+        json.dumps([{'text': "a", 'x': 1}, {'x': 2, 'text': "b"}, {'text': "c", 'extra': None}]),
+        "[]",
+        "not json",
+    ]
+
+    def setUp(self):
+        user = CustomUser.objects.create(username="test", email="test@example.com")
+        upload = Upload.objects.create(user=user, filename="test", detection_ids="[]", processing_status="", upload_type="original")
+        self.detection = Detection.objects.create(user=user, upload=upload, image_filename="test.jpg", original_detections="[]", detections="[]")
+
+    def get_stored_detections(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT detections FROM {Detection._meta.db_table} WHERE id = %s", [self.detection.id])
+            return cursor.fetchone()[0]
+
+    def test_round_trip(self):
+        for detections_json in self.detections_jsons:
+            self.assertEqual(decode_detections(encode_detections(detections_json)), detections_json)
+            self.assertTrue(check_if_detections_are_compact(encode_detections(detections_json)))
+
+    def test_model_round_trip(self):
+        for detections_json in self.detections_jsons:
+            self.detection.detections = detections_json
+            self.detection.save()
+            self.assertEqual(Detection.objects.get(id=self.detection.id).detections, detections_json)
+
+    def test_queryset_update(self):
+        detections_json = self.detections_jsons[0]
+        Detection.objects.filter(id=self.detection.id).update(detections=detections_json)
+        self.assertTrue(check_if_detections_are_compact(self.get_stored_detections()))
+        self.assertEqual(Detection.objects.values_list('detections', flat=True).get(id=self.detection.id), detections_json)
+
+    def test_legacy_text_rows(self):
+        detections_json = self.detections_jsons[1]
+        with connection.cursor() as cursor:
+            cursor.execute(f"UPDATE {Detection._meta.db_table} SET detections = %s WHERE id = %s", [detections_json, self.detection.id])
+        self.assertFalse(check_if_detections_are_compact(self.get_stored_detections()))
+        self.assertEqual(Detection.objects.get(id=self.detection.id).detections, detections_json)
+
+    def test_legacy_columns_values(self):
+        detections = [
+            {'text_id': "0", 'text_bbox': {'x_min': 1, 'x_max': 9}, 'text': "नमस्ते", 'confidence': 0.5},
+            {'text_id': "1", 'text_bbox': {'x_min': 10, 'x_max': 20}, 'text': "100%", 'confidence': 1},
+        ]
+        payload = [2, ['text_id', ['text_bbox', ['x_min', 'x_max']], 'text', 'confidence'], [["0", "1"], [1, 10], [9, 20], ["नमस्ते", "100%"], [0.5, 1]]]
+        value = COMPACT_DETECTIONS_MAGIC + COLUMNS_FORMAT + zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+        self.assertEqual(decode_detections(value), json.dumps(detections))
+        self.assertFalse(check_if_detections_are_compact(value))
+
+
+class DetectionOperationsTests(SimpleTestCase):
+    def setUp(self):
+        self.detections = [
+            {'text_id': "1", 'text': "one", 'text_bbox': {'x_min': 0, 'x_max': 10}},
+            {'text_id': "2", 'text': "two", 'text_bbox': {'x_min': 20, 'x_max': 30}},
+        ]
+
+    def test_update_text(self):
+        self.assertIsNone(apply_detection_operations(self.detections, [{'op': "updateText", 'textId': "2", 'text': "TWO"}]))
+        self.assertEqual([detection['text'] for detection in self.detections], ["one", "TWO"])
+
+    def test_move_bbox(self):
+        self.assertIsNone(apply_detection_operations(self.detections, [{'op': "moveBbox", 'textId': "1", 'bbox': {'x_max': 15, 'line_index': 1}}]))
+        self.assertEqual(self.detections[0]['text_bbox'], {'x_min': 0, 'x_max': 15, 'line_index': 1})
+
+    def test_insert(self):
+        operations = [
+            {'op': "insert", 'detection': {'text_id': "3", 'text': "three"}, 'afterTextId': "1"},
+            {'op': "insert", 'detection': {'text_id': "4", 'text': "four"}},
+            {'op': "updateText", 'textId': "2", 'text': "TWO"}, # the indices are kept up to date
+        ]
+        self.assertIsNone(apply_detection_operations(self.detections, operations))
+        self.assertEqual([detection['text'] for detection in self.detections], ["one", "three", "TWO", "four"])
+
+    def test_delete(self):
+        operations = [{'op': "delete", 'textId': "1"}, {'op': "updateText", 'textId': "2", 'text': "TWO"}]
+        self.assertIsNone(apply_detection_operations(self.detections, operations))
+        self.assertEqual(self.detections, [{'text_id': "2", 'text': "TWO", 'text_bbox': {'x_min': 20, 'x_max': 30}}])
+
+    def test_unknown_text_id(self):
+        self.assertEqual(apply_detection_operations(self.detections, [{'op': "delete", 'textId': "1"}, {'op': "delete", 'textId': "1"}]), "Operation 1: text_id 1 not found.")
+        self.assertEqual(apply_detection_operations(self.detections, [{'op': "insert", 'detection': {'text_id': "3"}, 'afterTextId': "9"}]), "Operation 0: text_id 9 not found.")
+        self.assertEqual(apply_detection_operations(self.detections, [{'op': "insert", 'detection': {'text_id': "2"}}]), "Operation 0: text_id 2 already exists.")
+
+
+class DetectionPatchTests(TestCase):
+    detections = [{'text_id': "1", 'text': "one"}]
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(username="test", email="test@example.com", credits=10)
+        upload = Upload.objects.create(user=self.user, filename="test.pdf", detection_ids="[]", processing_status="", upload_type="original")
+        self.detection = Detection.objects.create(
+            user=self.user,
+            upload=upload,
+            image_filename="page.jpg",
+            document_parser="{}",
+            parsing_postprocessor="no_postprocessor",
+            text_recognizer="{}",
+            original_detections=json.dumps(self.detections),
+            detections=json.dumps(self.detections)
+        )
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def patch(self, data, **headers):
+        return self.client.patch(f"/api/ocr/detections/?id={self.detection.id}", data, format="json", **headers)
+
+    def get_detections(self):
+        self.detection.refresh_from_db()
+        return json.loads(self.detection.detections)
+
+    def test_operations(self):
+        response = self.patch({'version': 0, 'operations': [{'op': "updateText", 'textId': "1", 'text': "two"}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['result']['version'], 1)
+
+        response = self.patch({'version': 0, 'operations': [{'op': "delete", 'textId': "1"}]})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error']['version'], 1)
+        self.assertEqual(self.patch({'version': 1, 'operations': [{'op': "delete", 'textId': "2"}]}).status_code, 400)
+        self.assertEqual(self.get_detections(), [{'text_id': "1", 'text': "two"}])
+
+    def test_replace(self):
+        detections = [{'text_id': "1", 'text': "a\\b \\\\ c"}]
+        response = self.patch({'detections': detections})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['result']['detection']['version'], 1)
+        self.assertEqual(self.get_detections(), detections) # backslashes are kept as sent
+
+    def test_replace_version_conflict(self):
+        self.assertEqual(self.patch({'detections': [], 'version': 0}).status_code, 200)
+
+        response = self.patch({'detections': [{'text_id': "2"}], 'version': 0})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error']['version'], 1)
+        self.assertEqual(self.patch({'detections': [{'text_id': "2"}]}, HTTP_IF_MATCH='"0"').status_code, 409)
+        self.assertEqual(self.get_detections(), [])
+
+        self.assertEqual(self.patch({'detections': [{'text_id': "2"}]}, HTTP_IF_MATCH='"1"').status_code, 200)
+        self.assertEqual(self.get_detections(), [{'text_id': "2"}])
+
+    def test_replace_detections_of_another_user(self):
+        self.client.force_authenticate(CustomUser.objects.create(username="other", email="other@example.com"))
+        self.assertEqual(self.patch({'detections': []}).status_code, 400)
+        self.assertEqual(self.patch({'detections': []}, HTTP_IF_MATCH="x").status_code, 400)
+        self.assertEqual(self.get_detections(), self.detections)
+
+
+@skipIf(fakeredis is None, "fakeredis (with lupa) is not installed")
+class NewUploadTaskTests(TestCase):
+    ocr_config = {'document_parser': {'modelId': "parser"}, 'text_recognizer': {'modelId': "recognizer", 'language': ["hindi"]}}
+
+    def setUp(self):
+        patchers = [
+            mock.patch.object(QueueManager, 'redis_client', fakeredis.FakeRedis()),
+            mock.patch.object(tasks, 'NEW_UPLOAD_PAGES_PER_TASK', 2),
+            mock.patch.object(tasks, 'upload_to_cloud_storage_from_cache', return_value=True),
+            mock.patch.object(tasks, 'delete_multiple_files_from_cache'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        task_always_eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', task_always_eager)
+
+        self.user = CustomUser.objects.create(username="test", email="test@example.com", credits=10)
+        self.upload = Upload.objects.create(user=self.user, filename="test.pdf", detection_ids="[]", processing_status="", upload_type="original")
+
+    def perform_ocr_on_multiple_images(self, image_paths, ocr_config, on_page_start=None):
+        for image_path in image_paths:
+            if image_path.endswith("page-3.jpg"):
+                raise RuntimeError("the model server went away")
+            yield ([{'text': image_path[-10:]}], False), None
+
+    def test_failed_chunk_marks_the_upload_errored(self):
+        with mock.patch.object(tasks.ocr_instance, 'perform_ocr_on_multiple_images', side_effect=self.perform_ocr_on_multiple_images):
+            tasks.queue_ocr_for_new_upload(self.upload.id, self.user.id, [f"page-{page_num}.jpg" for page_num in range(1, 5)], self.ocr_config)
+
+        self.upload.refresh_from_db()
+        self.assertEqual(json.loads(self.upload.processing_status)['statusCode'], 6)
+        self.assertEqual(len(json.loads(self.upload.detection_ids)), 2) # the pages of the first chunk are kept
+        self.assertFalse(QueueManager.check_if_upload_is_being_processed(self.upload.id))
+
+    def test_chord_error_callback_marks_the_upload_errored(self):
+        QueueManager.update_upload_processing_status(self.upload.id, "{}")
+        tasks.mark_new_upload_as_errored(None, RuntimeError("lost"), None, self.upload.id)
+
+        self.upload.refresh_from_db()
+        self.assertEqual(json.loads(self.upload.processing_status)['statusCode'], 6)
+        self.assertFalse(QueueManager.check_if_upload_is_being_processed(self.upload.id))
+
+    def test_history_etag_changes_after_each_page_of_a_serial_upload(self):
+        etags = []
+
+        def perform_ocr_on_full_image(*args, **kwargs):
+            # called as each page starts, i.e. after the previous page was saved
+            etags.append(generate_uploads_etag(CustomUser.objects.get(id=self.user.id), {}))
+            return [{'text': "page"}], False
+
+        with mock.patch.object(tasks, 'NEW_UPLOAD_PROCESSING_MODE', "serial"), \
+                mock.patch.object(tasks.ocr_instance, 'perform_ocr_on_full_image', side_effect=perform_ocr_on_full_image):
+            tasks.queue_ocr_for_new_upload(self.upload.id, self.user.id, ["page-1.jpg", "page-2.jpg", "page-3.jpg"], self.ocr_config)
+
+        user = CustomUser.objects.get(id=self.user.id)
+        etags.append(generate_uploads_etag(user, {}))
+        self.upload.refresh_from_db()
+        self.assertEqual(json.loads(self.upload.processing_status)['statusCode'], 5)
+        self.assertEqual(user.credits, 7)
+        self.assertEqual(len(set(etags)), len(etags)) # every saved page gives a new ETag, none is rolled back
@@ -13,6 +13,8 @@ from ocr.views import (
     UploadAPIView,
     UploadsHistoryAPIView,
     CustomOCRAPIView,
+    CustomOCRBatchAPIView,
+    CustomOCRResultAPIView,
     DetectionAPIView,
     MergeUploadsAPIView,
     UploadChangeFilenameAPIView,
@@ -24,6 +26,8 @@ from ocr.views import (
     ServiceUploadAPIView,
     UserCreditsAPIView,
     ServiceConfigAPIView,
+    ServiceJobAPIView,
+    ServiceUsageAPIView,
 )
 
 
@@ -37,6 +41,8 @@ urlpatterns = [
     path('uploads/', UploadAPIView.as_view(), name='uploads'),
     path('uploads/history/', UploadsHistoryAPIView.as_view(), name='uploads_history'),
     path('custom-ocr/', CustomOCRAPIView.as_view(), name='custom_ocr'),
+    path('custom-ocr/batch/', CustomOCRBatchAPIView.as_view(), name='custom_ocr_batch'),
+    path('custom-ocr/result/', CustomOCRResultAPIView.as_view(), name='custom_ocr_result'),
     path('detections/', DetectionAPIView.as_view(), name='detections'),
     path('uploads/merge/', MergeUploadsAPIView.as_view(), name='upload_merge'),
     path('uploads/change-filename/', UploadChangeFilenameAPIView.as_view(), name='upload_change_filename'),
@@ -49,6 +55,8 @@ urlpatterns = [
     # Lipikar Services
     path('services/config/', ServiceConfigAPIView.as_view(), name='config'),
     path('services/new-ocr/',ServiceUploadAPIView.as_view(),name='service_new_ocr'),
+    path('services/jobs/', ServiceJobAPIView.as_view(), name='service_jobs'),
+    path('services/usage/', ServiceUsageAPIView.as_view(), name='service_usage'),
     
     # path('uploads/export/', ExportUploadsAPIView.as_view(), name='export_uploads'),
     
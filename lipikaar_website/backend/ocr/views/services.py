@@ -1,26 +1,47 @@
+import json
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from os.path import splitext as path_splitext
 
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from django.http import StreamingHttpResponse
+from redis import RedisError
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from rest_framework.views import APIView
-from rest_framework.parsers import MultiPartParser
+from rest_framework.parsers import MultiPartParser, JSONParser
 
-from ocr.cache import save_image_or_pdf_to_cache
+from ocr.cache import delete_multiple_files_from_cache, save_image_or_pdf_to_cache
+from ocr.inline_ocr import inline_ocr_executor
 from ocr.config import language_to_indic_transliteration_script
-from ocr.language_ocr_models.main import OCR
+from ocr.language_ocr_models.main import ocr_instance
 from ocr.responses import (
     perform_ocr_responses,
+    generate_validation_errors_response,
+    generate_invalid_id_response,
     service_responses,
 )
-from ocr.tasks import perform_ocr_for_service
-from ocr_app.settings import NEW_OCR_ACCEPTED_FILE_EXTENSIONS
-
-
-SERVICE_API_KEY = "foo-the-service"
-
-ocr_instance = OCR()
-ocr_instance_config = ocr_instance.get_config()
+from ocr.service_api_keys import (
+    authenticate_service_request,
+    release_service_job,
+    add_service_api_key_usage,
+    get_service_api_key_usage,
+    new_service_job_id,
+)
+from ocr.service_jobs import (
+    check_if_callback_url_is_allowed,
+    create_service_job,
+    get_service_job_result,
+    check_if_service_job_belongs_to_api_key,
+    iter_service_job_page_results,
+)
+from ocr.tasks import perform_ocr_for_service, queue_ocr_for_service_job, run_ocr_for_service
+from ocr_app.settings import (
+    NEW_OCR_ACCEPTED_FILE_EXTENSIONS,
+    SERVICE_INLINE_OCR,
+    SERVICE_INLINE_OCR_MAX_FILE_SIZE_MB,
+    SERVICE_OCR_WAIT_TIMEOUT,
+)
 
 
 class ServiceConfigAPIView(APIView): # Done
@@ -28,18 +49,17 @@ class ServiceConfigAPIView(APIView): # Done
 
     def get(self, request):
         # Validate API Key
-        api_key_header = request.META.get('HTTP_X_LIPIKAR_SERVICE_API_KEY', "")
+        service_api_key, error_response = authenticate_service_request(request)
+        if error_response is not None:
+            return error_response
 
-        if api_key_header != SERVICE_API_KEY:
-            return service_responses['unauthorized']()
-        
 
         # Return Config
         return Response({
             'success': True,
             'result': {
                 'config': {
-                    **ocr_instance_config,
+                    **ocr_instance.get_config(),
                     'transliteration': {
                         'supportedLanguages': language_to_indic_transliteration_script.keys(),
                     },
@@ -48,48 +68,138 @@ class ServiceConfigAPIView(APIView): # Done
         }, status=status.HTTP_200_OK)
 
 
+def validate_service_ocr_request(request):
+    """
+    Validates the OCR config (query params) and the file of a service OCR request, and saves the pages of
+    the file to the cache. Returns (error_response, None, None) or (None, image_filenames, full_ocr_config).
+    """
+    # Validate OCR Config
+    ocr_config = {
+        'document_parser': request.query_params.get('document_parser', ""),
+        'text_recognizer': request.query_params.get('text_recognizer', ""),
+    }
+
+    ocr_config_invalid_keys = ocr_instance.validate_config(ocr_config)
+    if len(ocr_config_invalid_keys) > 0:
+        return perform_ocr_responses['invalidConfig'](ocr_config_invalid_keys), None, None
+
+
+    # Validate Request Files
+    file = request.FILES.get('file', None)
+    if file == None:
+        return perform_ocr_responses['noFile'](), None, None
+
+    _filename, file_extension = path_splitext(file.name)
+    if file_extension not in NEW_OCR_ACCEPTED_FILE_EXTENSIONS:
+        return perform_ocr_responses['unacceptedFileExtension'](), None, None
+
+    image_filenames = save_image_or_pdf_to_cache(file, file_extension)
+    full_ocr_config = ocr_instance.get_full_ocr_config(ocr_config['document_parser'], ocr_config['text_recognizer'])
+    return None, image_filenames, full_ocr_config
+
+
+def generate_service_ocr_ndjson(job_id, num_pages, order):
+    "One JSON line per page as it finishes, then a line with the job status (\"timeout\" if pages are missing)."
+    num_streamed_pages = 0
+    for page_result in iter_service_job_page_results(job_id, num_pages, order):
+        num_streamed_pages += 1
+        yield json.dumps(page_result) + "\n"
+
+    job_result = get_service_job_result(job_id, include_pages=False) or {'jobId': job_id, 'numPages': num_pages}
+    job_result['status'] = "completed" if num_streamed_pages == num_pages else "timeout"
+    job_result['numStreamedPages'] = num_streamed_pages
+    yield json.dumps(job_result) + "\n"
+
+
 class ServiceUploadAPIView(APIView):
+    """
+    OCR a file. By default only single-page files are accepted, and the response is their detections,
+    or a 504 if they are not ready within SERVICE_OCR_WAIT_TIMEOUT seconds.
+    With SERVICE_INLINE_OCR, single-image files up to SERVICE_INLINE_OCR_MAX_FILE_SIZE_MB are OCRed in the
+    web process while it has a free inline slot, everything else goes through Celery.
+    With stream=1 every page is processed in parallel and the response is NDJSON: one line per page
+    ({pageIndex, status, detections}) as soon as it is recognized, in page order, or in completion order
+    with order=completion, and a last line with the job status.
+    Every request takes an in-flight slot of its Service API Key until its last page is done.
+    """
+
     parser_classes = [MultiPartParser]
     permission_classes = [AllowAny]
 
     def post(self, request):
+        stream = request.query_params.get('stream', "") == "1"
+        order = request.query_params.get('order', "page")
+        if order not in ("page", "completion"):
+            return generate_validation_errors_response('query', {'order': ["Must be page or completion."]})
+
         # Validate API Key
-        api_key_header = request.META.get('HTTP_X_LIPIKAR_SERVICE_API_KEY', "")
-
-        if api_key_header != SERVICE_API_KEY:
-            return service_responses['unauthorized']()
-        
-
-        # Validate OCR Config
-        ocr_config = {
-            'document_parser': request.query_params.get('document_parser', ""),
-            'text_recognizer': request.query_params.get('text_recognizer', ""),
-        }
-
-        ocr_config_invalid_keys = ocr_instance.validate_config(ocr_config)
-        if len(ocr_config_invalid_keys) > 0:
-            return perform_ocr_responses['invalidConfig'](ocr_config_invalid_keys)
-        
-
-        # Validate Request Files
-        file = request.FILES.get('file', None)
-        if file == None:
-            return perform_ocr_responses['noFile']()
-        
-        _filename, file_extension = path_splitext(file.name)
-        if file_extension not in NEW_OCR_ACCEPTED_FILE_EXTENSIONS:
-            return perform_ocr_responses['unacceptedFileExtension']()
-        
-        image_filenames = save_image_or_pdf_to_cache(file, file_extension)
-        full_ocr_config = ocr_instance.get_full_ocr_config(ocr_config['document_parser'], ocr_config['text_recognizer'])
-
-        perform_ocr_result = perform_ocr_for_service.apply_async(
-            kwargs={
-                'image_filenames': image_filenames,
-                'ocr_config': full_ocr_config,
-            }
-        )
-        detections = perform_ocr_result.get()
+        job_id = new_service_job_id()
+        service_api_key, error_response = authenticate_service_request(request, job_id)
+        if error_response is not None:
+            return error_response
+
+        if stream:
+            error_response, image_filenames, full_ocr_config = validate_service_ocr_request(request)
+            if error_response is not None:
+                release_service_job(service_api_key.id, job_id)
+                return error_response
+
+            add_service_api_key_usage(service_api_key.id, 'pages', len(image_filenames))
+            create_service_job(len(image_filenames), api_key_id=service_api_key.id, job_id=job_id)
+            queue_ocr_for_service_job(job_id, image_filenames, full_ocr_config)
+
+            response = StreamingHttpResponse(
+                generate_service_ocr_ndjson(job_id, len(image_filenames), order),
+                content_type="application/x-ndjson"
+            )
+            response['X-Lipikar-Job-Id'] = job_id
+            response['X-Accel-Buffering'] = "no" # let nginx pass the lines through as they are written
+            return response
+
+        try:
+            return self.perform_ocr(request, service_api_key)
+        finally:
+            release_service_job(service_api_key.id, job_id)
+
+    def perform_ocr(self, request, service_api_key):
+        error_response, image_filenames, full_ocr_config = validate_service_ocr_request(request)
+        if error_response is not None:
+            return error_response
+
+        if len(image_filenames) > 1:
+            delete_multiple_files_from_cache(image_filenames)
+            return generate_validation_errors_response('body', {'file': [f"Has {len(image_filenames)} pages, use stream=1 or services/jobs/ for multi-page files."]})
+
+        add_service_api_key_usage(service_api_key.id, 'pages', len(image_filenames))
+
+        inline_ocr_future = None
+        if SERVICE_INLINE_OCR and len(image_filenames) == 1 and request.FILES['file'].size <= SERVICE_INLINE_OCR_MAX_FILE_SIZE_MB * 1024 * 1024:
+            inline_ocr_future = inline_ocr_executor.try_submit(run_ocr_for_service, image_filenames, full_ocr_config)
+
+        if inline_ocr_future is not None:
+            try:
+                detections = inline_ocr_future.result(timeout=SERVICE_OCR_WAIT_TIMEOUT)
+            except FutureTimeoutError:
+                return service_responses['ocrTimeout']()
+            except Exception as e:
+                print("Exception in performing inline OCR for service.")
+                print(e)
+                detections = False
+        else:
+            perform_ocr_result = perform_ocr_for_service.apply_async(
+                kwargs={
+                    'image_filenames': image_filenames,
+                    'ocr_config': full_ocr_config,
+                }
+            )
+            try:
+                detections = perform_ocr_result.get(timeout=SERVICE_OCR_WAIT_TIMEOUT)
+            except CeleryTimeoutError:
+                return service_responses['ocrTimeout']()
+            except Exception as e:
+                print("Exception in performing OCR for service.")
+                print(e)
+                detections = False
 
         if detections == False:
             return Response({
@@ -105,3 +215,105 @@ class ServiceUploadAPIView(APIView):
                 'detections': detections,
             },
         }, status=status.HTTP_200_OK)
+
+
+class ServiceJobAPIView(APIView):
+    """
+    Multi-page OCR jobs.
+    post: queue every page of the file and return the jobId right away. With the callback_url query param,
+          every page result, and then the whole job, is also posted to that URL as soon as it is ready.
+    get: the job status and the results of the pages finished so far (jobId query param), only for jobs of
+         the same Service API Key.
+    A job takes an in-flight slot of its Service API Key until its last page is done.
+    """
+
+    parser_classes = [MultiPartParser, JSONParser]
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        # Validate API Key
+        job_id = new_service_job_id()
+        service_api_key, error_response = authenticate_service_request(request, job_id)
+        if error_response is not None:
+            return error_response
+
+        # the callback host is resolved only for authenticated requests
+        callback_url = request.query_params.get('callback_url', "") or None
+        if callback_url is not None:
+            if not check_if_callback_url_is_allowed(callback_url):
+                release_service_job(service_api_key.id, job_id)
+                return generate_validation_errors_response('query', {'callback_url': ["Enter a valid http or https URL of a public host."]})
+
+        error_response, image_filenames, full_ocr_config = validate_service_ocr_request(request)
+        if error_response is not None:
+            release_service_job(service_api_key.id, job_id)
+            return error_response
+
+        add_service_api_key_usage(service_api_key.id, 'pages', len(image_filenames))
+        create_service_job(len(image_filenames), callback_url, service_api_key.id, job_id)
+        queue_ocr_for_service_job(job_id, image_filenames, full_ocr_config)
+
+        return Response({
+            'success': True,
+            'result': {
+                'jobId': job_id,
+                'status': "processing",
+                'numPages': len(image_filenames),
+            },
+        }, status=status.HTTP_202_ACCEPTED)
+
+    def get(self, request):
+        # Validate API Key
+        service_api_key, error_response = authenticate_service_request(request)
+        if error_response is not None:
+            return error_response
+
+        job_id = request.query_params.get('jobId', "")
+        if not check_if_service_job_belongs_to_api_key(job_id, service_api_key.id):
+            return generate_invalid_id_response("job")
+
+        job_result = get_service_job_result(job_id)
+        if job_result is None:
+            return generate_invalid_id_response("job")
+
+        return Response({
+            'success': True,
+            'result': job_result,
+        }, status=status.HTTP_200_OK)
+
+
+class ServiceUsageAPIView(APIView):
+    "Usage counters and limits of the Service API Key of the request."
+
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        # Validate API Key
+        service_api_key, error_response = authenticate_service_request(request)
+        if error_response is not None:
+            return error_response
+
+        try:
+            usage = get_service_api_key_usage(service_api_key.id)
+        except RedisError as e:
+            print("Error at ocr.views.services.ServiceUsageAPIView")
+            print(4 * " " + str(e))
+            return Response({
+                'success': False,
+                'error': {
+                    'message': "Usage is not available right now.",
+                },
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        return Response({
+            'success': True,
+            'result': {
+                'name': service_api_key.name,
+                'limits': {
+                    'requestsPerMinute': service_api_key.requests_per_minute,
+                    'burst': service_api_key.burst,
+                    'maxInFlightJobs': service_api_key.max_in_flight_jobs,
+                },
+                'usage': usage,
+            },
+        }, status=status.HTTP_200_OK)
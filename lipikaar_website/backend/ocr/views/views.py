@@ -3,6 +3,7 @@ import json
 import time
 from math import ceil
 from django.contrib.auth import authenticate
+from django.db.models import F
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
@@ -12,6 +13,8 @@ from rest_framework.parsers import MultiPartParser, JSONParser
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from celery.result import AsyncResult
 from indic_transliteration import sanscript
 
 from ocr_app.settings import (
@@ -22,8 +25,9 @@ from ocr_app.settings import (
     FRONTEND_VERSION,
     GET_MULTIPLE_UPLOADS_LIMIT,
     CAN_DELETE_MULTIPLE_UPLOADS_IN_SINGLE_REQUEST,
+    CUSTOM_OCR_WAIT_TIMEOUT,
+    CUSTOM_OCR_TASK_TTL,
 )
-SERVICE_API_KEY = "foo-the-service"
 from ocr.config import (
     language_to_indic_transliteration_script,
 )
@@ -36,6 +40,10 @@ from ocr.serializers import (
     DeleteUploadSerializer,
     ResetPasswordSerializer,
     CustomOCRSerializer,
+    CustomOCRBatchSerializer,
+    DetectionOperationsSerializer,
+    DetectionReplaceSerializer,
+    TaskIdSerializer,
     UploadChangeFilenameSerializer,
     MergeUploadsSerializer,
     IdSerializer,
@@ -52,6 +60,8 @@ from ocr.models import (
 from ocr.db_utils import (
     zip_upload,
     zip_uploads,
+    get_upload_pages,
+    set_upload_pages,
 )
 from ocr.cache import (
     save_image_or_pdf_to_cache,
@@ -84,16 +94,24 @@ from ocr.responses import (
     queue_full_response,
     generate_invalid_id_response,
     invalid_credentials_response,
+    generate_custom_ocr_timeout_response,
+    generate_custom_ocr_failed_response,
+    generate_detection_version_conflict_response,
+    generate_not_modified_response,
 )
-from ocr.language_ocr_models.main import (
-    OCR
+from ocr.language_ocr_models.main import ocr_instance
+from ocr.detection_operations import apply_detection_operations
+from ocr.etags import (
+    generate_upload_detections_etag,
+    generate_uploads_etag,
+    check_if_etag_matches,
+    set_etag,
 )
-ocr_instance = OCR()
-ocr_instance_config = ocr_instance.get_config()
 from ocr.tasks import (
-    perform_ocr_for_new_upload,
+    queue_ocr_for_new_upload,
     perform_ocr_for_service,
     re_run_ocr_for_bbox,
+    re_run_ocr_for_bboxes,
 )
 from ocr.QueueManager import QueueManager
 
@@ -180,7 +198,7 @@ class ResetPasswordAPIView(APIView): # Done
 
         # update the password and respond with success
         user.set_password(new_password)
-        user.save()
+        user.save(update_fields=['password'])
 
         return Response({
             'success': True,
@@ -202,7 +220,7 @@ class ConfigAPIView(APIView): # Done
             'success': True,
             'result': {
                 'config': {
-                    **ocr_instance_config,
+                    **ocr_instance.get_config(),
                     'transliteration': {
                         'supportedLanguages': language_to_indic_transliteration_script.keys(),
                     },
@@ -237,6 +255,11 @@ class UploadAPIView(APIView):
         id = request.query_params.get('id', None)
         processing_status_only = request.query_params.get('processing_status_only', None)
         latest_upload_id = request.query_params.get('latest_upload_id', float('inf'))
+
+        if processing_status_only != "1":
+            etag = generate_uploads_etag(user, request.query_params)
+            if check_if_etag_matches(request, etag):
+                return set_etag(generate_not_modified_response(), etag)
         
         if id == None:
             num_uploads_of_user = Upload.objects.filter(user=user).count()
@@ -247,14 +270,14 @@ class UploadAPIView(APIView):
                 uploads = Upload.objects.filter(user=user).order_by('-id')[:GET_MULTIPLE_UPLOADS_LIMIT]
 
             serializer = UploadSerializer(uploads, many=True)
-            return Response({
+            return set_etag(Response({
                 'success': True,
                 'result': {
                     'uploads': serializer.data,
                     'numUploadsOfUser': num_uploads_of_user,
 
                 },
-            }, status=status.HTTP_200_OK)
+            }, status=status.HTTP_200_OK), etag)
 
         if processing_status_only == "1":
             if QueueManager.check_if_upload_is_cancelled(id):
@@ -298,12 +321,12 @@ class UploadAPIView(APIView):
         try:
             upload_object = Upload.objects.get(user=user, id=id)
             serializer = UploadSerializer(upload_object)
-            return Response({
+            return set_etag(Response({
                 'success': True,
                 'result': {
                     'upload': serializer.data
                 }
-            })
+            }), etag)
         except:
             return Response({
                 'success': False,
@@ -401,17 +424,16 @@ class UploadAPIView(APIView):
 
         print(ocr_config)
 
-        perform_ocr_for_new_upload.delay(
+        # set the status before queueing, so that a fast worker cannot finish the upload before it is marked as queued
+        QueueManager.update_upload_processing_status(new_upload.id, new_upload_processing_status)
+
+        queue_ocr_for_new_upload(
             new_upload.id,
             user.id,
-            1,
-            len(image_filenames),
             image_filenames,
             ocr_config
         )
 
-        QueueManager.update_upload_processing_status(new_upload.id, new_upload_processing_status)
-
         return Response({
             'success': True,
             'result': {
@@ -511,6 +533,10 @@ class UploadsHistoryAPIView(APIView):
     def get(self, request):
         user = request.user # get the authenticated user
 
+        etag = generate_uploads_etag(user, request.query_params)
+        if check_if_etag_matches(request, etag):
+            return set_etag(generate_not_modified_response(), etag)
+
         page_num = int(request.query_params.get('page_num', 1))
         num_uploads_per_page = int(request.query_params.get('num_uploads_per_page', GET_MULTIPLE_UPLOADS_LIMIT))
 
@@ -520,7 +546,7 @@ class UploadsHistoryAPIView(APIView):
         uploads = Upload.objects.filter(user=user).order_by('-id')[current_page_first_upload_num - 1 : current_page_last_upload_num]
 
         serializer = UploadSerializer(uploads, many=True)
-        return Response({
+        return set_etag(Response({
             'success': True,
             'result': {
                 'uploads': serializer.data,
@@ -530,10 +556,50 @@ class UploadsHistoryAPIView(APIView):
                 'currentPageLastUploadNum': current_page_last_upload_num,
                 'numTotalUploadsOfUser': num_total_uploads_of_user,
             },
-        }, status=status.HTTP_200_OK)
+        }, status=status.HTTP_200_OK), etag)
+
+
+def get_custom_ocr_result_key(result):
+    return 'recognized_texts' if isinstance(result, list) else 'recognized_text'
+
+
+def generate_custom_ocr_response(re_run_ocr_async_result, user, wait):
+    "Registers the task for polling by user, then waits for its result for at most CUSTOM_OCR_WAIT_TIMEOUT seconds if wait."
+    task_id = re_run_ocr_async_result.id
+    QueueManager.add_custom_ocr_task(task_id, user.id, CUSTOM_OCR_TASK_TTL)
+
+    if not wait:
+        return Response({
+            'success': True,
+            'result': {
+                'taskId': task_id,
+                'status': "pending",
+            },
+        }, status=status.HTTP_202_ACCEPTED)
+
+    try:
+        result = re_run_ocr_async_result.get(timeout=CUSTOM_OCR_WAIT_TIMEOUT)
+    except CeleryTimeoutError:
+        return generate_custom_ocr_timeout_response(task_id)
+    except Exception:
+        return generate_custom_ocr_failed_response(task_id)
+
+    return Response({
+        'success': True,
+        'result': {
+            get_custom_ocr_result_key(result): result,
+            'taskId': task_id,
+        },
+    }, status=status.HTTP_200_OK)
 
 
 class CustomOCRAPIView(APIView): # Done
+    """
+    Re-run OCR on a bbox of a detection.
+    Waits at most CUSTOM_OCR_WAIT_TIMEOUT seconds for the text, then answers 504 with the taskId to poll
+    on custom-ocr/result/. With wait=0 it answers 202 with the taskId right away.
+    """
+
     parser_classes = [JSONParser]
     permission_classes = [IsAuthenticated]
     authentication_classes = [JWTAuthentication]
@@ -574,16 +640,102 @@ class CustomOCRAPIView(APIView): # Done
                 'text_recognizer': json.loads(detection.text_recognizer),
                 }
         )
-        recognized_text = re_run_ocr_async_result.get()
+        return generate_custom_ocr_response(re_run_ocr_async_result, user, request.query_params.get('wait') != "0")
+
+
+class CustomOCRBatchAPIView(APIView):
+    """
+    Re-run OCR on many bboxes of one detection in a single task: the page is decoded once and the crops
+    are recognized together. Returns recognized_texts in the order of the bboxes.
+    Same wait, timeout and polling behaviour as CustomOCRAPIView.
+    """
+
+    parser_classes = [JSONParser]
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+
+    def post(self, request):
+        user = request.user # get the authenticated user
+
+        body_serializer = CustomOCRBatchSerializer(data=request.data)
+        if not body_serializer.is_valid():
+            return generate_validation_errors_response('body', body_serializer.errors)
+
+        detection_id = body_serializer.validated_data['detectionId']
+        try:
+            detection = Detection.objects.get(user=user, id=detection_id)
+        except:
+            return generate_invalid_id_response("detection")
+
+        bboxes = [
+            {
+                'x_min': round(bbox['xMin']),
+                'y_min': round(bbox['yMin']),
+                'x_max': round(bbox['xMax']),
+                'y_max': round(bbox['yMax']),
+                'rotation': bbox['rotation'],
+            }
+            for bbox in body_serializer.validated_data['bboxes']
+        ]
+
+        re_run_ocr_async_result = re_run_ocr_for_bboxes.apply_async(
+            kwargs={
+                'image_filename': detection.image_filename,
+                'bboxes': bboxes,
+                'text_recognizer': json.loads(detection.text_recognizer),
+                }
+        )
+        return generate_custom_ocr_response(re_run_ocr_async_result, user, request.query_params.get('wait') != "0")
+
+
+class CustomOCRResultAPIView(APIView):
+    "Poll a custom OCR task: 200 with the text (or texts) once it is done, 202 while it is pending."
+
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+
+    def get(self, request):
+        user = request.user # get the authenticated user
+
+        query_serializer = TaskIdSerializer(data=request.query_params)
+        if not query_serializer.is_valid():
+            return generate_validation_errors_response('query', query_serializer.errors)
+
+        task_id = request.query_params.get('taskId')
+        if QueueManager.get_custom_ocr_task_user_id(task_id) != user.id:
+            return generate_invalid_id_response("task")
+
+        re_run_ocr_async_result = AsyncResult(task_id)
+        if re_run_ocr_async_result.failed():
+            return generate_custom_ocr_failed_response(task_id)
+
+        if not re_run_ocr_async_result.ready():
+            return Response({
+                'success': True,
+                'result': {
+                    'taskId': task_id,
+                    'status': "pending",
+                },
+            }, status=status.HTTP_202_ACCEPTED)
 
         return Response({
             'success': True,
             'result': {
-                'recognized_text': recognized_text,
+                get_custom_ocr_result_key(re_run_ocr_async_result.result): re_run_ocr_async_result.result,
+                'taskId': task_id,
             },
         }, status=status.HTTP_200_OK)
 
 
+def parse_detection_version(if_match):
+    "The version in an If-Match header (3, \"3\" or W/\"3\"), None if it is not one."
+    version = if_match.strip()
+    if version.startswith("W/"):
+        version = version[2:]
+    version = version.strip('"')
+    return int(version) if version.isdigit() else None
+
+
 class DetectionAPIView(APIView): # Done
     serializer_class = UploadSerializer
     permission_classes = [IsAuthenticated]
@@ -604,30 +756,32 @@ class DetectionAPIView(APIView): # Done
             upload_object = Upload.objects.get(user=user, id=upload_id)
         except:
             return generate_invalid_id_response("upload")
-        
-        detection_objects = []
 
+        etag = generate_upload_detections_etag(upload_object, request.query_params)
+        if check_if_etag_matches(request, etag):
+            return set_etag(generate_not_modified_response(), etag)
+        
         if filenames_only == "1":
-            for detection_id in json.loads(upload_object.detection_ids):
-                detection_object = Detection.objects.filter(id=detection_id).values('id', 'image_filename').first()
-                detection_objects.append(detection_object)
-            
+            detection_objects = get_upload_pages(upload_object, fields=('id', 'image_filename'))
             serializer = DetectionFilenameOnlySerializer(detection_objects, many=True)
         else:
-            for detection_id in json.loads(upload_object.detection_ids):
-                detection_object = Detection.objects.filter(id=detection_id).first()
-                detection_objects.append(detection_object)
-            
+            detection_objects = get_upload_pages(upload_object)
             serializer = DetectionSerializer(detection_objects, many=True)
         
-        return Response({
+        return set_etag(Response({
             'success': True,
             'result': {
                 'detections': serializer.data
             }
-        })
+        }), etag)
     
     def patch(self, request):
+        """
+        Replace the detections of a page (detections in the body), or apply word-level operations to them
+        (version and operations in the body, see ocr/detection_operations.py). Operations are only applied
+        while the detections are still at that version, otherwise the response is a 409 with the current version.
+        A replace is conditioned the same way on the version in the body or the If-Match header, if either is sent.
+        """
         user = request.user # get the authenticated user
         # if not user.can_compute:
         #     return generate_user_cannot_compute_error_response()
@@ -638,15 +792,36 @@ class DetectionAPIView(APIView): # Done
 
         id = request.query_params.get('id')
 
-        detections = request.data['detections']
-        detection_object = Detection.objects.get(id=id)
+        if 'operations' in request.data:
+            return self.apply_operations(request, user, id)
+
+        body_serializer = DetectionReplaceSerializer(data=request.data)
+        if not body_serializer.is_valid():
+            return generate_validation_errors_response('body', body_serializer.errors)
+
+        version = body_serializer.validated_data.get('version', None)
+        if version is None and 'HTTP_IF_MATCH' in request.META:
+            version = parse_detection_version(request.META['HTTP_IF_MATCH'])
+            if version is None:
+                return generate_validation_errors_response('header', {'If-Match': ["Must be the version of the detections."]})
+
+        detection_objects = Detection.objects.filter(upload__user=user, id=id)
+        if not detection_objects.exists():
+            return generate_invalid_id_response("detection")
+
+        # save only if nobody else saved the detections since the version the client sent
+        if version is not None:
+            detection_objects = detection_objects.filter(version=version)
+        num_updated = detection_objects.update(
+            detections=json.dumps(body_serializer.validated_data['detections']),
+            version=F('version') + 1,
+        )
+        if num_updated == 0:
+            current_version = Detection.objects.filter(id=id).values_list('version', flat=True).first()
+            return generate_detection_version_conflict_response(current_version)
 
-        # update the detection object and save it
-        detection_object.detections = json.dumps(detections).replace("\\\\","\\")
-        detection_object.save()
-            
         # serialize and return the updated object
-        serializer = DetectionSerializer(detection_object)
+        serializer = DetectionSerializer(Detection.objects.get(id=id))
         return Response({
             'success': True,
             'result': {
@@ -655,6 +830,48 @@ class DetectionAPIView(APIView): # Done
         }, status=status.HTTP_200_OK)
 
 
+    def apply_operations(self, request, user, id):
+        body_serializer = DetectionOperationsSerializer(data=request.data)
+        if not body_serializer.is_valid():
+            return generate_validation_errors_response('body', body_serializer.errors)
+
+        version = body_serializer.validated_data['version']
+        operations = [dict(operation) for operation in body_serializer.validated_data['operations']]
+
+        try:
+            detection_object = Detection.objects.only('id', 'detections', 'version').get(user=user, id=id)
+        except Detection.DoesNotExist:
+            return generate_invalid_id_response("detection")
+
+        if detection_object.version != version:
+            return generate_detection_version_conflict_response(detection_object.version)
+
+        try:
+            detections = json.loads(detection_object.detections)
+        except ValueError:
+            return generate_validation_errors_response('body', {'operations': ["The detections of this page can only be replaced as a whole."]})
+
+        error_message = apply_detection_operations(detections, operations)
+        if error_message is not None:
+            return generate_validation_errors_response('body', {'operations': [error_message]})
+
+        # save only if nobody else saved the detections since they were read
+        num_updated = Detection.objects.filter(id=detection_object.id, version=version).update(
+            detections=json.dumps(detections),
+            version=version + 1,
+        )
+        if num_updated == 0:
+            current_version = Detection.objects.filter(id=detection_object.id).values_list('version', flat=True).first()
+            return generate_detection_version_conflict_response(current_version)
+
+        return Response({
+            'success': True,
+            'result': {
+                'version': version + 1,
+            },
+        }, status=status.HTTP_200_OK)
+
+
 class MergeUploadsAPIView(APIView): # Done
     permission_classes = [IsAuthenticated]
     authentication_classes = [JWTAuthentication]
@@ -671,7 +888,7 @@ class MergeUploadsAPIView(APIView): # Done
         filename = request.data.get('filename')
         new_filename_without_extension = get_filename(filename)
         upload_ids = request.data.get('uploadIds')
-        combined_detection_ids = []
+        combined_detection_objects = []
 
         # for each upload
             # check if the upload is created by this user
@@ -682,7 +899,7 @@ class MergeUploadsAPIView(APIView): # Done
             except:
                 return generate_invalid_id_response("upload")
             
-            combined_detection_ids += json.loads(upload_object.detection_ids)
+            combined_detection_objects += list(get_upload_pages(upload_object))
 
         new_upload = Upload.objects.create(
             user=user,
@@ -695,18 +912,7 @@ class MergeUploadsAPIView(APIView): # Done
         new_detection_ids = []
 
         # create new detection objects, this is required since the user may delete the old upload
-        for detection_id in combined_detection_ids:
-            try:
-                detection_object = Detection.objects.get(id=detection_id)
-            except:
-                return Response({
-                    'success': False,
-                    'error': {
-                        'errorCode': 0,
-                        'message': f"Could not find Detection object with id {detection_id}.",
-                    },
-                }, status=status.HTTP_201_CREATED) 
-
+        for detection_object in combined_detection_objects:
             new_filename = duplicate_inside_cloud_storage(detection_object.image_filename, "detection_images")
             
             new_detection = Detection.objects.create(
@@ -721,8 +927,7 @@ class MergeUploadsAPIView(APIView): # Done
             )
             new_detection_ids.append(new_detection.id)
         
-        new_upload.detection_ids = new_detection_ids
-        new_upload.save()
+        set_upload_pages(new_upload, new_detection_ids)
 
         serializer = UploadSerializer(new_upload)
         return Response({
@@ -884,11 +1089,12 @@ class ImportSingleUploadAPIView(APIView):
                 new_upload.processing_status = upload_processing_status_generators['errored']()
                 new_upload.save()
 
-            print(f"Failed to upload image: {image_filename} from Cache to Cloud Storage. Upload id: {new_upload.id}")
+                print(f"Failed to upload image: {image_filename} from Cache to Cloud Storage. Upload id: {new_upload.id}")
+                continue
 
             new_upload_detection_ids.append(new_detection.id)
-            new_upload.detection_ids = json.dumps(new_upload_detection_ids)
-            new_upload.save()
+
+        set_upload_pages(new_upload, new_upload_detection_ids)
         
         return Response({
             'success': True,
@@ -947,26 +1153,7 @@ class PDFGenerationAPIView(APIView):
                     }            
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        detection_ids = json.loads(upload_object.detection_ids)
-        selected_detection_ids = [
-            detection_id
-            for i, detection_id in enumerate(detection_ids)
-            if (i + 1) in page_numbers
-        ]
-
-        selected_detection_objects = []
-        for detection_id in selected_detection_ids:
-            try:
-                detection_object = Detection.objects.get(user=user, id=detection_id)
-                selected_detection_objects.append(detection_object)
-            except:
-                return Response({
-                    'success': False,
-                    'error': {
-                        "errorCode": 0,
-                        "message": f"Detection with id {detection_id} not found for user."
-                        }            
-                }, status=status.HTTP_400_BAD_REQUEST)
+        selected_detection_objects = get_upload_pages(upload_object).filter(user=user, page_index__in=[page_number - 1 for page_number in page_numbers])
         
         pdf_generator_detections = []
         pdf_generator_image_paths = []
@@ -9,10 +9,12 @@ Start Django Server
     python3 manage.py startup && python3 manage.py runserver
 """
 
+import json
 from pathlib import Path
 from datetime import timedelta
 from os.path import join
 from decouple import config
+from corsheaders.defaults import default_headers
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -33,7 +35,58 @@ DJANGO_TIME_ZONE = config('DJANGO_TIME_ZONE')
 DJANGO_LANGUAGE_CODE = config('DJANGO_LANGUAGE_CODE')
 BACKEND_VERSION = config('BACKEND_VERSION')
 FRONTEND_VERSION = config('FRONTEND_VERSION')
-SERVICE_API_KEY = config('SERVICE_API_KEY')
+SERVICE_API_KEY = config('SERVICE_API_KEY', default="") # default key of the create_service_api_key command, and of the key created by the startup command while there is none; requests are checked against the ServiceAPIKey objects
+NEW_UPLOAD_PROCESSING_MODE = config('NEW_UPLOAD_PROCESSING_MODE', default="fan_out") # "fan_out" or "serial"
+NEW_UPLOAD_PAGES_PER_TASK = config('NEW_UPLOAD_PAGES_PER_TASK', default=4, cast=int) # pages of one task are pipelined, 1 turns the pipelining off
+OCR_PIPELINE_MAX_PAGES_IN_FLIGHT = config('OCR_PIPELINE_MAX_PAGES_IN_FLIGHT', default=2, cast=int)
+MODEL_SERVER_POOL_CONNECTIONS = config('MODEL_SERVER_POOL_CONNECTIONS', default=4, cast=int) # number of model server hosts to keep pools for
+MODEL_SERVER_POOL_MAXSIZE = config('MODEL_SERVER_POOL_MAXSIZE', default=10, cast=int) # keep-alive connections per model server host
+MODEL_SERVER_CONNECT_TIMEOUT = config('MODEL_SERVER_CONNECT_TIMEOUT', default=5.0, cast=float)
+MODEL_SERVER_READ_TIMEOUT = config('MODEL_SERVER_READ_TIMEOUT', default=300.0, cast=float)
+MODEL_SERVER_MAX_RETRIES = config('MODEL_SERVER_MAX_RETRIES', default=0, cast=int)
+MODEL_SERVER_RETRY_BACKOFF_FACTOR = config('MODEL_SERVER_RETRY_BACKOFF_FACTOR', default=0.5, cast=float)
+TEXT_RECOGNIZER_BATCH_SIZE = config('TEXT_RECOGNIZER_BATCH_SIZE', default=64, cast=int) # crops per recognizer request, 0 for the whole page (0 starts at TEXT_RECOGNIZER_MAX_BATCH_SIZE with the adaptive batch size)
+TEXT_RECOGNIZER_MAX_CONCURRENT_BATCHES = config('TEXT_RECOGNIZER_MAX_CONCURRENT_BATCHES', default=4, cast=int)
+TEXT_RECOGNIZER_ADAPTIVE_BATCH_SIZE = config('TEXT_RECOGNIZER_ADAPTIVE_BATCH_SIZE', default=True, cast=bool) # tune the batch size of each recognizer from its observed latency, starting at TEXT_RECOGNIZER_BATCH_SIZE
+TEXT_RECOGNIZER_TARGET_LATENCY = config('TEXT_RECOGNIZER_TARGET_LATENCY', default=2.0, cast=float) # seconds per recognizer request
+TEXT_RECOGNIZER_MIN_BATCH_SIZE = config('TEXT_RECOGNIZER_MIN_BATCH_SIZE', default=8, cast=int)
+TEXT_RECOGNIZER_MAX_BATCH_SIZE = config('TEXT_RECOGNIZER_MAX_BATCH_SIZE', default=256, cast=int)
+TEXT_RECOGNIZER_MICRO_BATCHING = config('TEXT_RECOGNIZER_MICRO_BATCHING', default=False, cast=bool) # merge the crops of concurrent pages and uploads into shared recognizer requests, only across tasks with --pool=threads
+TEXT_RECOGNIZER_MICRO_BATCH_MAX_SIZE = config('TEXT_RECOGNIZER_MICRO_BATCH_MAX_SIZE', default=128, cast=int) # crops per merged recognizer request, the adaptive batch size replaces it when enabled
+TEXT_RECOGNIZER_MICRO_BATCH_MAX_WAIT_MS = config('TEXT_RECOGNIZER_MICRO_BATCH_MAX_WAIT_MS', default=20, cast=int) # longest a crop waits for others to join its request
+MODEL_SERVER_IMAGE_TRANSPORT = config('MODEL_SERVER_IMAGE_TRANSPORT', default="json") # "json" (base64), "multipart" or "packed"
+MODEL_SERVER_IMAGE_FORMAT = config('MODEL_SERVER_IMAGE_FORMAT', default="PNG") # "PNG", "JPEG", "WEBP" or "RAW"
+MODEL_SERVER_IMAGE_QUALITY = config('MODEL_SERVER_IMAGE_QUALITY', default=90, cast=int) # JPEG and WEBP only
+TEXT_RECOGNIZER_IMAGE_ENCODINGS = config('TEXT_RECOGNIZER_IMAGE_ENCODINGS', default="{}", cast=json.loads) # {"<modelId>": {"transport": ..., "format": ..., "quality": ...}}
+DOCUMENT_PARSER_SEND_ORIGINAL_IMAGE = config('DOCUMENT_PARSER_SEND_ORIGINAL_IMAGE', default=True, cast=bool) # send JPEG/PNG/WEBP pages as they are instead of re-encoding them
+PAGE_OCR_CACHE_ENABLED = config('PAGE_OCR_CACHE_ENABLED', default=True, cast=bool)
+PAGE_OCR_CACHE_MAX_SIZE_MB = config('PAGE_OCR_CACHE_MAX_SIZE_MB', default=512, cast=float) # least recently used entries are evicted above this
+PAGE_OCR_CACHE_EVICTION_INTERVAL = config('PAGE_OCR_CACHE_EVICTION_INTERVAL', default=60, cast=int) # seconds between two evictions, across all workers
+PAGE_OCR_CACHE_TOUCH_INTERVAL = config('PAGE_OCR_CACHE_TOUCH_INTERVAL', default=3600, cast=int) # seconds before a hit updates the entry's last use again
+PAGE_OCR_CACHE_HIT_CREDITS = config('PAGE_OCR_CACHE_HIT_CREDITS', default=1.0, cast=float) # credits charged for a page served from the cache
+CROP_TEXT_CACHE_ENABLED = config('CROP_TEXT_CACHE_ENABLED', default=True, cast=bool)
+CROP_TEXT_CACHE_MAX_ENTRIES = config('CROP_TEXT_CACHE_MAX_ENTRIES', default=20000, cast=int) # recognized texts kept in each worker
+CROP_TEXT_CACHE_REDIS_URL = config('CROP_TEXT_CACHE_REDIS_URL', default="") # a Redis with maxmemory and allkeys-lru, not the broker, empty keeps the cache in the workers only
+CROP_TEXT_CACHE_REDIS_TTL = config('CROP_TEXT_CACHE_REDIS_TTL', default=604800, cast=int) # seconds, 0 keeps the cache in the workers only
+CUSTOM_OCR_WAIT_TIMEOUT = config('CUSTOM_OCR_WAIT_TIMEOUT', default=30.0, cast=float) # seconds a custom OCR request waits for its text before answering with the task id to poll
+CUSTOM_OCR_TASK_TTL = config('CUSTOM_OCR_TASK_TTL', default=3600, cast=int) # seconds a custom OCR task id can be polled
+CUSTOM_OCR_BATCH_MAX_BBOXES = config('CUSTOM_OCR_BATCH_MAX_BBOXES', default=1000, cast=int) # bboxes per batch custom OCR request
+PAGE_IMAGE_CACHE_MAX_SIZE_MB = config('PAGE_IMAGE_CACHE_MAX_SIZE_MB', default=256, cast=float) # decoded pages kept by each re_run_ocr worker for custom OCR re-runs, shared by its processes, 0 disables it
+SERVICE_JOB_TTL = config('SERVICE_JOB_TTL', default=86400, cast=int) # seconds the status and results of a service job can be fetched
+SERVICE_JOB_CALLBACK_TIMEOUT = config('SERVICE_JOB_CALLBACK_TIMEOUT', default=10.0, cast=float) # seconds
+SERVICE_JOB_CALLBACK_MAX_RETRIES = config('SERVICE_JOB_CALLBACK_MAX_RETRIES', default=3, cast=int)
+SERVICE_JOB_CALLBACK_ALLOWED_HOSTS = [host for host in config('SERVICE_JOB_CALLBACK_ALLOWED_HOSTS', default="").split(',') if host] # callback hosts allowed to resolve to private addresses, e.g. an internal service
+SERVICE_STREAM_POLL_INTERVAL = config('SERVICE_STREAM_POLL_INTERVAL', default=0.2, cast=float) # seconds between checks for finished pages of a streamed service request
+SERVICE_STREAM_TIMEOUT = config('SERVICE_STREAM_TIMEOUT', default=600.0, cast=float) # seconds a streamed service request waits for its pages
+SERVICE_OCR_WAIT_TIMEOUT = config('SERVICE_OCR_WAIT_TIMEOUT', default=60.0, cast=float) # seconds a services/new-ocr/ request waits for its detections before answering 504
+SERVICE_INLINE_OCR = config('SERVICE_INLINE_OCR', default=False, cast=bool) # run small single-image service requests in the web process instead of Celery
+SERVICE_INLINE_OCR_MAX_CONCURRENCY = config('SERVICE_INLINE_OCR_MAX_CONCURRENCY', default=2, cast=int) # inline requests at once per web process, the others go through Celery
+SERVICE_INLINE_OCR_MAX_FILE_SIZE_MB = config('SERVICE_INLINE_OCR_MAX_FILE_SIZE_MB', default=5.0, cast=float)
+SERVICE_JOB_MAX_DURATION = config('SERVICE_JOB_MAX_DURATION', default=3600, cast=int) # seconds after which an unfinished request or job stops counting against its key's in-flight quota
+SERVICE_IN_FLIGHT_RETRY_AFTER = config('SERVICE_IN_FLIGHT_RETRY_AFTER', default=5, cast=int) # Retry-After seconds when a key has too many requests or jobs in flight
+DETECTION_PATCH_MAX_OPERATIONS = config('DETECTION_PATCH_MAX_OPERATIONS', default=5000, cast=int) # word-level operations per detections PATCH request
+MODEL_CONFIG_REFRESH_INTERVAL = config('MODEL_CONFIG_REFRESH_INTERVAL', default=300, cast=int) # seconds between model server config refreshes
+MODEL_CONFIG_FETCH_TIMEOUT = config('MODEL_CONFIG_FETCH_TIMEOUT', default=10.0, cast=float) # read timeout of a config fetch, requests waiting for the first one wait at most this long
 #endregion
 
 NEW_OCR_ACCEPTED_FILE_EXTENSIONS = [".pdf", ".jpg", ".jpeg"]
@@ -43,6 +96,8 @@ ALLOWED_HOSTS=["*"] if DEBUG else CS__ALLOWED_HOSTS.split(',')
 
 CORS_ORIGIN_ALLOW_ALL = DEBUG
 CORS_ORIGIN_WHITELIST = CS__CORS_ORIGIN_WHITELIST.split(',')
+CORS_ALLOW_HEADERS = (*default_headers, "if-none-match")
+CORS_EXPOSE_HEADERS = ["ETag"]
 #endregion
 
 ROOT_URLCONF = 'ocr_app.urls'
@@ -139,6 +194,7 @@ STATICFILES_DIRS = (
 MEDIA_URL= "/media/"
 MEDIA_ROOT = join(BASE_DIR, "media")
 CACHE_ROOT = join(BASE_DIR, "cache")
+MODEL_CONFIGS_ROOT = join(BASE_DIR, "model_configs") # snapshots of the model server configs, not in the cache since it is cleared at startup
 #endregion
 
 #region DRF Settings